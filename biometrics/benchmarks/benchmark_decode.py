@@ -0,0 +1,261 @@
+"""
+This script measures the throughput of the RAW decode paths on synthetic corpora (see `generate_raw_corpus.py`),
+so decode optimisations can be measured & regression gated on any Linux machine, without a live Pod.
+
+Key functionalities:
+- Generates 1h/8h/14h corpora on demand into `--corpus_folder` & reuses them on later runs.
+- Runs every case in a fresh Python process, so the peak RSS (VmHWM) of one case doesn't leak into the next.
+- Cases:
+    - `load_raw_files`: every record type, decoded into dicts.
+    - `load_piezo_df`: `load_raw_files` piezo records & `piezo_data.load_piezo_df`.
+    - `load_cap_df`: `load_raw_files` capSense records & `cap_data.load_cap_df`.
+    - `stream_tailer`: `stream.LatestRawFileHandler.follow_latest_file` on a file growing one minute at a time,
+      only the follow calls are timed.
+- Reports records/s, MB/s of RAW files read & peak RSS per case, optionally as JSON with `--output`.
+- With `--baseline`, compares records/s against a previous `--output` & exits with 1 when a case is more than
+  `--max_regression` slower.
+
+Usage:
+    python biometrics/benchmarks/benchmark_decode.py --hours 1 8 14 --output=/tmp/decode_benchmark.json
+    python biometrics/benchmarks/benchmark_decode.py --hours 8 --baseline=/tmp/decode_benchmark.json --max_regression=0.2
+"""
+import sys
+import os
+import gc
+import json
+import subprocess
+import tempfile
+import time
+from argparse import SUPPRESS, ArgumentParser, Namespace
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, TypedDict
+
+sys.path.append(os.getcwd())
+# Benchmarks run on any machine, not only the Pod, import the biometrics modules relative to this script
+BIOMETRICS_FOLDER_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BIOMETRICS_FOLDER_PATH)
+sys.path.append(os.path.join(BIOMETRICS_FOLDER_PATH, 'sleep_detection'))
+sys.path.append(os.path.join(BIOMETRICS_FOLDER_PATH, 'stream'))
+
+# This must run before the other local import in order to set up the logger
+from get_logger import get_logger
+
+logger = get_logger('decode-benchmark')
+
+from data_types import *
+from generate_raw_corpus import get_corpus_config, iter_raw_seconds, write_raw_corpus
+from load_raw_files import get_current_files
+from raw_index import get_raw_file_index
+from resource_usage import get_peak_memory_usage_unix
+
+CORPUS_FOLDER_PATH = '/tmp/free-sleep-benchmark/'
+CORPUS_START_TIME = datetime(2025, 1, 10, 20, 0, 0, tzinfo=timezone.utc)
+CASES = ['load_raw_files', 'load_piezo_df', 'load_cap_df', 'stream_tailer']
+
+
+class BenchmarkResult(TypedDict):
+    case: str
+    hours: float
+    records: int
+    raw_mb: float
+    seconds: float
+    records_per_second: float
+    mb_per_second: float
+    peak_rss_mb: float
+
+
+def _get_corpus_folder_path(corpus_folder: str, hours: float) -> str:
+    return os.path.join(corpus_folder, f'{hours:g}h')
+
+
+def _get_raw_mb(folder_path: str) -> float:
+    return sum(os.path.getsize(file_path) for file_path in get_current_files(folder_path)) / 1024 / 1024
+
+
+def prepare_corpus(corpus_folder: str, hours: float) -> str:
+    """
+    Writes the corpus if it doesn't exist yet & builds the RAW file indexes, so the cases only measure decoding
+    """
+    folder_path = _get_corpus_folder_path(corpus_folder, hours)
+    if len(get_current_files(folder_path)) == 0:
+        write_raw_corpus(folder_path, CORPUS_START_TIME, hours, get_corpus_config(gap_rate=0.01, duplicate_seq_rate=0.0005))
+    for file_path in get_current_files(folder_path):
+        get_raw_file_index(file_path)
+    return folder_path
+
+
+def _run_load_raw_files(folder_path: str, hours: float, side: Side) -> int:
+    from load_raw_files import load_raw_files
+
+    end_time = CORPUS_START_TIME + timedelta(hours=hours)
+    data = load_raw_files(folder_path, CORPUS_START_TIME, end_time, side)
+    return sum(len(records) for records in data.values())
+
+
+def _run_load_piezo_df(folder_path: str, hours: float, side: Side) -> int:
+    from load_raw_files import load_raw_files
+    from piezo_data import load_piezo_df
+
+    end_time = CORPUS_START_TIME + timedelta(hours=hours)
+    data = load_raw_files(folder_path, CORPUS_START_TIME, end_time, side, raw_data_types=['piezo-dual'], epoch_ts=True)
+    return len(load_piezo_df(data, side))
+
+
+def _run_load_cap_df(folder_path: str, hours: float, side: Side) -> int:
+    from load_raw_files import load_raw_files
+    from cap_data import load_cap_df
+
+    end_time = CORPUS_START_TIME + timedelta(hours=hours)
+    data = load_raw_files(folder_path, CORPUS_START_TIME, end_time, side, raw_data_types=['capSense'])
+    return len(load_cap_df(data, side))
+
+
+def _run_stream_tailer(hours: float, block_seconds=60) -> Dict[str, float]:
+    """
+    Appends the corpus to a RAW file one block at a time, like the Pod does, and times only the tailer reading it.
+    The corpus starts now, the tailer skips records older than 2 minutes.
+    """
+    import stream
+
+    start_ts = int(time.time())
+    seconds = int(hours * 60 * 60)
+    records, raw_bytes, elapsed = 0, 0, 0.0
+    with tempfile.TemporaryDirectory() as folder_path:
+        file_path = os.path.join(folder_path, '00000000.RAW')
+        open(file_path, 'wb').close()
+        handler = stream.LatestRawFileHandler(folder_path)
+        block = []
+        with open(file_path, 'ab') as raw_file:
+            for ts, encoded in iter_raw_seconds(start_ts, seconds, get_corpus_config(), block_seconds=block_seconds):
+                block.append(encoded)
+                if (ts - start_ts) % block_seconds != block_seconds - 1:
+                    continue
+                raw_file.write(b''.join(block))
+                raw_file.flush()
+                raw_bytes += sum(len(encoded) for encoded in block)
+                block = []
+
+                start = time.perf_counter()
+                handler.follow_latest_file()
+                elapsed += time.perf_counter() - start
+                while not stream.piezo_record_queue.empty():
+                    stream.piezo_record_queue.get_nowait()
+                    records += 1
+        handler.latest_file_reader.close()
+    return {'records': records, 'raw_mb': raw_bytes / 1024 / 1024, 'seconds': elapsed}
+
+
+def run_case(case: str, corpus_folder: str, hours: float, side: Side) -> BenchmarkResult:
+    """
+    Runs a single case in the current process, call through `_run_case_subprocess` to get a clean peak RSS
+    """
+    folder_path = _get_corpus_folder_path(corpus_folder, hours)
+    gc.collect()
+    if case == 'stream_tailer':
+        stream_result = _run_stream_tailer(hours)
+        records, raw_mb, seconds = stream_result['records'], stream_result['raw_mb'], stream_result['seconds']
+    else:
+        case_functions = {
+            'load_raw_files': _run_load_raw_files,
+            'load_piezo_df': _run_load_piezo_df,
+            'load_cap_df': _run_load_cap_df,
+        }
+        raw_mb = _get_raw_mb(folder_path)
+        start = time.perf_counter()
+        records = case_functions[case](folder_path, hours, side)
+        seconds = time.perf_counter() - start
+
+    return {
+        'case': case,
+        'hours': hours,
+        'records': records,
+        'raw_mb': round(raw_mb, 2),
+        'seconds': round(seconds, 3),
+        'records_per_second': round(records / seconds, 1) if seconds > 0 else 0,
+        'mb_per_second': round(raw_mb / seconds, 2) if seconds > 0 else 0,
+        'peak_rss_mb': round(get_peak_memory_usage_unix(), 1),
+    }
+
+
+def _run_case_subprocess(case: str, corpus_folder: str, hours: float, side: Side) -> BenchmarkResult:
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        '--run_case', case,
+        '--corpus_folder', corpus_folder,
+        '--hours', str(hours),
+        '--side', side,
+    ]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    # The result is the last line, anything before it was logged by the modules under test
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare_to_baseline(results: List[BenchmarkResult], baseline: List[BenchmarkResult], max_regression: float) -> List[str]:
+    """
+    Returns a message for every case whose records/s dropped by more than max_regression vs the baseline
+    """
+    baseline_results = {(result['case'], result['hours']): result for result in baseline}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get((result['case'], result['hours']))
+        if baseline_result is None or baseline_result['records_per_second'] == 0:
+            continue
+        change = result['records_per_second'] / baseline_result['records_per_second'] - 1
+        if change < -max_regression:
+            regressions.append(
+                f"{result['case']} {result['hours']:g}h | {result['records_per_second']:,.0f} records/s vs "
+                f"{baseline_result['records_per_second']:,.0f} baseline ({change:+.0%})"
+            )
+    return regressions
+
+
+def _parse_args() -> Namespace:
+    parser = ArgumentParser(description="Benchmark the RAW decode paths on synthetic corpora.")
+    parser.add_argument("--corpus_folder", default=CORPUS_FOLDER_PATH, help=f"Folder the corpora are written to (default: {CORPUS_FOLDER_PATH}).")
+    parser.add_argument("--hours", type=float, nargs='+', default=[1, 8, 14], help="Corpus lengths in hours (default: 1 8 14).")
+    parser.add_argument("--cases", nargs='+', choices=CASES, default=CASES, help="Cases to run (default: all).")
+    parser.add_argument("--side", choices=['left', 'right'], default='left', help="Side to load (default: left).")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", default=None, help="JSON file of a previous --output to compare against.")
+    parser.add_argument("--max_regression", type=float, default=0.2, help="Allowed records/s drop vs the baseline (default: 0.2).")
+    parser.add_argument("--run_case", choices=CASES, default=None, help=SUPPRESS)
+    return parser.parse_args()
+
+
+def main(args: Namespace) -> int:
+    results: List[BenchmarkResult] = []
+    for hours in args.hours:
+        prepare_corpus(args.corpus_folder, hours)
+        for case in args.cases:
+            result = _run_case_subprocess(case, args.corpus_folder, hours, args.side)
+            results.append(result)
+            logger.info(
+                f"{case:<15} {hours:>4g}h | {result['records']:>9,} records | {result['seconds']:>8.2f}s | "
+                f"{result['records_per_second']:>10,.0f} records/s | {result['mb_per_second']:>7.2f} MB/s | "
+                f"peak RSS {result['peak_rss_mb']:>7.1f} MB"
+            )
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        logger.info(f'Wrote results to {args.output}')
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline: List[BenchmarkResult] = json.load(baseline_file)
+        regressions = compare_to_baseline(results, baseline, args.max_regression)
+        for regression in regressions:
+            logger.error(f'Regression | {regression}')
+        if regressions:
+            return 1
+        logger.info(f'No case regressed by more than {args.max_regression:.0%} vs {args.baseline}')
+    return 0
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    if args.run_case is not None:
+        print(json.dumps(run_case(args.run_case, args.corpus_folder, args.hours[0], args.side)))
+        sys.exit(0)
+    logger.setLevel('INFO')
+    sys.exit(main(args))
@@ -0,0 +1,142 @@
+"""
+This script measures `heart.datautils.rolling_mean` against the sliding window version it replaced, on the signal
+lengths heartpy is run on: the 3s stream heart rate windows, 30s and the 300s HRV windows.
+
+Key functionalities:
+- Signals are the synthetic piezo signal of `generate_raw_corpus.py` at 500 Hz, filtered like the stream does.
+- Cases per signal length:
+    - `sliding_window`: the previous O(n * window) implementation, a mean per strided window, padded by concatenation.
+    - `cumsum`: `rolling_mean`, allocating its result.
+    - `cumsum_out`: `rolling_mean` writing into one reused buffer, like the stream heart rate windows.
+- Checks that every case matches `sliding_window` (padding exactly, means to float rounding) before timing it.
+- Reports the best time per call & the speedup vs `sliding_window`, optionally as JSON with `--output`.
+
+Usage:
+    python biometrics/benchmarks/benchmark_rolling_mean.py
+    python biometrics/benchmarks/benchmark_rolling_mean.py --seconds 3 30 300 --window_size 0.65 --output=/tmp/rolling_mean_benchmark.json
+"""
+import sys
+import os
+import json
+import timeit
+from argparse import ArgumentParser, Namespace
+from typing import List, TypedDict
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+# Benchmarks run on any machine, not only the Pod, import the biometrics modules relative to this script
+BIOMETRICS_FOLDER_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BIOMETRICS_FOLDER_PATH)
+sys.path.append(os.path.join(BIOMETRICS_FOLDER_PATH, 'stream'))
+
+# This must run before the other local import in order to set up the logger
+from get_logger import get_logger
+
+logger = get_logger('rolling-mean-benchmark')
+
+from generate_raw_corpus import _SideSignal, get_corpus_config
+from biometric_processor import filter_heart_signal
+from heart.datautils import rolling_mean
+
+SAMPLE_RATE = 500
+
+
+class BenchmarkResult(TypedDict):
+    case: str
+    seconds: float  # Signal length
+    window_size: float
+    ms_per_call: float
+    speedup: float  # vs sliding_window
+
+
+def sliding_window_rolling_mean(hrdata: np.ndarray, windowsize: float, sample_rate: int) -> np.ndarray:
+    win_size = int(windowsize * sample_rate)
+    rol_mean = np.mean(np.lib.stride_tricks.sliding_window_view(hrdata, win_size), axis=1)
+    n_missvals = (len(hrdata) - len(rol_mean)) // 2
+    missvals_a = np.full(n_missvals, rol_mean[0], dtype=hrdata.dtype)
+    missvals_b = np.full(n_missvals, rol_mean[-1], dtype=hrdata.dtype)
+    rol_mean = np.hstack((missvals_a, rol_mean, missvals_b))
+    len_diff = len(rol_mean) - len(hrdata)
+    if len_diff < 0:
+        rol_mean = np.append(rol_mean, np.zeros(-len_diff, dtype=hrdata.dtype))
+    elif len_diff > 0:
+        rol_mean = rol_mean[:len(hrdata)]
+    return rol_mean
+
+
+def get_signal(seconds: float) -> np.ndarray:
+    side_signal = _SideSignal(get_corpus_config(), np.random.default_rng(0), 0)
+    whole_seconds = int(np.ceil(seconds))
+    signal = side_signal.samples(0, whole_seconds, np.ones(whole_seconds))['1'].reshape(-1)[:int(seconds * SAMPLE_RATE)]
+    return filter_heart_signal(signal, (0.2, 99.8))
+
+
+def _check(expected: np.ndarray, actual: np.ndarray, window_size: float):
+    n_missvals = (int(window_size * SAMPLE_RATE) - 1) // 2
+    mean_count = len(expected) - 2 * n_missvals - (int(window_size * SAMPLE_RATE) + 1) % 2
+    if actual.shape != expected.shape or actual.dtype != expected.dtype:
+        raise AssertionError(f'Shape/dtype {actual.shape} {actual.dtype} != {expected.shape} {expected.dtype}')
+    # The padding repeats the first & last mean & an even window leaves a zero at the end
+    if not (np.all(actual[:n_missvals] == actual[n_missvals]) and np.all(actual[n_missvals + mean_count:][:n_missvals] == actual[n_missvals + mean_count - 1])):
+        raise AssertionError('Padding differs')
+    if not np.array_equal(actual[2 * n_missvals + mean_count:], expected[2 * n_missvals + mean_count:]):
+        raise AssertionError('Length correction differs')
+    if not np.allclose(actual, expected, rtol=1e-12, atol=1e-9):
+        raise AssertionError(f'Means differ by {np.max(np.abs(actual - expected))}')
+
+
+def run_benchmark(seconds: float, window_size: float, repeat: int) -> List[BenchmarkResult]:
+    signal = get_signal(seconds)
+    out = np.empty(len(signal))
+    case_functions = {
+        'sliding_window': lambda: sliding_window_rolling_mean(signal, window_size, SAMPLE_RATE),
+        'cumsum': lambda: rolling_mean(signal, window_size, SAMPLE_RATE),
+        'cumsum_out': lambda: rolling_mean(signal, window_size, SAMPLE_RATE, out=out),
+    }
+    expected = case_functions['sliding_window']()
+    results: List[BenchmarkResult] = []
+    for case, function in case_functions.items():
+        _check(expected, function(), window_size)
+        # Fewer calls for long signals, so every length takes about as long
+        number = max(1, int(repeat * 3 / seconds))
+        ms_per_call = min(timeit.repeat(function, number=number, repeat=5)) / number * 1000
+        results.append({
+            'case': case,
+            'seconds': seconds,
+            'window_size': window_size,
+            'ms_per_call': round(ms_per_call, 4),
+            'speedup': round(results[0]['ms_per_call'] / ms_per_call, 1) if results else 1.0,
+        })
+    return results
+
+
+def _parse_args() -> Namespace:
+    parser = ArgumentParser(description="Benchmark heart.datautils.rolling_mean against the sliding window version.")
+    parser.add_argument("--seconds", type=float, nargs='+', default=[3, 30, 300], help="Signal lengths in seconds (default: 3 30 300).")
+    parser.add_argument("--window_size", type=float, default=0.65, help="Rolling mean window in seconds (default: 0.65).")
+    parser.add_argument("--repeat", type=int, default=200, help="Calls per timing of a 3s signal (default: 200).")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file.")
+    return parser.parse_args()
+
+
+def main(args: Namespace) -> int:
+    results: List[BenchmarkResult] = []
+    for seconds in args.seconds:
+        for result in run_benchmark(seconds, args.window_size, args.repeat):
+            results.append(result)
+            logger.info(
+                f"{result['case']:<15} {seconds:>5g}s | {result['ms_per_call']:>9.4f} ms/call | {result['speedup']:>6.1f}x"
+            )
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        logger.info(f'Wrote results to {args.output}')
+    return 0
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    logger.setLevel('INFO')
+    sys.exit(main(args))
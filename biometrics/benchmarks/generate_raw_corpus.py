@@ -0,0 +1,238 @@
+"""
+This script writes synthetic `.RAW` files in the same outer/inner CBOR layout as the Pod, so the
+decode paths can be measured without a live Pod (see `benchmark_decode.py`).
+
+Key functionalities:
+- Piezo channels carry a breathing wave, heart beats with beat to beat jitter & noise while the bed
+  is occupied, and only noise while it's empty (`empty_minutes` at the start & end of the corpus).
+- capSense values step up while the bed is occupied, bedTemp, frzTemp & log records are written
+  at their own interval, record types left out of `record_intervals` aren't written.
+- Optional gaps without any records & duplicate `seq`s, like the Pod produces.
+- Files are split every `file_minutes` & their mtime is set to their last record, like closed Pod files.
+
+Usage:
+    python biometrics/benchmarks/generate_raw_corpus.py --folder_path=/tmp/raw --start_time="2025-01-10 20:00:00" --hours=8
+"""
+import sys
+import os
+from argparse import ArgumentParser, Namespace
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple, TypedDict
+import cbor2
+import numpy as np
+
+sys.path.append(os.getcwd())
+# Benchmarks run on any machine, not only the Pod, import the biometrics modules relative to this script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# This must run before the other local import in order to set up the logger
+from get_logger import get_logger
+
+logger = get_logger('decode-benchmark')
+
+from data_types import *
+from biometrics_helpers import validate_datetime_utc
+
+SAMPLE_RATE = 500
+# Offsets of the piezo channels, taken from a real recording
+CHANNEL_OFFSETS = {'left1': -160_000, 'left2': -5_000, 'right1': 540_000, 'right2': 720_000}
+# Empty bed capacitance, taken from a real recording
+CAP_BASELINES = {'left': {'out': 387, 'cen': 381, 'in': 505}, 'right': {'out': 1076, 'cen': 1075, 'in': 1074}}
+
+
+class CorpusConfig(TypedDict):
+    heart_rate: float  # Beats per minute while the bed is occupied
+    breathing_rate: float  # Breaths per minute while the bed is occupied
+    hrv_ms: float  # Standard deviation of the beat to beat interval jitter
+    sides: List[Side]  # Occupied sides
+    empty_minutes: float  # Minutes the bed is empty at the start & the end of the corpus
+    record_intervals: Dict[str, int]  # Seconds between records of each RawDataTypes
+    gap_rate: float  # Probability a minute is followed by a gap without records
+    gap_seconds: int
+    duplicate_seq_rate: float  # Probability a record reuses the seq of the previous record
+    file_minutes: int
+    seed: int
+
+
+def get_corpus_config(**overrides) -> CorpusConfig:
+    config: CorpusConfig = {
+        'heart_rate': 60,
+        'breathing_rate': 15,
+        'hrv_ms': 40,
+        'sides': ['left', 'right'],
+        'empty_minutes': 10,
+        'record_intervals': {'piezo-dual': 1, 'capSense': 1, 'bedTemp': 60, 'frzTemp': 60, 'log': 300},
+        'gap_rate': 0.0,
+        'gap_seconds': 30,
+        'duplicate_seq_rate': 0.0,
+        'file_minutes': 15,
+        'seed': 0,
+    }
+    config.update(overrides)
+    return config
+
+
+class _SideSignal:
+    """
+    Keeps the beat times of a side across blocks so the heart beats stay continuous
+    """
+
+    def __init__(self, config: CorpusConfig, rng: np.random.Generator, start_ts: int):
+        self.config = config
+        self.rng = rng
+        self.next_beat = float(start_ts)
+        self.breathing_phase = rng.uniform(0, 2 * np.pi)
+
+    def _beat_times(self, block_start: float, block_end: float) -> np.ndarray:
+        beat_interval = 60 / self.config['heart_rate']
+        beats = []
+        while self.next_beat < block_end:
+            if self.next_beat >= block_start:
+                beats.append(self.next_beat)
+            self.next_beat += beat_interval + self.rng.normal(0, self.config['hrv_ms'] / 1000)
+        return np.array(beats)
+
+    def samples(self, block_start: int, seconds: int, occupied: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Returns the (seconds, SAMPLE_RATE) signal of the side's sensor 1 & 2 before their offsets
+        """
+        t = block_start + np.arange(seconds * SAMPLE_RATE) / SAMPLE_RATE
+        breathing = np.sin(2 * np.pi * self.config['breathing_rate'] / 60 * t + self.breathing_phase)
+
+        heart = np.zeros_like(t)
+        pulse_offsets = np.arange(-25, 26)
+        pulse = np.exp(-0.5 * (pulse_offsets / 6) ** 2)
+        for beat in self._beat_times(block_start, block_start + seconds):
+            ix = int(round((beat - block_start) * SAMPLE_RATE)) + pulse_offsets
+            valid = (ix >= 0) & (ix < len(t))
+            heart[ix[valid]] += pulse[valid]
+
+        presence = np.repeat(occupied, SAMPLE_RATE).astype(np.float64)
+        signals = {}
+        for sensor, gain in [(1, 1.0), (2, 0.6)]:
+            # Occupied signals swing well past the 200k peak to peak presence threshold of the stream
+            signal = presence * gain * (180_000 * breathing + 48_000 * heart)
+            noise = self.rng.normal(0, 9_000 if sensor == 1 else 6_000, len(t)) * np.where(presence > 0, 1.0, 0.05)
+            signals[str(sensor)] = (signal + noise).reshape(seconds, SAMPLE_RATE)
+        return signals
+
+
+def iter_raw_seconds(start_ts: int, seconds: int, config: Optional[CorpusConfig] = None, seq=0, block_seconds=60) -> Iterator[Tuple[int, bytes]]:
+    """
+    Yields (ts, encoded records) for every second of the corpus, skipping the seconds inside gaps
+    """
+    if config is None:
+        config = get_corpus_config()
+    rng = np.random.default_rng(config['seed'])
+    side_signals = {side: _SideSignal(config, rng, start_ts) for side in ['left', 'right']}
+    record_intervals = config['record_intervals']
+    empty_seconds = int(config['empty_minutes'] * 60)
+    gap_until = -1
+
+    for block_start in range(start_ts, start_ts + seconds, block_seconds):
+        block_length = min(block_seconds, start_ts + seconds - block_start)
+        elapsed = np.arange(block_start, block_start + block_length) - start_ts
+        occupied = (elapsed >= empty_seconds) & (elapsed < seconds - empty_seconds)
+        channels = {}
+        for side, side_signal in side_signals.items():
+            side_occupied = occupied if side in config['sides'] else np.zeros_like(occupied)
+            for sensor, samples in side_signal.samples(block_start, block_length, side_occupied).items():
+                channels[f'{side}{sensor}'] = (samples + CHANNEL_OFFSETS[f'{side}{sensor}']).astype(np.int32)
+
+        for row in range(block_length):
+            ts = block_start + row
+            if ts <= gap_until:
+                continue
+            if (ts - start_ts) % 60 == 59 and rng.random() < config['gap_rate']:
+                gap_until = ts + config['gap_seconds']
+
+            records = []
+            if 'piezo-dual' in record_intervals and (ts - start_ts) % record_intervals['piezo-dual'] == 0:
+                records.append({
+                    'type': 'piezo-dual', 'ts': ts, 'freq': SAMPLE_RATE, 'adc': 1, 'gain': 400,
+                    **{name: channel[row].tobytes() for name, channel in channels.items()},
+                })
+            if 'capSense' in record_intervals and (ts - start_ts) % record_intervals['capSense'] == 0:
+                cap_record = {'type': 'capSense', 'ts': ts}
+                for side in ['left', 'right']:
+                    step = 30 if occupied[row] and side in config['sides'] else 0
+                    cap_record[side] = {sensor: int(baseline + step + rng.integers(-1, 2)) for sensor, baseline in CAP_BASELINES[side].items()}
+                    cap_record[side]['status'] = 'good'
+                records.append(cap_record)
+            if 'bedTemp' in record_intervals and (ts - start_ts) % record_intervals['bedTemp'] == 0:
+                records.append({
+                    'type': 'bedTemp', 'ts': ts, 'amb': 2168, 'mcu': 3100, 'hu': 45,
+                    'left': {'side': 2900, 'out': 2800, 'cen': 2850, 'in': 2870},
+                    'right': {'side': 2950, 'out': 2810, 'cen': 2860, 'in': 2880},
+                })
+            if 'frzTemp' in record_intervals and (ts - start_ts) % record_intervals['frzTemp'] == 0:
+                records.append({'type': 'frzTemp', 'ts': ts, 'left': 1975, 'right': 1981, 'amb': 2168, 'hs': 3168})
+            if 'log' in record_intervals and (ts - start_ts) % record_intervals['log'] == 0:
+                records.append({'type': 'log', 'ts': ts, 'level': 'info', 'msg': 'synthetic corpus heartbeat'})
+
+            encoded = []
+            for record in records:
+                if seq == 0 or rng.random() >= config['duplicate_seq_rate']:
+                    seq += 1
+                record['seq'] = seq
+                encoded.append(cbor2.dumps({'seq': seq, 'data': cbor2.dumps(record)}))
+            yield ts, b''.join(encoded)
+
+
+def write_raw_corpus(folder_path: str, start_time: datetime, hours: float, config: Optional[CorpusConfig] = None) -> List[str]:
+    """
+    Writes the corpus into folder_path, returns the paths of the RAW files
+    """
+    if config is None:
+        config = get_corpus_config()
+    os.makedirs(folder_path, exist_ok=True)
+    start_ts = int(start_time.timestamp())
+    file_seconds = config['file_minutes'] * 60
+    logger.info(f'Writing {hours}h synthetic RAW corpus to {folder_path}...')
+
+    file_paths = []
+    raw_file = None
+    file_start, last_ts = None, None
+    for ts, encoded in iter_raw_seconds(start_ts, int(hours * 60 * 60), config):
+        if raw_file is None or ts >= file_start + file_seconds:
+            if raw_file is not None:
+                raw_file.close()
+                os.utime(file_paths[-1], (last_ts, last_ts))
+            file_start = ts - (ts - start_ts) % file_seconds
+            file_paths.append(os.path.join(folder_path, f'{len(file_paths):08d}.RAW'))
+            raw_file = open(file_paths[-1], 'wb')
+        raw_file.write(encoded)
+        last_ts = ts
+    if raw_file is not None:
+        raw_file.close()
+        os.utime(file_paths[-1], (last_ts, last_ts))
+    return file_paths
+
+
+def _parse_args() -> Namespace:
+    parser = ArgumentParser(description="Write a synthetic RAW corpus.")
+    parser.add_argument("--folder_path", required=True, help="Folder the RAW files are written to.")
+    parser.add_argument("--start_time", type=validate_datetime_utc, required=True, help="Start time in UTC format 'YYYY-MM-DD HH:MM:SS'.")
+    parser.add_argument("--hours", type=float, default=8, help="Length of the corpus in hours (default: 8).")
+    parser.add_argument("--heart_rate", type=float, default=60, help="Heart rate in beats per minute (default: 60).")
+    parser.add_argument("--breathing_rate", type=float, default=15, help="Breathing rate in breaths per minute (default: 15).")
+    parser.add_argument("--gap_rate", type=float, default=0.0, help="Probability a minute is followed by a gap without records (default: 0).")
+    parser.add_argument("--duplicate_seq_rate", type=float, default=0.0, help="Probability a record reuses the previous seq (default: 0).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0).")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    write_raw_corpus(
+        args.folder_path,
+        args.start_time,
+        args.hours,
+        get_corpus_config(
+            heart_rate=args.heart_rate,
+            breathing_rate=args.breathing_rate,
+            gap_rate=args.gap_rate,
+            duplicate_seq_rate=args.duplicate_seq_rate,
+            seed=args.seed,
+        ),
+    )
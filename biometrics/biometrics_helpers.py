@@ -1,5 +1,6 @@
 import argparse
 import numpy as np
+import pandas as pd
 from datetime import datetime, timezone
 import json
 
@@ -18,3 +19,12 @@ def validate_datetime_utc(date_str):
             f"Invalid datetime format: '{date_str}'. Use ISO 8601 format like 'YYYY-MM-DDTHH:MM:SSZ'."
         )
 
+
+def ts_to_datetime(ts: pd.Series) -> pd.Series:
+    """
+    Converts a `ts` column to datetime64, `ts` is either int epoch seconds (loaded with epoch_ts=True)
+    or 'YYYY-MM-DD HH:MM:SS' strings
+    """
+    if pd.api.types.is_integer_dtype(ts):
+        return pd.to_datetime(ts, unit='s')
+    return pd.to_datetime(ts)
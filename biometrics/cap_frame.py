@@ -0,0 +1,64 @@
+"""
+This module defines `CapFrame`, a columnar container for capacitance sensor data.
+
+A `CapFrame` holds an `epochs` & `seq` vector plus one int32 vector per kept sensor
+(e.g. `left_out`, `left_cen`, `left_in`), it's the capSense counterpart of `PiezoFrame`.
+
+Usage:
+- Use `load_raw_files.load_raw_frames(...)` to load a frame directly from RAW files.
+- Use `cap_data.load_cap_df(frame, side)` to turn it into the capacitance dataframe.
+"""
+from typing import List
+
+import numpy as np
+
+from data_types import *
+from piezo_frame import RecordFrame
+
+
+class CapFrame(RecordFrame):
+    """
+    Capacitance channels are `(n_seconds,)` int32 vectors named `{side}_{sensor}`
+    """
+
+    @staticmethod
+    def empty(channel_names: List[str]) -> 'CapFrame':
+        return CapFrame(
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            {name: np.empty(0, dtype=np.int32) for name in channel_names},
+        )
+
+
+class CapFrameBuilder:
+    """
+    Collects the sensor values of capSense records into flat lists, capSense records are
+    a few integers each so there's no need to preallocate like `PiezoFrameBuilder`.
+    """
+
+    def __init__(self):
+        self.epochs: List[int] = []
+        self.seq: List[int] = []
+        self.channels: Dict[str, List[int]] = {}
+
+    def append(self, cap_record: CapSenseData):
+        if not self.channels:
+            # Keep the sides left after `_delete_other_side`
+            self.channels = {
+                f'{side}_{sensor}': []
+                for side in ['left', 'right'] if side in cap_record
+                for sensor in ['out', 'cen', 'in']
+            }
+        for name, values in self.channels.items():
+            side, sensor = name.split('_')
+            values.append(cap_record[side][sensor])
+        self.epochs.append(cap_record['ts'])
+        self.seq.append(cap_record['seq'])
+
+    def build(self) -> CapFrame:
+        frame = CapFrame(
+            np.array(self.epochs, dtype=np.int64),
+            np.array(self.seq, dtype=np.int64),
+            {name: np.array(values, dtype=np.int32) for name, values in self.channels.items()},
+        )
+        return frame.sorted()
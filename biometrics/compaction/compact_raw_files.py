@@ -0,0 +1,124 @@
+"""
+This script compacts closed `.RAW` files into the columnar night archives of `raw_archive.py`
+and applies the retention policy to the original files.
+
+Key functionalities:
+- Skips the RAW file the pod is still writing to & files modified within `--compact_after_hours`.
+- Writes one archive chunk per RAW file into `{folder_path}archive/{night}/`, files already compacted are skipped.
+- With `--delete_raw_after_days`, deletes the compacted originals older than that, `load_raw_files.py`
+  reads their records from the archive from then on.
+
+Usage:
+    cd /home/dac/free-sleep/biometrics/compaction && /home/dac/venv/bin/python compact_raw_files.py --compact_after_hours=1 --delete_raw_after_days=2
+"""
+import sys
+import platform
+import os
+import time
+import traceback
+from argparse import ArgumentParser, Namespace
+from typing import Optional
+
+sys.path.append(os.getcwd())
+FOLDER_PATH = '/persistent/'
+if platform.system().lower() == 'linux':
+    sys.path.append('/home/dac/free-sleep/biometrics/')
+
+# This must run before the other local import in order to set up the logger
+from get_logger import get_logger
+
+logger = get_logger('raw-compactor')
+
+from load_raw_files import get_current_files
+from raw_archive import compact_raw_file, is_same_source, list_archived_chunks
+
+
+def _parse_args() -> Namespace:
+    parser = ArgumentParser(description="Compact closed RAW files into columnar night archives.")
+    parser.add_argument(
+        "--folder_path",
+        default=FOLDER_PATH,
+        required=False,
+        help=f"Folder holding the RAW files (default: {FOLDER_PATH})."
+    )
+    parser.add_argument(
+        "--compact_after_hours",
+        type=float,
+        default=1,
+        required=False,
+        help="Only compact RAW files which haven't been modified for this many hours (default: 1)."
+    )
+    parser.add_argument(
+        "--delete_raw_after_days",
+        type=float,
+        default=None,
+        required=False,
+        help="Delete compacted RAW files older than this many days, originals are kept if omitted."
+    )
+    return parser.parse_args()
+
+
+def compact_raw_files(folder_path: str, compact_after_hours: float = 1, delete_raw_after_days: Optional[float] = None):
+    file_paths = get_current_files(folder_path)
+    if len(file_paths) == 0:
+        logger.info(f'No RAW files found in {folder_path}')
+        return
+
+    # The most recently modified file is still being written by the pod
+    latest_file_path = max(file_paths, key=os.path.getmtime)
+    archived_chunks = list_archived_chunks(folder_path)
+    now = time.time()
+    compacted_count, deleted_count, raw_bytes, deleted_bytes = 0, 0, 0, 0
+
+    for file_path in sorted(file_paths):
+        if file_path == latest_file_path:
+            continue
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        age_seconds = now - stat.st_mtime
+        if age_seconds < compact_after_hours * 60 * 60:
+            continue
+
+        file_name = os.path.basename(file_path)
+        archived_chunk = archived_chunks.get(file_name)
+        if archived_chunk is None or not is_same_source(file_path, archived_chunk[1]):
+            try:
+                chunk = compact_raw_file(file_path, folder_path)
+            except Exception as error:
+                logger.error(f'Error compacting {file_path} | {error}')
+                logger.error(traceback.format_exc())
+                continue
+            if chunk is None:
+                logger.warning(f'No records found in {file_path}, skipping...')
+                continue
+            compacted_count += 1
+            raw_bytes += stat.st_size
+
+        if delete_raw_after_days is not None and age_seconds >= delete_raw_after_days * 24 * 60 * 60:
+            os.remove(file_path)
+            deleted_count += 1
+            deleted_bytes += stat.st_size
+
+    logger.info(
+        f'Compacted {compacted_count:,} RAW files ({raw_bytes / 1024 / 1024:0.1f} MB) | '
+        f'Deleted {deleted_count:,} compacted RAW files ({deleted_bytes / 1024 / 1024:0.1f} MB)'
+    )
+
+
+if __name__ == "__main__":
+    try:
+        args = _parse_args()
+        compact_raw_files(
+            args.folder_path,
+            compact_after_hours=args.compact_after_hours,
+            delete_raw_after_days=args.delete_raw_after_days,
+        )
+    except KeyboardInterrupt:
+        logger.info('Keyboard interrupt signal received, exiting...')
+    except Exception as e:
+        logger.error(e)
+        stack = traceback.format_exc()
+        logger.error(stack)
+        logger.error('Error compacting RAW files, exiting...')
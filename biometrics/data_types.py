@@ -1,4 +1,4 @@
-from typing import TypedDict, Literal, List, Tuple
+from typing import TypedDict, Literal, List, Tuple, Dict
 from datetime import datetime
 from numpy import ndarray, float64, ma, int64
 from typing import TypedDict, Union
@@ -141,6 +141,47 @@ class RawRow(TypedDict):
     data: bytes
 
 
+class RawFileIndex(TypedDict):
+    version: int
+    file_name: str
+    inode: int
+    scanned_bytes: int  # Byte offset right after the last fully decoded record
+    first_ts: Union[int, None]
+    last_ts: Union[int, None]
+    first_seq: Union[int, None]
+    last_seq: Union[int, None]
+    record_counts: Dict[str, int]  # Number of records per RawDataTypes
+    checkpoint_ts: List[int]  # ts of the record stored at checkpoint_offsets[i]
+    checkpoint_offsets: List[int]  # Byte offset of the first record of every checkpoint interval
+
+
+
+class ArchiveChunk(TypedDict):
+    file_name: str  # Name of the .npz chunk in the night folder
+    source_file_name: str  # RAW file the chunk was compacted from
+    source_inode: int
+    source_size: int
+    first_ts: int
+    last_ts: int
+    first_seq: Union[int, None]
+    last_seq: Union[int, None]
+    record_counts: Dict[str, int]  # Number of records per RawDataTypes
+
+
+class ArchiveIndex(TypedDict):
+    version: int
+    night: str  # 'YYYY-MM-DD' of the evening the night started
+    chunks: List[ArchiveChunk]  # Sorted by first_ts
+
+class IngestionCursor(TypedDict):
+    version: int
+    file_path: str
+    inode: int
+    size: int  # Size of the RAW file when it was last read
+    scanned_bytes: int  # Byte offset right after the last decoded record
+    last_seq: Union[int, None]
+
+
 class Data(TypedDict):
     bed_temps: List[BedTempData]
     cap_senses: List[CapSenseData]
@@ -189,6 +230,9 @@ class HeartPyMeasurement(TypedDict):
     s: Union[float64, float]
     sd1_sd2: Union[float64, float]  # Renamed "sd1/sd2" to a valid key
     breathingrate: Union[float64, float]
+    peaklist: ndarray  # Sample indexes of the peaks in the measured signal, see `BeatStore`
+    best_ma_perc: float  # Threshold fit_peaks selected, the hint for the next overlapping window
+    full_sweep: bool  # Whether fit_peaks had to evaluate every threshold
 
 
 class Measurement(TypedDict):
@@ -213,17 +257,24 @@ class WorkingData(TypedDict):
     ybeat: List[float64]
     rolling_mean: ndarray
     RR_list: ndarray
-    RR_indices: List[Tuple[int64, int64]]
-    RR_diff: ma.MaskedArray
-    RR_sqdiff: ma.MaskedArray
+    RR_diff: ndarray
+    RR_sqdiff: ndarray
     rrsd: float64
     best_ma_perc: int
+    full_sweep: bool
     removed_beats: ndarray
     removed_beats_y: ndarray
     binary_peaklist: ndarray
-    RR_masklist: List[int]
+    RR_masklist: ndarray
     RR_list_cor: ndarray
     RR_masked: ma.MaskedArray
     nn20: ma.MaskedArray
     nn50: ma.MaskedArray
     poincare: PoincareData
+
+
+# Returned by process(measures_only=True) instead of the diagnostic WorkingData
+class WorkingDataSummary(TypedDict):
+    peaklist: ndarray
+    best_ma_perc: int
+    full_sweep: bool
@@ -14,10 +14,25 @@ logger = get_logger()
 
 DB_FILE_PATH = f'{logger.folder_path}free-sleep.db'
 
+VITALS_UPSERT_SQL = """
+INSERT INTO vitals (side, timestamp, heart_rate, hrv, breathing_rate)
+VALUES (:side, :timestamp, :heart_rate, :hrv, :breathing_rate)
+ON CONFLICT(side, timestamp) DO NOTHING;
+"""
+
+
+def get_connection(busy_timeout_ms=5000, check_same_thread=False) -> sqlite3.Connection:
+    """
+    Opens an autocommit connection in WAL mode, transactions are started explicitly
+    """
+    connection = sqlite3.connect(DB_FILE_PATH, isolation_level=None, check_same_thread=check_same_thread)
+    connection.execute("PRAGMA journal_mode=WAL;")  # Enable WAL mode
+    connection.execute(f"PRAGMA busy_timeout={busy_timeout_ms};")  # Wait up to busy_timeout_ms if locked
+    return connection
+
+
 # Create a persistent connection
-conn = sqlite3.connect(DB_FILE_PATH, isolation_level=None, check_same_thread=False)
-conn.execute("PRAGMA journal_mode=WAL;")  # Enable WAL mode
-conn.execute("PRAGMA busy_timeout=5000;")  # Wait up to 5 seconds if locked
+conn = get_connection()
 cursor = conn.cursor()
 atexit.register(lambda: conn.close())
 
@@ -54,11 +69,18 @@ def insert_vitals(data: dict):
     """
     Inserts a record into the 'vitals' table. If a conflict occurs, it skips the insertion.
     """
-    sql = """
-    INSERT INTO vitals (side, timestamp, heart_rate, hrv, breathing_rate)
-    VALUES (:side, :timestamp, :heart_rate, :hrv, :breathing_rate)
-    ON CONFLICT(side, timestamp) DO NOTHING;
-    """
+    _prepare_vitals(data)
+    logger.debug('Inserting vitals record...')
+    try:
+        cursor.execute(VITALS_UPSERT_SQL, data)
+        conn.commit()
+    except sqlite3.Error as e:
+        error_message = traceback.format_exc()
+        logger.error(e)
+        logger.error(error_message)
+
+
+def _prepare_vitals(data: dict) -> dict:
     if np.isnan(data['hrv']):
         data['hrv'] = 0
     else:
@@ -70,14 +92,24 @@ def insert_vitals(data: dict):
         data['breathing_rate'] = math.floor(data['breathing_rate'])
 
     data['heart_rate'] = math.floor(data['heart_rate'])
-    logger.debug('Inserting vitals record...')
+    return data
+
+
+def insert_vitals_batch(records: List[dict], connection: sqlite3.Connection):
+    """
+    Inserts the records into the 'vitals' table in a single transaction, skipping conflicts.
+    Errors, like `sqlite3.OperationalError` when the database stays locked past the busy timeout, are raised
+    after rolling back so the caller can retry the batch.
+    """
+    rows = [_prepare_vitals(dict(record)) for record in records]
+    connection.execute('BEGIN IMMEDIATE;')
     try:
-        cursor.execute(sql, data)
-        conn.commit()
-    except sqlite3.Error as e:
-        error_message = traceback.format_exc()
-        logger.error(e)
-        logger.error(error_message)
+        connection.executemany(VITALS_UPSERT_SQL, rows)
+        connection.execute('COMMIT;')
+    except sqlite3.Error:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK;')
+        raise
 
 
 def insert_sleep_records(sleep_records: List[SleepRecord]):
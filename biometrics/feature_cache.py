@@ -0,0 +1,337 @@
+"""
+This module persists the per-second features used by sleep detection & calibration for every `.RAW`
+file, along with an ingestion cursor, so repeated jobs only decode the bytes appended since the last run.
+
+Sleep detection & calibration only need, per second:
+- piezo-dual: the mean of the sensor 1 samples of each side (`left1_avg`, `right1_avg`)
+- capSense: the `out`, `cen` & `in` values of each side
+
+Both sides are cached, so the left & right jobs share the same cache.
+
+Key functionalities:
+- Stores one `.npz` file per RAW file in `{logger.folder_path}feature_cache/` holding the feature
+  columns & an `IngestionCursor` (path, inode, size, last byte offset & last `seq`).
+- Resumes decoding from the cursor when a RAW file grew, the trailing record still being written is
+  left for the next run.
+- Rebuilds the cache when a RAW file was replaced (new inode) or truncated.
+- Files needing an update can be decoded in a process pool.
+- Compacted RAW files are read from their archive chunk, which already stores the columns, instead of being cached.
+
+Usage:
+- Use `load_feature_frames(folder_path, start_time, end_time, side)` to get a `PiezoFeatureFrame` & a `CapFrame`,
+  accepted by `load_piezo_df` & `load_cap_df`.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Optional
+import json
+import os
+import traceback
+import cbor2
+import numpy as np
+
+from data_types import *
+from get_logger import get_logger
+from cap_frame import CapFrame
+from piezo_frame import PiezoFeatureFrame
+from load_raw_files import get_mp_context, get_seek_ranges, get_current_files
+from raw_archive import OTHER_PREFIX, ArchiveChunkReader, is_archive_chunk
+from raw_cbor import CBORPeekError, encode_keys, peek_type_ts, read_fields
+from raw_index import get_folder_hash
+from raw_reader import RawFileReader
+
+logger = get_logger()
+
+FEATURE_CACHE_FOLDER_PATH = f'{logger.folder_path}feature_cache/'
+FEATURE_CACHE_VERSION = 1
+
+PIEZO_FEATURE_KEYS = encode_keys(['left1', 'right1', 'seq'])
+PIEZO_COLUMNS = ['left1_avg', 'right1_avg']
+CAP_COLUMNS = ['left_out', 'left_cen', 'left_in', 'right_out', 'right_cen', 'right_in']
+
+# Column name -> array, piezo_epochs/piezo_seq & cap_epochs/cap_seq index the feature columns
+FileFeatures = Dict[str, np.ndarray]
+
+
+class FeatureFrames(TypedDict):
+    piezo: PiezoFeatureFrame
+    cap: CapFrame
+
+
+def _get_cache_file_path(file_path: str) -> str:
+    # RAW file names are only unique per folder, prefix them with a hash of the folder
+    folder_hash = get_folder_hash(os.path.dirname(file_path))
+    return f'{FEATURE_CACHE_FOLDER_PATH}{folder_hash}_{os.path.basename(file_path)}.npz'
+
+
+def _empty_features() -> FileFeatures:
+    features = {
+        'piezo_epochs': np.empty(0, dtype=np.int64),
+        'piezo_seq': np.empty(0, dtype=np.int64),
+        'cap_epochs': np.empty(0, dtype=np.int64),
+        'cap_seq': np.empty(0, dtype=np.int64),
+    }
+    for column in PIEZO_COLUMNS + CAP_COLUMNS:
+        features[column] = np.empty(0, dtype=np.float64)
+    return features
+
+
+def _empty_cursor(file_path: str, inode: int) -> IngestionCursor:
+    return {
+        'version': FEATURE_CACHE_VERSION,
+        'file_path': file_path,
+        'inode': inode,
+        'size': 0,
+        'scanned_bytes': 0,
+        'last_seq': None,
+    }
+
+
+def _read_cache(cache_file_path: str) -> Tuple[Optional[IngestionCursor], Optional[FileFeatures]]:
+    if not os.path.isfile(cache_file_path):
+        return None, None
+    try:
+        with np.load(cache_file_path) as npz_file:
+            cursor: IngestionCursor = json.loads(str(npz_file['cursor']))
+            if cursor.get('version') != FEATURE_CACHE_VERSION:
+                return None, None
+            features = {name: npz_file[name] for name in _empty_features().keys()}
+        return cursor, features
+    except (OSError, ValueError, KeyError) as error:
+        logger.warning(f'Could not read feature cache {cache_file_path}, rebuilding... | {error}')
+        return None, None
+
+
+def _save_cache(cache_file_path: str, cursor: IngestionCursor, features: FileFeatures):
+    try:
+        os.makedirs(FEATURE_CACHE_FOLDER_PATH, exist_ok=True)
+        # The cursor & the features are written in the same file, a job never sees one without the other
+        tmp_file_path = f'{cache_file_path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_file_path, cursor=np.array(json.dumps(cursor)), **features)
+        os.replace(tmp_file_path, cache_file_path)
+    except OSError as error:
+        logger.warning(f'Could not save feature cache {cache_file_path} | {error}')
+
+
+def _channel_avg(samples) -> float:
+    if samples is None or len(samples) == 0:
+        return np.nan
+    return float(np.mean(samples))
+
+
+def _read_piezo_channels(data: memoryview) -> dict:
+    try:
+        # Views into the mapping, they're averaged right away
+        return read_fields(data, PIEZO_FEATURE_KEYS, copy=False)
+    except CBORPeekError:
+        decoded_data = cbor2.loads(data)
+        return {
+            name: np.frombuffer(decoded_data[name], dtype=np.int32)
+            for name in ['left1', 'right1'] if name in decoded_data
+        }
+
+
+def _read_feature_row(data: bytes, seq: Optional[int]) -> Optional[dict]:
+    """
+    Computes the feature columns of a piezo-dual or capSense record, returns None for other records
+    """
+    try:
+        record_type, ts = peek_type_ts(data)
+    except CBORPeekError:
+        decoded_data = cbor2.loads(data)
+        record_type, ts = decoded_data.get('type'), decoded_data.get('ts')
+
+    if ts is None or record_type not in ('piezo-dual', 'capSense'):
+        return None
+    # Every column of a row is computed before appending so a bad record can't misalign them
+    if record_type == 'piezo-dual':
+        piezo_record = _read_piezo_channels(data)
+        return {
+            'piezo_epochs': ts,
+            'piezo_seq': piezo_record.get('seq', seq),
+            'left1_avg': _channel_avg(piezo_record.get('left1')),
+            'right1_avg': _channel_avg(piezo_record.get('right1')),
+        }
+    cap_record = cbor2.loads(data)
+    row = {'cap_epochs': ts, 'cap_seq': cap_record.get('seq', seq)}
+    for column in CAP_COLUMNS:
+        side, sensor = column.split('_')
+        row[column] = cap_record[side][sensor] if side in cap_record else np.nan
+    return row
+
+
+def _to_features(columns: Dict[str, list]) -> FileFeatures:
+    return {
+        name: np.array(values, dtype=np.float64 if name in PIEZO_COLUMNS or name in CAP_COLUMNS else np.int64)
+        for name, values in columns.items()
+    }
+
+
+def _decode_features(file_path: str, cursor: IngestionCursor) -> FileFeatures:
+    """
+    Decodes the features of the records appended after `scanned_bytes` and moves the cursor forward
+    """
+    columns: Dict[str, list] = {name: [] for name in _empty_features().keys()}
+
+    with RawFileReader(file_path) as reader:
+        cursor['size'] = reader.size
+        # Stops before a trailing record that is still being written
+        for offset, next_offset, seq, data in reader.iter_records(cursor['scanned_bytes']):
+            cursor['scanned_bytes'] = next_offset
+            if seq is not None:
+                cursor['last_seq'] = seq
+            try:
+                row = _read_feature_row(data, seq)
+            except Exception as error:
+                logger.error(f'Error decoding {file_path} @ byte {offset:,} | {error}')
+                continue
+            if row is not None:
+                for name, value in row.items():
+                    columns[name].append(value)
+
+    return _to_features(columns)
+
+
+def load_archive_features(chunk_path: str) -> FileFeatures:
+    """
+    Computes the features of an archive chunk, the columns are already split out so nothing is cached
+    """
+    features = _empty_features()
+    with ArchiveChunkReader(chunk_path) as reader:
+        if reader.has('piezo'):
+            features['piezo_epochs'] = reader.epochs('piezo')
+            features['piezo_seq'] = reader.seq('piezo')
+            for column in PIEZO_COLUMNS:
+                channel_name = column[:-len('_avg')]
+                if reader.is_channel('piezo', channel_name):
+                    features[column] = reader.channel('piezo', channel_name).mean(axis=1)
+                else:
+                    features[column] = np.full(len(features['piezo_epochs']), np.nan)
+        if reader.has('cap'):
+            features['cap_epochs'] = reader.epochs('cap')
+            features['cap_seq'] = reader.seq('cap')
+            for column in CAP_COLUMNS:
+                side, sensor = column.split('_')
+                if reader.has('cap', f'{side}.{sensor}'):
+                    features[column] = reader.column('cap', f'{side}.{sensor}').astype(np.float64)
+                else:
+                    features[column] = np.full(len(features['cap_epochs']), np.nan)
+
+        # Records kept as raw CBOR
+        if reader.has(OTHER_PREFIX):
+            columns: Dict[str, list] = {name: [] for name in features.keys()}
+            for payload in reader.other_payloads(np.arange(len(reader.epochs(OTHER_PREFIX)))):
+                try:
+                    row = _read_feature_row(payload, None)
+                except Exception as error:
+                    logger.error(f'Error decoding a record of {chunk_path} | {error}')
+                    continue
+                if row is not None:
+                    for name, value in row.items():
+                        columns[name].append(value)
+            other_features = _to_features(columns)
+            features = {name: np.concatenate([values, other_features[name]]) for name, values in features.items()}
+    return features
+
+
+def update_feature_cache(file_path: str) -> FileFeatures:
+    """
+    Loads the cached features of a RAW file, only decoding the bytes appended since the last update
+    """
+    stat = os.stat(file_path)
+    cache_file_path = _get_cache_file_path(file_path)
+    cursor, features = _read_cache(cache_file_path)
+
+    if cursor is None or cursor['inode'] != stat.st_ino or stat.st_size < cursor['scanned_bytes']:
+        cursor, features = _empty_cursor(file_path, stat.st_ino), _empty_features()
+    elif stat.st_size == cursor['size']:
+        return features
+
+    scanned_bytes = cursor['scanned_bytes']
+    try:
+        new_features = _decode_features(file_path, cursor)
+    except OSError:
+        logger.error(traceback.format_exc())
+        return features
+    if cursor['scanned_bytes'] != scanned_bytes:
+        features = {name: np.concatenate([values, new_features[name]]) for name, values in features.items()}
+        logger.debug(f'Decoded {cursor["scanned_bytes"] - scanned_bytes:,} new bytes of {file_path}')
+    _save_cache(cache_file_path, cursor, features)
+    return features
+
+
+def _load_file_features(file_path: str) -> FileFeatures:
+    if is_archive_chunk(file_path):
+        return load_archive_features(file_path)
+    return update_feature_cache(file_path)
+
+
+def _select_side(features: FileFeatures, side: Side, start_epoch: float, end_epoch: float) -> FeatureFrames:
+    piezo_column = f'{side}1_avg'
+    piezo_epochs = features['piezo_epochs']
+    piezo_mask = (piezo_epochs >= start_epoch) & (piezo_epochs <= end_epoch) & ~np.isnan(features[piezo_column])
+
+    cap_columns = [f'{side}_out', f'{side}_cen', f'{side}_in']
+    cap_epochs = features['cap_epochs']
+    cap_mask = (cap_epochs >= start_epoch) & (cap_epochs <= end_epoch) & ~np.isnan(features[cap_columns[0]])
+    return {
+        'piezo': PiezoFeatureFrame(
+            piezo_epochs[piezo_mask],
+            features['piezo_seq'][piezo_mask],
+            {piezo_column: features[piezo_column][piezo_mask]},
+        ),
+        'cap': CapFrame(
+            cap_epochs[cap_mask],
+            features['cap_seq'][cap_mask],
+            {column: features[column][cap_mask].astype(np.int32) for column in cap_columns},
+        ),
+    }
+
+
+def load_feature_frames(folder_path: str, start_time: datetime, end_time: datetime, side: Side, workers=1) -> FeatureFrames:
+    """
+    Loads the per-second piezo & capSense features of a side between start_time & end_time.
+
+    RAW files are decoded only past their ingestion cursor, so rerunning overlapping time ranges costs
+    about as much as the data appended since the previous run. With workers > 1 the files which
+    need decoding are processed in parallel.
+    """
+    logger.debug(f'Loading cached features from {folder_path} | {start_time.isoformat()} -> {end_time.isoformat()} | workers: {workers}')
+    start_epoch = start_time.timestamp()
+    end_epoch = end_time.timestamp()
+    file_paths = [file_path for file_path, _, _, _ in get_seek_ranges(folder_path, start_epoch, end_epoch)]
+    prune_feature_caches(folder_path, get_current_files(folder_path))
+
+    if workers > 1 and len(file_paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(file_paths)), mp_context=get_mp_context()) as executor:
+            file_features = list(executor.map(_load_file_features, file_paths))
+    else:
+        file_features = [_load_file_features(file_path) for file_path in file_paths]
+
+    side_frames = [_select_side(features, side, start_epoch, end_epoch) for features in file_features]
+    del file_features
+    feature_frames: FeatureFrames = {
+        'piezo': PiezoFeatureFrame.concat([frames['piezo'] for frames in side_frames]),
+        'cap': CapFrame.concat([frames['cap'] for frames in side_frames]),
+    }
+    logger.debug(f'Loaded {feature_frames["piezo"]} & {feature_frames["cap"]}')
+    return feature_frames
+
+
+def prune_feature_caches(folder_path: str, file_paths: List[str]):
+    """
+    Deletes the feature caches of RAW files in folder_path which no longer exist
+    """
+    if not os.path.isdir(FEATURE_CACHE_FOLDER_PATH):
+        return
+    current_cache_file_names = {os.path.basename(_get_cache_file_path(file_path)) for file_path in file_paths}
+    folder_hash = get_folder_hash(folder_path)
+    for cache_file_name in os.listdir(FEATURE_CACHE_FOLDER_PATH):
+        if '.tmp' in cache_file_name:
+            # Another job is still writing it
+            continue
+        if cache_file_name.startswith(folder_hash) and cache_file_name not in current_cache_file_names:
+            try:
+                os.remove(f'{FEATURE_CACHE_FOLDER_PATH}{cache_file_name}')
+            except OSError:
+                pass
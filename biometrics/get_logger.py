@@ -7,7 +7,7 @@ import sys
 from datetime import datetime
 import os
 
-LoggerName = Literal['sleep-analyzer', 'calibrate-sensor', 'free-sleep-stream']
+LoggerName = Literal['sleep-analyzer', 'calibrate-sensor', 'free-sleep-stream', 'raw-compactor', 'decode-benchmark', 'stream-replay']
 LOGGER_NAMES: List[LoggerName] = list(get_args(LoggerName))
 
 
@@ -21,6 +21,8 @@ from data_types import *
 
 __all__ = ['calc_rr',
            'update_rr',
+           'get_rr_outliers',
+           'get_rr_mask',
            'clean_rr_intervals',
            'calc_ts_measures',
            'calc_breathing']
@@ -35,24 +37,28 @@ def calc_rr(peaklist: List[np.int64], sample_rate: int, working_data={}) -> Work
             working_data['ybeat'] = np.delete(working_data['ybeat'], 0)
 
     rr_list = (np.diff(peaklist) / sample_rate) * 1000.0
-    rr_indices = [(peaklist[i], peaklist[i + 1]) for i in range(len(peaklist) - 1)]
     rr_diff = np.abs(np.diff(rr_list))
     rr_sqdiff = np.power(rr_diff, 2)
     working_data['RR_list'] = rr_list
-    working_data['RR_indices'] = rr_indices
     working_data['RR_diff'] = rr_diff
     working_data['RR_sqdiff'] = rr_sqdiff
     return working_data
 
 
+def _masked_rr_diff(rr_list: np.ndarray, rr_mask: np.ndarray) -> np.ndarray:
+    # Successive differences between accepted intervals only, like np.diff of the masked RR list without the masked ones
+    adjacent = (rr_mask[:-1] == 0) & (rr_mask[1:] == 0)
+    return np.abs(np.diff(rr_list))[adjacent]
+
+
 def update_rr(working_data: WorkingData):
     rr_source = working_data['RR_list']
     b_peaklist = working_data['binary_peaklist']
-    rr_list = [rr_source[i] for i in range(len(rr_source)) if b_peaklist[i] + b_peaklist[i + 1] == 2]
-    rr_mask = [0 if (b_peaklist[i] + b_peaklist[i + 1] == 2) else 1 for i in range(len(rr_source))]
-    rr_masked = np.ma.array(rr_source, mask=rr_mask)
-    rr_diff = np.abs(np.diff(rr_masked))
-    rr_diff = rr_diff[~rr_diff.mask]
+    # An interval is kept when the beats on both of its ends are
+    both_kept = (b_peaklist[:-1] + b_peaklist[1:]) == 2
+    rr_list = rr_source[both_kept]
+    rr_mask = np.where(both_kept, 0, 1)
+    rr_diff = _masked_rr_diff(rr_source, rr_mask)
     rr_sqdiff = np.power(rr_diff, 2)
 
     working_data['RR_masklist'] = rr_mask
@@ -63,32 +69,54 @@ def update_rr(working_data: WorkingData):
 
 
 
+def get_rr_outliers(rr_list: np.ndarray) -> np.ndarray:
+    # Intervals outside the mean +- max(300ms, 30%), check_peaks removes the beat after each
+    mean_rr = np.mean(rr_list)
+    thirty_perc = 0.3 * mean_rr
+    if thirty_perc <= 300:
+        upper_threshold = mean_rr + 300
+        lower_threshold = mean_rr - 300
+    else:
+        upper_threshold = mean_rr + thirty_perc
+        lower_threshold = mean_rr - thirty_perc
+    return (rr_list <= lower_threshold) | (rr_list >= upper_threshold)
+
+
+def get_rr_mask(rr_list: np.ndarray) -> np.ndarray:
+    '''
+    Returns the mask of rejected intervals check_peaks, update_rr & clean_rr_intervals end up with,
+    without the working_data arrays they build on the way
+    '''
+    outliers = get_rr_outliers(rr_list)
+    # update_rr rejects both intervals around a beat check_peaks removed
+    rr_mask = outliers.astype(np.int64)
+    rr_mask[1:] |= outliers[:-1]
+    return quotient_filter(rr_list, rr_mask)
+
+
 def clean_rr_intervals(working_data):
-    rr_mask = quotient_filter(working_data['RR_list'], working_data['RR_masklist'])
-    rr_cleaned = [x for x, y in zip(working_data['RR_list'], rr_mask) if y == 0]
+    rr_list = working_data['RR_list']
+    rr_mask = quotient_filter(rr_list, working_data['RR_masklist'])
 
-    rr_masked = np.ma.array(working_data['RR_list'], mask=rr_mask)
-    rr_diff = np.abs(np.diff(rr_masked))
-    rr_diff = rr_diff[~rr_diff.mask]
+    rr_masked = np.ma.array(rr_list, mask=rr_mask)
+    rr_diff = _masked_rr_diff(rr_list, rr_mask)
     rr_sqdiff = np.power(rr_diff, 2)
     working_data['RR_masked'] = rr_masked
-    working_data['RR_list_cor'] = np.asarray(rr_cleaned)
+    working_data['RR_list_cor'] = rr_list[rr_mask == 0]
     working_data['RR_diff'] = rr_diff
     working_data['RR_sqdiff'] = rr_sqdiff
 
     try:
-        removed_beats = [x for x in working_data['removed_beats']]
-        removed_beats_y = [x for x in working_data['removed_beats_y']]
-        peaklist = working_data['peaklist']
-        ybeat = working_data['ybeat']
-
-        for i in range(len(rr_mask)):
-            if rr_mask[i] == 1 and peaklist[i] not in removed_beats:
-                removed_beats.append(peaklist[i])
-                removed_beats_y.append(ybeat[i])
-
-        working_data['removed_beats'] = np.asarray(removed_beats)
-        working_data['removed_beats_y'] = np.asarray(removed_beats_y)
+        removed_beats = np.asarray(working_data['removed_beats'])
+        removed_beats_y = np.asarray(working_data['removed_beats_y'])
+        peaklist = np.asarray(working_data['peaklist'])
+        ybeat = np.asarray(working_data['ybeat'])
+
+        # The first beat of every rejected interval is removed too, unless it already was
+        newly_removed = np.flatnonzero((rr_mask == 1) & ~np.isin(peaklist[:len(rr_mask)], removed_beats))
+
+        working_data['removed_beats'] = np.concatenate((removed_beats, peaklist[newly_removed]))
+        working_data['removed_beats_y'] = np.concatenate((removed_beats_y, ybeat[newly_removed]))
     except:
         pass
 
@@ -293,23 +293,24 @@ def quotient_filter(RR_list, RR_list_mask=[], iterations=2):
 
     '''
 
+    RR_list = np.asarray(RR_list)
     if len(RR_list_mask) == 0:
         RR_list_mask = np.zeros((len(RR_list)))
     else:
         assert len(RR_list) == len(RR_list_mask), \
             'error: RR_list and RR_list_mask should be same length if RR_list_mask is specified'
+        RR_list_mask = np.asarray(RR_list_mask)
 
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = RR_list[:-1] / RR_list[1:]
+    # NaN ratios fail the range check like they did in the per pair loop
+    out_of_range = ~((0.8 <= ratio) & (ratio <= 1.2))
     for iteration in range(iterations):
-        for i in range(len(RR_list) - 1):
-            if RR_list_mask[i] + RR_list_mask[i + 1] != 0:
-                pass  # skip if one of both intervals is already rejected
-            elif 0.8 <= RR_list[i] / RR_list[i + 1] <= 1.2:
-                pass  # if R-R pair seems ok, do noting
-            else:  # update mask
-                RR_list_mask[i] = 1
-                # RR_list_mask[i + 1] = 1
-
-    return np.asarray(RR_list_mask)
+        # A pass only sets the first interval of a pair, it can't change a later pair's decision within the pass
+        both_accepted = (RR_list_mask[:-1] == 0) & (RR_list_mask[1:] == 0)
+        RR_list_mask[:-1][both_accepted & out_of_range] = 1
+
+    return RR_list_mask
 
 
 def smooth_signal(data, sample_rate, window_length=None, polyorder=3):
@@ -12,12 +12,12 @@ main module for HeartPy.
 '''
 
 import numpy as np
-from typing import Tuple
-from data_types import HeartPyMeasurement, WorkingData
+from typing import Optional, Tuple, Union
+from data_types import HeartPyMeasurement, WorkingData, WorkingDataSummary
 from heart.datautils import rolling_mean
 
-from heart.peakdetection import check_peaks, fit_peaks
-from heart.analysis import clean_rr_intervals, calc_ts_measures, calc_breathing, calc_rr
+from heart.peakdetection import check_peaks, find_best_fit, fit_peaks
+from heart.analysis import clean_rr_intervals, calc_ts_measures, calc_breathing, calc_rr, get_rr_mask
 import traceback
 
 
@@ -30,7 +30,16 @@ def process(
         bpmmax: int = 180,
         breathing_method='welch',
         calculate_breathing=True,
-) -> Tuple[dict, HeartPyMeasurement]:
+        ma_perc_hint: Optional[float] = None,
+        rolling_mean_out: Optional[np.ndarray] = None,
+        measures_only=False,
+) -> Tuple[Union[WorkingData, WorkingDataSummary], HeartPyMeasurement]:
+    '''
+    With measures_only only bpm, sdnn & breathingrate (with calculate_breathing) are computed, from the best peaks &
+    RR intervals alone, and they match the ones of the full path. The intermediate arrays WorkingData keeps for
+    debugging & plotting (RR_diff, RR_sqdiff, the breathing signal...) are skipped, a WorkingDataSummary is returned
+    in their place.
+    '''
     measures: HeartPyMeasurement = {}
     working_data: WorkingData = {}
 
@@ -45,9 +54,13 @@ def process(
     rol_mean = rolling_mean(
         hrdata,
         windowsize,
-        sample_rate
+        sample_rate,
+        out=rolling_mean_out,
     )
 
+    if measures_only:
+        return _process_measures(hrdata, rol_mean, sample_rate, bpmmin, bpmmax, breathing_method, calculate_breathing, ma_perc_hint)
+
     fit_peaks(
         hrdata,
         rol_mean,
@@ -55,6 +68,7 @@ def process(
         working_data,
         bpmmin=bpmmin,
         bpmmax=bpmmax,
+        ma_perc_hint=ma_perc_hint,
     )
     try:
         if type(working_data["peaklist"]) == list:
@@ -92,3 +106,44 @@ def process(
         except:
             measures['breathingrate'] = np.nan
     return working_data, measures
+
+
+def _process_measures(
+        hrdata: np.ndarray,
+        rol_mean: np.ndarray,
+        sample_rate: int,
+        bpmmin: int,
+        bpmmax: int,
+        breathing_method: str,
+        calculate_breathing: bool,
+        ma_perc_hint: Optional[float],
+) -> Tuple[WorkingDataSummary, HeartPyMeasurement]:
+    measures: HeartPyMeasurement = {}
+    best_fit, full_sweep = find_best_fit(hrdata, rol_mean, sample_rate, bpmmin, bpmmax, ma_perc_hint)
+
+    # fit_peaks & process both run calc_rr, each drops a first peak within 150ms
+    peaklist = best_fit['peaklist']
+    for _ in range(2):
+        if len(peaklist) > 0 and peaklist[0] <= ((sample_rate / 1000.0) * 150):
+            peaklist = peaklist[1:]
+
+    rr_list = (np.diff(peaklist) / sample_rate) * 1000.0
+    rr_list_cor = rr_list[get_rr_mask(rr_list) == 0]
+
+    # Same measures as calc_ts_measures
+    measures['bpm'] = 60000 / np.mean(rr_list_cor)
+    measures['sdnn'] = np.std(rr_list_cor)
+
+    if calculate_breathing:
+        try:
+            # The breathing signal & spectrum are left in a throwaway dict
+            measures, _ = calc_breathing(rr_list_cor, measures, {}, method=breathing_method)
+        except:
+            measures['breathingrate'] = np.nan
+
+    summary: WorkingDataSummary = {
+        'peaklist': peaklist,
+        'best_ma_perc': best_fit['ma_perc'],
+        'full_sweep': full_sweep,
+    }
+    return summary, measures
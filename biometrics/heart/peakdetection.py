@@ -10,16 +10,18 @@
 
 functions for peak detection and related tasks
 '''
-from typing import List, Dict, Union, Tuple
+from typing import List, Dict, Optional, Union, Tuple, TypedDict
 import numpy as np
 from heart.analysis import calc_rr
-from heart.analysis import update_rr
+from heart.analysis import get_rr_outliers, update_rr
 from heart.exceptions import BadSignalWarning
 from data_types import *
 
 __all__ = ['make_windows',
            'append_dict',
            'detect_peaks',
+           'detect_peaks_multi',
+           'find_best_fit',
            'fit_peaks',
            'check_peaks',
            ]
@@ -181,14 +183,92 @@ def detect_peaks(
 
 
 
-def fit_peaks(
+class PeakFit(TypedDict):
+    ma_perc: float
+    peaklist: np.ndarray  # Before calc_rr drops a peak within the first 150ms
+    bpm: float
+    rrsd: float
+
+
+def detect_peaks_multi(
+        hrdata: np.ndarray,
+        rol_mean: np.ndarray,
+        ma_percs: List[float],
+        sample_rate: int,
+) -> List[PeakFit]:
+    """
+    Runs `detect_peaks` for every ma_perc in one pass & returns the peaks, BPM and RR standard deviation of each.
+
+    The thresholds are broadcast to a (len(ma_percs), len(hrdata)) mask, the segments above the threshold of all rows
+    are reduced with one `np.maximum.reduceat` & the first sample reaching each segment's maximum is its peak.
+    """
+    mean = np.mean(rol_mean / 100)
+    offsets = np.array([mean * ma_perc for ma_perc in ma_percs])
+    above = hrdata[np.newaxis, :] > (rol_mean[np.newaxis, :] + offsets[:, np.newaxis])
+
+    # flatnonzero & divmod are several times faster than a 2D np.nonzero
+    rows, peaks_x = np.divmod(np.flatnonzero(above), len(hrdata))
+    fits: List[PeakFit] = []
+    if len(peaks_x) == 0:
+        return [{'ma_perc': ma_perc, 'peaklist': np.array([], dtype=np.int64), 'bpm': 0.0, 'rrsd': np.inf} for ma_perc in ma_percs]
+
+    # Same segments as `detect_peaks`: every row starts one & each gap in peaks_x starts the next one at the last
+    # sample before the gap. A start shared by both is one of the empty segments detect_peaks skips.
+    row_starts = np.searchsorted(rows, np.arange(len(ma_percs)))
+    gaps = np.flatnonzero((np.diff(peaks_x) > 1) & (np.diff(rows) == 0))
+    is_start = np.zeros(len(peaks_x), dtype=bool)
+    is_start[row_starts[row_starts < len(peaks_x)]] = True
+    is_start[gaps] = True
+    starts = np.flatnonzero(is_start)
+    peaks_y = hrdata[peaks_x]
+    segment_max = np.maximum.reduceat(peaks_y, starts)
+    segment_ids = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(peaks_x))))
+    at_max = np.flatnonzero(peaks_y == segment_max[segment_ids])
+    # First sample reaching the maximum of each segment, like list.index(max(...))
+    at_max_ids = segment_ids[at_max]
+    first = np.concatenate(([True], at_max_ids[1:] != at_max_ids[:-1]))
+    peak_positions = at_max[first]
+    peak_rows = rows[peak_positions]
+    peaks = peaks_x[peak_positions]
+
+    row_bounds = np.searchsorted(peak_rows, np.arange(len(ma_percs) + 1))
+    for row, ma_perc in enumerate(ma_percs):
+        peaklist = peaks[row_bounds[row]:row_bounds[row + 1]]
+        # calc_rr drops a first peak within 150ms, the signal might start mid-beat
+        rr_peaks = peaklist[1:] if len(peaklist) > 0 and peaklist[0] <= ((sample_rate / 1000.0) * 150) else peaklist
+        rr_list = (np.diff(rr_peaks) / sample_rate) * 1000.0
+        fits.append({
+            'ma_perc': ma_perc,
+            'peaklist': peaklist,
+            'bpm': (len(rr_peaks) / (len(hrdata) / sample_rate)) * 60,
+            'rrsd': np.std(rr_list) if len(rr_list) > 0 else np.inf,
+        })
+    return fits
+
+
+def _select_best_fit(fits: List[PeakFit], bpmmin: int, bpmmax: int) -> Optional[PeakFit]:
+    # Find valid MA percentages based on RR standard deviation and BPM range
+    valid_fits = [fit for fit in fits if fit['rrsd'] > 0.1 and bpmmin <= fit['bpm'] <= bpmmax]
+    if not valid_fits:
+        return None
+    # Select the best moving average percentage based on lowest RRSD
+    return min(valid_fits, key=lambda fit: fit['rrsd'])
+
+
+def find_best_fit(
         hrdata: np.ndarray,
         rol_mean: np.ndarray,
         sample_rate: int,
-        working_data: WorkingData,
         bpmmin: int = 40,
         bpmmax: int = 180,
-):
+        ma_perc_hint: Optional[float] = None,
+) -> Tuple[PeakFit, bool]:
+    """
+    Returns the fit of the best threshold & whether every threshold was evaluated, raises BadSignalWarning without one.
+
+    With ma_perc_hint, the best_ma_perc of the previous overlapping window, only it & its neighbours are evaluated.
+    That result is kept if its best fit is valid & has no untested neighbour, otherwise all thresholds are swept.
+    """
     ma_perc_list = [
         # 5,
         # 10,
@@ -210,45 +290,60 @@ def fit_peaks(
         # 300
     ]
 
-    # Store results: (RR standard deviation, detected BPM, ma_perc)
-    rrsd = []
-
-    for ma_perc in ma_perc_list:
-        detect_peaks(hrdata, rol_mean, ma_perc, sample_rate, working_data)
-        bpm = ((len(working_data["peaklist"]) / (len(hrdata) / sample_rate)) * 60)
-        rrsd.append((working_data["rrsd"], bpm, ma_perc))
-
-    # Find valid MA percentages based on RR standard deviation and BPM range
-    valid_ma = [(rrsd, ma_perc) for rrsd, bpm, ma_perc in rrsd if rrsd > 0.1 and bpmmin <= bpm <= bpmmax]
-
-    if valid_ma:
-        # Select the best moving average percentage based on lowest RRSD
-        best_ma_perc = min(valid_ma, key=lambda x: x[0])[1]
-        working_data["best_ma_perc"] = best_ma_perc
-
-        # Re-run peak detection with the best MA percentage
-        detect_peaks(hrdata, rol_mean, best_ma_perc, sample_rate, working_data)
-    else:
+    best_fit = None
+    if ma_perc_hint in ma_perc_list:
+        hint_index = ma_perc_list.index(ma_perc_hint)
+        neighbours = ma_perc_list[max(hint_index - 1, 0):hint_index + 2]
+        best_fit = _select_best_fit(detect_peaks_multi(hrdata, rol_mean, neighbours, sample_rate), bpmmin, bpmmax)
+        # A best fit at the edge of the neighbours might be beaten by the next, untested threshold
+        if best_fit is not None:
+            best_index = ma_perc_list.index(best_fit['ma_perc'])
+            if (best_fit['ma_perc'] == neighbours[0] and best_index > 0) or (best_fit['ma_perc'] == neighbours[-1] and best_index < len(ma_perc_list) - 1):
+                best_fit = None
+    full_sweep = best_fit is None
+
+    if best_fit is None:
+        # All thresholds are evaluated in one pass, see `detect_peaks_multi`
+        best_fit = _select_best_fit(detect_peaks_multi(hrdata, rol_mean, ma_perc_list, sample_rate), bpmmin, bpmmax)
+
+    if best_fit is None:
         # Raise warning if no valid peak detection can be determined
         raise BadSignalWarning("Could not determine best fit, bad signal")
+    return best_fit, full_sweep
 
 
-def check_peaks(working_data: WorkingData):
-    mean_rr = np.mean(working_data['RR_list'])
-    thirty_perc = 0.3 * mean_rr
-    if thirty_perc <= 300:
-        upper_threshold = mean_rr + 300
-        lower_threshold = mean_rr - 300
-    else:
-        upper_threshold = mean_rr + thirty_perc
-        lower_threshold = mean_rr - thirty_perc
+def fit_peaks(
+        hrdata: np.ndarray,
+        rol_mean: np.ndarray,
+        sample_rate: int,
+        working_data: WorkingData,
+        bpmmin: int = 40,
+        bpmmax: int = 180,
+        ma_perc_hint: Optional[float] = None,
+):
+    """
+    Fills working_data with the peaks of the best threshold, see `find_best_fit`.
+    working_data['full_sweep'] tells which search was used.
+    """
+    best_fit, working_data['full_sweep'] = find_best_fit(hrdata, rol_mean, sample_rate, bpmmin, bpmmax, ma_perc_hint)
+    working_data["best_ma_perc"] = best_fit['ma_perc']
+
+    # Fill working_data like re-running detect_peaks with the best MA percentage would
+    peaklist = best_fit['peaklist']
+    working_data["peaklist"] = peaklist
+    working_data["ybeat"] = hrdata[peaklist]
+    working_data["rolling_mean"] = rol_mean + np.mean(rol_mean / 100) * best_fit['ma_perc']
+    if len(peaklist) > 0:
+        calc_rr(peaklist, sample_rate, working_data=working_data)
+    working_data['rrsd'] = best_fit['rrsd']
+
 
+def check_peaks(working_data: WorkingData):
     # identify peaks to exclude based on RR interval
-    rem_idx = np.where((working_data['RR_list'] <= lower_threshold) | (working_data['RR_list'] >= upper_threshold))[0] + 1
+    rem_idx = np.where(get_rr_outliers(working_data['RR_list']))[0] + 1
 
     working_data['removed_beats'] = np.array(working_data['peaklist'])[rem_idx]
     working_data['removed_beats_y'] = np.array(working_data['ybeat'])[rem_idx]
-    working_data['binary_peaklist'] = np.asarray([0 if x in working_data['removed_beats']
-                                                  else 1 for x in working_data['peaklist']])
+    working_data['binary_peaklist'] = np.where(np.isin(working_data['peaklist'], working_data['removed_beats']), 0, 1)
 
     update_rr(working_data)
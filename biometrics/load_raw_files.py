@@ -1,8 +1,12 @@
 import numpy as np
 import traceback
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 import cbor2
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Tuple
+import multiprocessing
 import gc
 import sys
 import os
@@ -11,6 +15,12 @@ import os
 sys.path.append(os.getcwd())
 from data_types import *
 from get_logger import get_logger
+from raw_index import get_seek_range, get_raw_file_index, prune_raw_indexes
+from piezo_frame import PiezoFrame, PiezoFrameBuilder
+from cap_frame import CapFrame, CapFrameBuilder
+from raw_archive import DecodeRecord, get_archive_chunks, get_archive_record_count, is_archive_chunk, is_same_source, iter_archive_records, load_archive_frames
+from raw_cbor import CBORPeekError, EncodedKeys, get_piezo_keys, peek_type_ts, read_fields
+from raw_reader import RawFileReader
 
 logger = get_logger()
 
@@ -51,7 +61,7 @@ def _delete_other_side(decoded_data: dict, side: Side, sensor_count: int):
 
         if decoded_data['type'] == 'capSense':
             del decoded_data[del_side]
-        else:
+        elif decoded_data['type'] == 'piezo-dual':
             if sensor_count == 1:
                 # Delete sensor 2 of the current side
                 if f'{side}2' in decoded_data:
@@ -67,51 +77,80 @@ def _delete_other_side(decoded_data: dict, side: Side, sensor_count: int):
         raise error
 
 
-def _decode_cbor_file(file_path: str, data: dict, start_time, end_time, side: Side, sensor_count: int):
-    # logger.debug(f'Loading cbor data from: {file_path}')
-    load_raw_types = list(data.keys())
-    checked_timespan = False
-    with open(file_path, 'rb') as raw_data:
-        while True:
+def _decode_record(data: bytes, start_epoch: float, end_epoch: float, load_raw_types: List[RawDataTypes],
+                   side: Side, sensor_count: int, piezo_keys: EncodedKeys, copy: bool) -> Optional[dict]:
+    """
+    Peeks the type & ts of an inner record before decoding it, returns None if the record isn't wanted.
+    Piezo records only get the kept channels decoded, the other channels are never read.
+    """
+    try:
+        record_type, ts = peek_type_ts(data)
+    except CBORPeekError:
+        record_type = None
+        ts = None
+    else:
+        if record_type not in load_raw_types:
+            return None
+        if ts is None or not start_epoch <= ts <= end_epoch:
+            return None
+        if record_type == 'piezo-dual':
             try:
+                decoded_data = read_fields(data, piezo_keys, copy=copy)
+                decoded_data['type'] = record_type
+                decoded_data['ts'] = ts
+                return decoded_data
+            except CBORPeekError:
+                pass
+
+    # Layouts the peek reader doesn't handle & non piezo records, which are small
+    decoded_data = cbor2.loads(data)
+    if record_type is None:
+        if not decoded_data['type'] in load_raw_types:
+            return None
+        if not start_epoch <= decoded_data['ts'] <= end_epoch:
+            return None
+    _delete_other_side(decoded_data, side, sensor_count)
+    if decoded_data['type'] == 'piezo-dual':
+        load_piezo_row(decoded_data, side)
+    return decoded_data
+
 
-                # Decode the next CBOR object
-                row = cbor2.load(raw_data)
-                decoded_data = cbor2.loads(row['data'])
-                if not decoded_data['type'] in load_raw_types:
-                    continue
-                _delete_other_side(decoded_data, side, sensor_count)
-                if not checked_timespan:
-                    timestamp_start = datetime.fromtimestamp(
-                        decoded_data['ts'],
-                        timezone.utc
-                    )
-                    timestamp_end = timestamp_start + timedelta(minutes=15)
-                    if start_time <= timestamp_start <= end_time:
-                        checked_timespan = True
-                    else:
-                        if start_time <= timestamp_end <= end_time:
-                            checked_timespan = True
-                        else:
-                            raw_data.close()
-                            return
-
-                if decoded_data['type'] == 'piezo-dual':
-                    load_piezo_row(decoded_data, side)
-
-                decoded_data['ts'] = datetime.fromtimestamp(
-                    decoded_data['ts'],
-                    timezone.utc
-                ).strftime("%Y-%m-%d %H:%M:%S")
-                data[decoded_data['type']].append(decoded_data)
-
-            except EOFError:
-                break
+def _decode_cbor_file(file_path: str, start_offset: int, end_offset: Optional[int], start_epoch: float, end_epoch: float,
+                      load_raw_types: List[RawDataTypes], side: Side, sensor_count: int, piezo_metadata=True, copy=True) -> Iterator[dict]:
+    """
+    Yields the wanted records of a memory-mapped RAW file.
+
+    With copy=False the piezo channels are views into the mapping, which stays mapped until they're
+    garbage collected. Only pass copy=False when the records are consumed right away (e.g. by a builder).
+    """
+    # logger.debug(f'Loading cbor data from: {file_path}')
+    piezo_keys = get_piezo_keys(side, sensor_count, metadata=piezo_metadata)
+    with RawFileReader(file_path) as reader:
+        for _, _, _, data in reader.iter_records(start_offset, end_offset):
+            try:
+                decoded_data = _decode_record(data, start_epoch, end_epoch, load_raw_types, side, sensor_count, piezo_keys, copy)
             except Exception as error:
                 logger.error(error)
-        raw_data.close()
-        gc.collect()
-    return data
+                continue
+            if decoded_data is not None:
+                yield decoded_data
+
+
+def _get_decode_other(start_epoch: float, end_epoch: float, load_raw_types: List[RawDataTypes], side: Side, sensor_count: int,
+                      piezo_metadata: bool) -> DecodeRecord:
+    """
+    Decodes the records an archive chunk keeps as raw CBOR, the same way as the records of a RAW file
+    """
+    piezo_keys = get_piezo_keys(side, sensor_count, metadata=piezo_metadata)
+
+    def decode_other(data: bytes) -> Optional[dict]:
+        try:
+            return _decode_record(data, start_epoch, end_epoch, load_raw_types, side, sensor_count, piezo_keys, True)
+        except Exception as error:
+            logger.error(error)
+            return None
+
+    return decode_other
 
 
 def _rename_keys(data: dict):
@@ -127,26 +166,257 @@ def _rename_keys(data: dict):
             data[new_key] = data.pop(old_key)
 
 
-def load_raw_files(folder_path: str, start_time: datetime, end_time: datetime, side: Side, sensor_count=2, raw_data_types: List[RawDataTypes] = None):
-    data = {}
-    if raw_data_types is None:
-        raw_data_types = ['bedTemp', 'capSense', 'frzTemp', 'log', 'piezo-dual']
-
-    for field in raw_data_types:
-        data[field] = []
-    logger.debug(f'Loading RAW files from {folder_path} | {start_time.isoformat()} -> {end_time.isoformat()}')
-
+def get_seek_ranges(folder_path: str, start_epoch: float, end_epoch: float) -> List[Tuple[str, int, Optional[int], int]]:
+    """
+    Returns (file_path, start_offset, end_offset, start_ts) of every RAW file overlapping the range, in timestamp order.
+    Compacted RAW files are read from their archive chunk (see `raw_archive.py`), file_path is then the chunk path.
+    """
     file_paths = get_current_files(folder_path)
+    archive_chunks = get_archive_chunks(folder_path, start_epoch, end_epoch)
 
-    if len(file_paths) == 0:
+    if len(file_paths) == 0 and len(archive_chunks) == 0:
         logger.error('No file paths detected!')
         raise FileNotFoundError(f'No files found for: {folder_path}')
+    prune_raw_indexes(folder_path, file_paths)
 
+    # Skip files outside the time range & seek straight to the first record in range
+    seek_ranges = []
     for file_path in file_paths:
-        if os.path.isfile(file_path):
-            _decode_cbor_file(file_path, data, start_time, end_time, side, sensor_count)
-        else:
+        if not os.path.isfile(file_path):
+            logger.warning(f'File path deleted before parsed! {file_path}')
+            continue
+        archive_chunk = archive_chunks.get(os.path.basename(file_path))
+        if archive_chunk is not None:
+            if is_same_source(file_path, archive_chunk[1]):
+                continue
+            # The RAW file changed since it was compacted, it's the source of truth
+            del archive_chunks[os.path.basename(file_path)]
+        seek_range = get_seek_range(file_path, start_epoch, end_epoch)
+        if seek_range is not None:
+            seek_ranges.append((file_path, *seek_range))
+    for chunk_path, archive_chunk in archive_chunks.values():
+        seek_ranges.append((chunk_path, 0, None, archive_chunk['first_ts']))
+    seek_ranges.sort(key=lambda seek_range: seek_range[3])
+    return seek_ranges
+
+
+def _get_piezo_record_count(file_path: str) -> int:
+    if is_archive_chunk(file_path):
+        return get_archive_record_count(file_path, 'piezo-dual')
+    return get_raw_file_index(file_path)['record_counts'].get('piezo-dual', 0)
+
+
+def _iter_decoded_records(
+        seek_ranges: List[Tuple[str, int, Optional[int], int]],
+        start_epoch: float,
+        end_epoch: float,
+        raw_data_types: List[RawDataTypes],
+        side: Side,
+        sensor_count: int,
+        piezo_metadata=True,
+        copy=True,
+) -> Iterator[dict]:
+    for file_path, start_offset, end_offset, _ in seek_ranges:
+        if not os.path.isfile(file_path):
             logger.warning(f'File path deleted before parsed! {file_path}')
+            continue
+        if is_archive_chunk(file_path):
+            decode_other = _get_decode_other(start_epoch, end_epoch, raw_data_types, side, sensor_count, piezo_metadata)
+            yield from iter_archive_records(file_path, start_epoch, end_epoch, raw_data_types, side, sensor_count, decode_other, piezo_metadata)
+            continue
+        yield from _decode_cbor_file(file_path, start_offset, end_offset, start_epoch, end_epoch, raw_data_types, side, sensor_count, piezo_metadata, copy)
+
+
+def iter_raw_records(
+        folder_path: str,
+        start_time: datetime,
+        end_time: datetime,
+        raw_data_types: List[RawDataTypes] = None,
+        side: Side = 'left',
+        sensor_count=2,
+        copy=True,
+        epoch_ts=False,
+) -> Iterator[dict]:
+    """
+    Yields the decoded records between start_time & end_time one at a time, files are read in timestamp order.
+
+    Only the records of the requested side (& sensor 1 if sensor_count == 1) are kept, nothing is buffered
+    so memory usage stays flat no matter how long the time range is.
+
+    With copy=False the piezo channels are read-only views into the memory-mapped RAW files, use it when
+    the records are folded right away instead of being kept.
+
+    With epoch_ts=True `ts` is left as int epoch seconds instead of a 'YYYY-MM-DD HH:MM:SS' string,
+    the dataframe builders & `ts_to_datetime` accept both.
+    """
+    if raw_data_types is None:
+        raw_data_types = ['bedTemp', 'capSense', 'frzTemp', 'log', 'piezo-dual']
+    logger.debug(f'Loading RAW files from {folder_path} | {start_time.isoformat()} -> {end_time.isoformat()}')
+
+    start_epoch = start_time.timestamp()
+    end_epoch = end_time.timestamp()
+    seek_ranges = get_seek_ranges(folder_path, start_epoch, end_epoch)
+    for decoded_data in _iter_decoded_records(seek_ranges, start_epoch, end_epoch, raw_data_types, side, sensor_count, copy=copy):
+        if epoch_ts:
+            yield decoded_data
+            continue
+        decoded_data['ts'] = datetime.fromtimestamp(
+            decoded_data['ts'],
+            timezone.utc
+        ).strftime("%Y-%m-%d %H:%M:%S")
+        yield decoded_data
+
+
+def load_piezo_frame(folder_path: str, start_time: datetime, end_time: datetime, side: Side, sensor_count=2) -> PiezoFrame:
+    """
+    Loads the piezo records between start_time & end_time straight into a columnar `PiezoFrame`
+    """
+    logger.debug(f'Loading piezo frame from {folder_path} | {start_time.isoformat()} -> {end_time.isoformat()}')
+    start_epoch = start_time.timestamp()
+    end_epoch = end_time.timestamp()
+    seek_ranges = get_seek_ranges(folder_path, start_epoch, end_epoch)
+
+    # Size the arrays from the indexes, capped at one record per second
+    indexed_row_count = sum(_get_piezo_record_count(file_path) for file_path, *_ in seek_ranges)
+    capacity = min(indexed_row_count, int(end_epoch - start_epoch) + 1)
+
+    builder = PiezoFrameBuilder(capacity)
+    for piezo_record in _iter_decoded_records(seek_ranges, start_epoch, end_epoch, ['piezo-dual'], side, sensor_count, piezo_metadata=False, copy=False):
+        builder.append(piezo_record)
+    piezo_frame = builder.build()
+    logger.debug(f'Loaded {piezo_frame}')
+    return piezo_frame
+
+
+class RawFrames(TypedDict):
+    piezo_dual: PiezoFrame
+    cap_senses: CapFrame
+
+
+def _decode_file_frames(
+        file_path: str,
+        start_offset: int,
+        end_offset: Optional[int],
+        start_epoch: float,
+        end_epoch: float,
+        raw_data_types: List[RawDataTypes],
+        side: Side,
+        sensor_count: int,
+        piezo_capacity: int,
+) -> RawFrames:
+    """
+    Decodes the byte range of a single RAW file into columnar frames, runs inside the worker processes
+    """
+    if is_archive_chunk(file_path):
+        decode_other = _get_decode_other(start_epoch, end_epoch, raw_data_types, side, sensor_count, piezo_metadata=False)
+        piezo_frame, cap_frame = load_archive_frames(file_path, start_epoch, end_epoch, raw_data_types, side, sensor_count, decode_other)
+        return {
+            'piezo_dual': piezo_frame,
+            'cap_senses': cap_frame,
+        }
+
+    piezo_builder = PiezoFrameBuilder(piezo_capacity)
+    cap_builder = CapFrameBuilder()
+    if os.path.isfile(file_path):
+        for record in _decode_cbor_file(file_path, start_offset, end_offset, start_epoch, end_epoch, raw_data_types, side, sensor_count, piezo_metadata=False, copy=False):
+            if record['type'] == 'piezo-dual':
+                piezo_builder.append(record)
+            else:
+                cap_builder.append(record)
+    else:
+        logger.warning(f'File path deleted before parsed! {file_path}')
+    # Only the arrays are pickled back to the parent process
+    return {
+        'piezo_dual': piezo_builder.build(),
+        'cap_senses': cap_builder.build(),
+    }
+
+
+def get_mp_context():
+    """
+    Returns the multiprocessing context of the decode worker pools
+    """
+    # Forked workers inherit the configured logger & sys.path, spawned workers would fail to import this module
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def load_raw_frames(
+        folder_path: str,
+        start_time: datetime,
+        end_time: datetime,
+        side: Side,
+        sensor_count=2,
+        raw_data_types: List[RawDataTypes] = None,
+        workers=1,
+) -> RawFrames:
+    """
+    Loads the piezo & capSense records between start_time & end_time into columnar frames.
+
+    With workers > 1 the RAW files are decoded in parallel by a process pool, one task per file,
+    and the per file frames are merged in timestamp order. Unlike `iter_raw_records` the whole time
+    range is held in memory, so this is meant for offline jobs on a machine with spare cores & RAM.
+    """
+    if raw_data_types is None:
+        raw_data_types = ['capSense', 'piezo-dual']
+    unsupported_types = set(raw_data_types) - {'capSense', 'piezo-dual'}
+    if unsupported_types:
+        raise ValueError(f'load_raw_frames only supports capSense & piezo-dual records, got: {sorted(unsupported_types)}')
+
+    logger.debug(f'Loading RAW frames from {folder_path} | {start_time.isoformat()} -> {end_time.isoformat()} | workers: {workers}')
+    start_epoch = start_time.timestamp()
+    end_epoch = end_time.timestamp()
+    seek_ranges = get_seek_ranges(folder_path, start_epoch, end_epoch)
+
+    max_row_count = int(end_epoch - start_epoch) + 1
+    tasks = [
+        (
+            file_path, start_offset, end_offset, start_epoch, end_epoch, raw_data_types, side, sensor_count,
+            min(_get_piezo_record_count(file_path), max_row_count),
+        )
+        for file_path, start_offset, end_offset, _ in seek_ranges
+    ]
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=get_mp_context()) as executor:
+            file_frames = list(executor.map(_decode_file_frames, *zip(*tasks)))
+    else:
+        file_frames = [_decode_file_frames(*task) for task in tasks]
+
+    raw_frames: RawFrames = {
+        'piezo_dual': PiezoFrame.concat([frames['piezo_dual'] for frames in file_frames]),
+        'cap_senses': CapFrame.concat([frames['cap_senses'] for frames in file_frames]),
+    }
+    del file_frames
+    gc.collect()
+    logger.debug(f'Loaded {raw_frames["piezo_dual"]} & {raw_frames["cap_senses"]}')
+    return raw_frames
+
+
+def iter_chunks(records: Iterable[dict], chunk_size: int) -> Iterator[List[dict]]:
+    """
+    Groups records into lists of at most chunk_size records
+    """
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def load_raw_files(folder_path: str, start_time: datetime, end_time: datetime, side: Side, sensor_count=2, raw_data_types: List[RawDataTypes] = None,
+                   epoch_ts=False):
+    data = {}
+    if raw_data_types is None:
+        raw_data_types = ['bedTemp', 'capSense', 'frzTemp', 'log', 'piezo-dual']
+
+    for field in raw_data_types:
+        data[field] = []
+
+    for record in iter_raw_records(folder_path, start_time, end_time, raw_data_types, side, sensor_count, epoch_ts=epoch_ts):
+        data[record['type']].append(record)
     _rename_keys(data)
     gc.collect()
     return data
@@ -4,10 +4,13 @@ import sys
 import os
 import pandas as pd
 import numpy as np
+from typing import Iterable
 
 sys.path.append(os.getcwd())
 from data_types import *
 from get_logger import get_logger
+from piezo_frame import PiezoFeatureFrame, PiezoFrame
+from biometrics_helpers import ts_to_datetime
 
 logger = get_logger()
 
@@ -16,20 +19,11 @@ def _calculate_avg(arr: np.ndarray):
     return np.mean(arr)
 
 
-def load_piezo_df(data: Data, side: Side, lower_percentile=2, upper_percentile=98, expected_row_count=None) -> pd.DataFrame:
-    logger.debug('Loading piezo df...')
-    df = pd.DataFrame(data['piezo_dual'])
-    df.sort_values(by='ts', inplace=True)
-    df['ts'] = pd.to_datetime(df['ts'])
-    df.set_index('ts', inplace=True)
-
-    df[f'{side}1_avg'] = df[f'{side}1'].apply(_calculate_avg)
-
+def _filter_piezo_df(df: pd.DataFrame, side: Side, lower_percentile: float, upper_percentile: float, expected_row_count=None) -> pd.DataFrame:
     lower_bound = np.percentile(df[f'{side}1_avg'], lower_percentile)
     upper_bound = np.percentile(df[f'{side}1_avg'], upper_percentile)
     df = df[(df[f'{side}1_avg'] >= lower_bound) & (df[f'{side}1_avg'] <= upper_bound)]
 
-    df.drop(columns=[f'{side}1', 'type', 'freq', 'adc', 'gain'], inplace=True)
     logger.debug(f'Piezo rows loaded: {df.shape[0]:,}')
     if expected_row_count is not None:
         row_count = df.shape[0]
@@ -40,6 +34,95 @@ def load_piezo_df(data: Data, side: Side, lower_percentile=2, upper_percentile=9
     return df
 
 
+def load_piezo_df(data: Union[Data, PiezoFrame, PiezoFeatureFrame], side: Side, lower_percentile=2, upper_percentile=98, expected_row_count=None) -> pd.DataFrame:
+    logger.debug('Loading piezo df...')
+    if isinstance(data, PiezoFrame):
+        # Columnar input, average every row of the channel matrix in one vectorized call
+        df = pd.DataFrame(
+            {
+                'seq': data.seq,
+                f'{side}1_avg': data.channel(f'{side}1').mean(axis=1),
+            },
+            index=pd.DatetimeIndex(pd.to_datetime(data.epochs, unit='s'), name='ts'),
+        )
+        return _filter_piezo_df(df, side, lower_percentile, upper_percentile, expected_row_count=expected_row_count)
+    if isinstance(data, PiezoFeatureFrame):
+        # Cached features, the averages are already computed (see `feature_cache.py`)
+        df = pd.DataFrame(
+            {
+                'seq': data.seq,
+                f'{side}1_avg': data.channel(f'{side}1_avg'),
+            },
+            index=pd.DatetimeIndex(pd.to_datetime(data.epochs, unit='s'), name='ts'),
+        )
+        return _filter_piezo_df(df, side, lower_percentile, upper_percentile, expected_row_count=expected_row_count)
+
+    df = pd.DataFrame(data['piezo_dual'])
+    df.sort_values(by='ts', inplace=True)
+    df['ts'] = ts_to_datetime(df['ts'])
+    df.set_index('ts', inplace=True)
+
+    df[f'{side}1_avg'] = df[f'{side}1'].apply(_calculate_avg)
+    df.drop(columns=[f'{side}1', 'type', 'freq', 'adc', 'gain'], inplace=True)
+    return _filter_piezo_df(df, side, lower_percentile, upper_percentile, expected_row_count=expected_row_count)
+
+
+class PiezoDfBuilder:
+    """
+    Folds piezo records into the columns of `load_piezo_df` as they arrive, `chunk_size` records at a time.
+
+    Only the per-second average of sensor 1 is kept, so memory usage is bounded by chunk_size
+    instead of the length of the time range.
+    """
+
+    def __init__(self, side: Side, chunk_size=900):
+        self.side = side
+        self.chunk_size = chunk_size
+        self.pending: List[PiezoDualData] = []
+        self.ts_chunks: List[np.ndarray] = []
+        self.seq_chunks: List[np.ndarray] = []
+        self.avg_chunks: List[np.ndarray] = []
+
+    def add(self, piezo_record: PiezoDualData):
+        self.pending.append(piezo_record)
+        if len(self.pending) >= self.chunk_size:
+            self._fold()
+
+    def _fold(self):
+        if not self.pending:
+            return
+        self.ts_chunks.append(np.array([record['ts'] for record in self.pending]))
+        self.seq_chunks.append(np.array([record['seq'] for record in self.pending], dtype=np.int64))
+        self.avg_chunks.append(np.mean(np.stack([record[f'{self.side}1'] for record in self.pending]), axis=1))
+        self.pending = []
+
+    def build(self, lower_percentile=2, upper_percentile=98, expected_row_count=None) -> pd.DataFrame:
+        logger.debug('Loading piezo df...')
+        self._fold()
+        df = pd.DataFrame({
+            'ts': np.concatenate(self.ts_chunks) if self.ts_chunks else [],
+            'seq': np.concatenate(self.seq_chunks) if self.seq_chunks else [],
+            f'{self.side}1_avg': np.concatenate(self.avg_chunks) if self.avg_chunks else [],
+        })
+        self.ts_chunks, self.seq_chunks, self.avg_chunks = [], [], []
+
+        df.sort_values(by='ts', inplace=True)
+        df['ts'] = ts_to_datetime(df['ts'])
+        df.set_index('ts', inplace=True)
+        return _filter_piezo_df(df, self.side, lower_percentile, upper_percentile, expected_row_count=expected_row_count)
+
+
+def load_piezo_df_chunked(piezo_records: Iterable[PiezoDualData], side: Side, lower_percentile=2, upper_percentile=98, expected_row_count=None,
+                          chunk_size=900) -> pd.DataFrame:
+    """
+    Chunked variant of `load_piezo_df` consuming a record iterator (see `load_raw_files.iter_raw_records`)
+    """
+    builder = PiezoDfBuilder(side, chunk_size=chunk_size)
+    for piezo_record in piezo_records:
+        builder.add(piezo_record)
+    return builder.build(lower_percentile, upper_percentile, expected_row_count=expected_row_count)
+
+
 def detect_presence_piezo(df: pd.DataFrame, side: Side, rolling_seconds=10, threshold_percent=0.75, range_rolling_seconds=10, range_threshold=10_000,
                           clean=True):
     """Detects presence on a bed using piezo sensor data.
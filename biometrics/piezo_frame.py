@@ -0,0 +1,187 @@
+"""
+This module defines `PiezoFrame`, a columnar container for piezo sensor data, and its `RecordFrame` base class.
+
+Instead of one Python dict per second holding 500-sample arrays, a `PiezoFrame` holds:
+- `epochs`: int64 vector of record timestamps (epoch seconds), sorted ascending.
+- `seq`: int64 vector of record sequence numbers.
+- One contiguous `(n_seconds, 500)` int32 matrix per kept channel (e.g. `left1`, `left2`).
+
+Time range slicing uses binary search over `epochs` and returns views, so a window of
+consecutive seconds is a single contiguous 1-D signal without any `np.concatenate`.
+
+Usage:
+- Use `load_raw_files.load_piezo_frame(...)` to load a frame directly from RAW files.
+- Use `frame.signal('left1', start_epoch, end_epoch)` to get the samples of a time range.
+"""
+from typing import Dict, List, Optional
+import numpy as np
+
+from data_types import *
+
+
+class RecordFrame:
+    """
+    Base class for columnar record containers, every array in `channels` is indexed by row on its first axis
+    """
+    epochs: np.ndarray
+    seq: np.ndarray
+    channels: Dict[str, np.ndarray]
+
+    def __init__(self, epochs: np.ndarray, seq: np.ndarray, channels: Dict[str, np.ndarray]):
+        self.epochs = epochs
+        self.seq = seq
+        self.channels = channels
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __repr__(self):
+        name = type(self).__name__
+        if len(self) == 0:
+            return f'{name}(empty)'
+        start = np.datetime64(int(self.epochs[0]), 's')
+        end = np.datetime64(int(self.epochs[-1]), 's')
+        return f'{name}({len(self):,} rows | {start} -> {end} | channels: {", ".join(self.columns)})'
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.channels.keys())
+
+    def channel(self, name: str) -> np.ndarray:
+        return self.channels[name]
+
+    def _bounds(self, start_epoch: float, end_epoch: float):
+        # Inclusive on both ends, same as DataFrame.loc[start:end]
+        start_ix = int(np.searchsorted(self.epochs, start_epoch, side='left'))
+        end_ix = int(np.searchsorted(self.epochs, end_epoch, side='right'))
+        return start_ix, end_ix
+
+    def slice(self, start_epoch: float, end_epoch: float):
+        """
+        Returns a frame holding the rows between start_epoch & end_epoch (inclusive), the arrays are views
+        """
+        start_ix, end_ix = self._bounds(start_epoch, end_epoch)
+        return type(self)(
+            self.epochs[start_ix:end_ix],
+            self.seq[start_ix:end_ix],
+            {name: values[start_ix:end_ix] for name, values in self.channels.items()},
+        )
+
+    @classmethod
+    def concat(cls, frames: List['RecordFrame']):
+        """
+        Merges frames into a single frame sorted by epoch
+        """
+        frames = [frame for frame in frames if len(frame) > 0]
+        if len(frames) == 0:
+            return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), {})
+        if len(frames) == 1:
+            return frames[0].sorted()
+        channel_names = [name for name in frames[0].columns if all(name in frame.channels for frame in frames)]
+        frame = cls(
+            np.concatenate([frame.epochs for frame in frames]),
+            np.concatenate([frame.seq for frame in frames]),
+            {name: np.concatenate([frame.channels[name] for frame in frames]) for name in channel_names},
+        )
+        return frame.sorted()
+
+    def sorted(self):
+        if len(self) < 2 or np.all(self.epochs[1:] >= self.epochs[:-1]):
+            return self
+        order = np.argsort(self.epochs, kind='stable')
+        return type(self)(
+            self.epochs[order],
+            self.seq[order],
+            {name: values[order] for name, values in self.channels.items()},
+        )
+
+
+class PiezoFrame(RecordFrame):
+    """
+    Piezo channels are `(n_seconds, samples_per_record)` int32 matrices
+    """
+
+    def signal(self, name: str, start_epoch: float, end_epoch: float) -> np.ndarray:
+        """
+        Returns the samples of a channel between start_epoch & end_epoch (inclusive) as a 1-D view
+        """
+        start_ix, end_ix = self._bounds(start_epoch, end_epoch)
+        return self.channels[name][start_ix:end_ix].reshape(-1)
+
+    @staticmethod
+    def empty(channel_names: List[str], samples_per_record=500) -> 'PiezoFrame':
+        return PiezoFrame(
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            {name: np.empty((0, samples_per_record), dtype=np.int32) for name in channel_names},
+        )
+
+
+class PiezoFeatureFrame(RecordFrame):
+    """
+    Per-second piezo features, `{side}1_avg` float64 vectors holding the mean of the sensor 1 samples of each record
+    """
+
+    @staticmethod
+    def empty(channel_names: List[str]) -> 'PiezoFeatureFrame':
+        return PiezoFeatureFrame(
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            {name: np.empty(0, dtype=np.float64) for name in channel_names},
+        )
+
+
+class PiezoFrameBuilder:
+    """
+    Copies piezo records into preallocated arrays as they are decoded, growing them only if
+    more records arrive than expected.
+    """
+
+    def __init__(self, capacity: int, samples_per_record=500):
+        self.capacity = max(capacity, 1)
+        self.samples_per_record = samples_per_record
+        self.row_count = 0
+        self.epochs = np.empty(self.capacity, dtype=np.int64)
+        self.seq = np.empty(self.capacity, dtype=np.int64)
+        self.channels: Optional[Dict[str, np.ndarray]] = None
+
+    def _grow(self):
+        self.capacity = int(self.capacity * 1.5) + 1
+        self.epochs = np.resize(self.epochs, self.capacity)
+        self.seq = np.resize(self.seq, self.capacity)
+        for name, matrix in self.channels.items():
+            grown = np.empty((self.capacity, self.samples_per_record), dtype=np.int32)
+            grown[:self.row_count] = matrix[:self.row_count]
+            self.channels[name] = grown
+
+    def append(self, piezo_record: PiezoDualData):
+        if self.channels is None:
+            # Keep the channels left after `_delete_other_side`
+            self.channels = {
+                name: np.empty((self.capacity, self.samples_per_record), dtype=np.int32)
+                for name in ['left1', 'left2', 'right1', 'right2'] if name in piezo_record
+            }
+        if self.row_count == self.capacity:
+            self._grow()
+
+        row = self.row_count
+        for name, matrix in self.channels.items():
+            samples = piezo_record[name]
+            if len(samples) != self.samples_per_record:
+                # Skip malformed records rather than misaligning the matrix
+                return
+            matrix[row] = samples
+        self.epochs[row] = piezo_record['ts']
+        self.seq[row] = piezo_record['seq']
+        self.row_count += 1
+
+    def build(self) -> PiezoFrame:
+        if self.channels is None:
+            return PiezoFrame.empty([])
+        row_count = self.row_count
+        frame = PiezoFrame(
+            self.epochs[:row_count],
+            self.seq[:row_count],
+            {name: matrix[:row_count] for name, matrix in self.channels.items()},
+        )
+        return frame.sorted()
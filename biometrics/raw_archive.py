@@ -0,0 +1,527 @@
+"""
+This module implements the compact columnar archive of closed `.RAW` files, written by
+`compaction/compact_raw_files.py` & read transparently by `load_raw_files.py`.
+
+Archives live in `{folder_path}archive/`, one folder per night holding one `.npz` chunk per compacted
+RAW file plus an `index.json` time index (first/last `ts` of every chunk).
+
+Inside a chunk, every record type is stored as columns:
+- piezo-dual channels are int32 matrices, delta-encoded over consecutive samples & split into byte planes
+  which compresses far better than the raw samples.
+- capSense, bedTemp & frzTemp fields are flattened into int/text columns (`left.out`, `amb`, ...).
+- Every column has an `order` (position of the record in the RAW file) & `epochs` vector.
+- Records which don't fit the columns of their type (logs, unexpected fields...) are kept as raw CBOR.
+
+Key functionalities:
+- `compact_raw_file(file_path, folder_path)` writes the chunk of a RAW file & adds it to the night index.
+- `get_archive_chunks(folder_path, start_epoch, end_epoch)` returns the chunks overlapping a time range.
+- `iter_archive_records(...)` yields the records of a chunk in the same format `load_raw_files` decodes them.
+- `load_archive_frames(...)` loads a chunk straight into a `PiezoFrame` & `CapFrame`.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterator, Optional
+import json
+import os
+import cbor2
+import numpy as np
+
+from data_types import *
+from get_logger import get_logger
+from cap_frame import CapFrame, CapFrameBuilder
+from piezo_frame import PiezoFrame, PiezoFrameBuilder
+from raw_cbor import get_piezo_keys
+from raw_reader import RawFileReader
+
+logger = get_logger()
+
+ARCHIVE_VERSION = 1
+# Nights are named after the evening they start, a record at 08:00 UTC belongs to the previous night
+NIGHT_OFFSET_SECONDS = 12 * 60 * 60
+ARCHIVE_PREFIXES: Dict[str, str] = {
+    'piezo-dual': 'piezo',
+    'capSense': 'cap',
+    'bedTemp': 'bed_temp',
+    'frzTemp': 'frz_temp',
+}
+OTHER_PREFIX = 'other'
+
+# Decodes the CBOR payload of a record kept as is, returns None if the record isn't wanted
+DecodeRecord = Callable[[bytes], Optional[dict]]
+
+
+def get_archive_folder_path(folder_path: str) -> str:
+    return os.path.join(folder_path, 'archive', '')
+
+
+def is_archive_chunk(file_path: str) -> bool:
+    return file_path.endswith('.npz')
+
+
+def _get_night(ts: int) -> str:
+    return datetime.fromtimestamp(ts - NIGHT_OFFSET_SECONDS, timezone.utc).strftime('%Y-%m-%d')
+
+
+def _delta_encode(samples: np.ndarray) -> np.ndarray:
+    """
+    Encodes int32 samples into bytes that deflate well:
+    - Differences between consecutive samples, int32 differences wrap around on overflow & are unwrapped by the cumulative sum
+    - Zigzag so small negative differences have leading zero bits too
+    - Byte planes, the high bytes of every difference are stored together & compress to almost nothing
+    """
+    deltas = np.empty_like(samples)
+    if len(samples) > 0:
+        deltas[0] = samples[0]
+        np.subtract(samples[1:], samples[:-1], out=deltas[1:])
+    zigzag = ((deltas << 1) ^ (deltas >> 31)).view(np.uint32)
+    return np.ascontiguousarray(zigzag.view(np.uint8).reshape(-1, 4).T).reshape(-1)
+
+
+def _delta_decode(byte_planes: np.ndarray) -> np.ndarray:
+    zigzag = np.ascontiguousarray(byte_planes.reshape(4, -1).T).view(np.uint32).reshape(-1)
+    deltas = (zigzag >> 1).view(np.int32) ^ -(zigzag & 1).view(np.int32)
+    return np.cumsum(deltas, dtype=np.int32)
+
+
+def _flatten(record: dict, record_type: str) -> Optional[dict]:
+    """
+    Flattens the fields of a record besides `type` & `ts` into `{'left.out': 387, ...}`,
+    returns None if a field can't be stored as a column.
+    """
+    fields = {}
+    for key, value in record.items():
+        if key in ('type', 'ts'):
+            continue
+        if type(value) is dict:
+            for sub_key, sub_value in value.items():
+                if type(sub_value) not in (int, str):
+                    return None
+                fields[f'{key}.{sub_key}'] = sub_value
+        elif type(value) in (int, str):
+            fields[key] = value
+        elif type(value) is bytes and record_type == 'piezo-dual' and len(value) % 4 == 0:
+            fields[key] = value
+        else:
+            return None
+    return fields
+
+
+class _ColumnarRecords:
+    """
+    Collects the records of one type sharing the fields of the first record as columns
+    """
+
+    def __init__(self):
+        # (field, value type, byte length of byte string fields)
+        self.schema: Optional[Tuple[Tuple[str, type, int], ...]] = None
+        self.order: List[int] = []
+        self.epochs: List[int] = []
+        self.columns: List[list] = []
+
+    def append(self, order: int, ts: int, fields: dict) -> bool:
+        schema = tuple((name, type(value), len(value) if type(value) is bytes else 0) for name, value in fields.items())
+        if self.schema is None:
+            self.schema = schema
+            self.columns = [[] for _ in schema]
+        elif schema != self.schema:
+            return False
+        self.order.append(order)
+        self.epochs.append(ts)
+        for values, value in zip(self.columns, fields.values()):
+            values.append(value)
+        return True
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        arrays = {
+            f'{prefix}/order': np.array(self.order, dtype=np.int32),
+            f'{prefix}/epochs': np.array(self.epochs, dtype=np.int64),
+        }
+        for (name, value_type, byte_length), values in zip(self.schema, self.columns):
+            if value_type is bytes:
+                arrays[f'{prefix}/{name}'] = _delta_encode(np.frombuffer(b''.join(values), dtype=np.int32))
+                arrays[f'{prefix}/{name}:samples'] = np.array(byte_length // 4)
+            elif value_type is int:
+                arrays[f'{prefix}/{name}'] = np.array(values, dtype=np.int64)
+            else:
+                arrays[f'{prefix}/{name}'] = np.array(values, dtype=str)
+        return arrays
+
+
+class _OtherRecords:
+    """
+    Records kept as raw CBOR, concatenated into a single byte buffer
+    """
+
+    def __init__(self):
+        self.order: List[int] = []
+        self.epochs: List[int] = []
+        self.types: List[str] = []
+        self.payloads: List[bytes] = []
+
+    def append(self, order: int, ts: int, record_type: str, data: bytes):
+        self.order.append(order)
+        self.epochs.append(ts)
+        self.types.append(record_type)
+        self.payloads.append(data)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        offsets = np.zeros(len(self.payloads) + 1, dtype=np.int64)
+        np.cumsum([len(payload) for payload in self.payloads], out=offsets[1:])
+        return {
+            f'{OTHER_PREFIX}/order': np.array(self.order, dtype=np.int32),
+            f'{OTHER_PREFIX}/epochs': np.array(self.epochs, dtype=np.int64),
+            f'{OTHER_PREFIX}/types': np.array(self.types, dtype=str),
+            f'{OTHER_PREFIX}/data': np.frombuffer(b''.join(self.payloads), dtype=np.uint8),
+            f'{OTHER_PREFIX}/offsets': offsets,
+        }
+
+
+def _get_index_file_path(archive_folder_path: str, night: str) -> str:
+    return f'{archive_folder_path}{night}/index.json'
+
+
+def _read_archive_index(index_file_path: str, night: str) -> ArchiveIndex:
+    if os.path.isfile(index_file_path):
+        try:
+            with open(index_file_path, 'r') as json_file:
+                archive_index = json.load(json_file)
+            if archive_index.get('version') == ARCHIVE_VERSION:
+                return archive_index
+        except (OSError, ValueError) as error:
+            logger.error(f'Could not read archive index {index_file_path} | {error}')
+    return {'version': ARCHIVE_VERSION, 'night': night, 'chunks': []}
+
+
+def _save_archive_index(index_file_path: str, archive_index: ArchiveIndex):
+    tmp_file_path = f'{index_file_path}.{os.getpid()}.tmp'
+    with open(tmp_file_path, 'w') as json_file:
+        json.dump(archive_index, json_file, indent=4)
+    os.replace(tmp_file_path, index_file_path)
+
+
+def compact_raw_file(file_path: str, folder_path: str) -> Optional[ArchiveChunk]:
+    """
+    Writes the archive chunk of a closed RAW file and adds it to the index of its night.
+    Returns None if the file holds no records.
+    """
+    stat = os.stat(file_path)
+    columnar_records: Dict[str, _ColumnarRecords] = {}
+    other_records = _OtherRecords()
+    record_counts: Dict[str, int] = {}
+    first_ts, last_ts, first_seq, last_seq = None, None, None, None
+
+    with RawFileReader(file_path) as reader:
+        for order, (offset, _, seq, data) in enumerate(reader.iter_records()):
+            try:
+                record = cbor2.loads(data)
+            except Exception as error:
+                logger.error(f'Error decoding {file_path} @ byte {offset:,}, dropping the record | {error}')
+                continue
+            record_type = record.get('type')
+            ts = record.get('ts')
+            if type(record_type) is not str or type(ts) is not int:
+                # Records without a type or ts are never returned by load_raw_files
+                continue
+
+            record_counts[record_type] = record_counts.get(record_type, 0) + 1
+            first_ts = ts if first_ts is None else min(first_ts, ts)
+            last_ts = ts if last_ts is None else max(last_ts, ts)
+            if seq is not None:
+                if first_seq is None:
+                    first_seq = seq
+                last_seq = seq
+
+            prefix = ARCHIVE_PREFIXES.get(record_type)
+            fields = _flatten(record, record_type) if prefix is not None else None
+            if fields is None or not columnar_records.setdefault(prefix, _ColumnarRecords()).append(order, ts, fields):
+                other_records.append(order, ts, record_type, bytes(data))
+
+    if first_ts is None:
+        return None
+
+    arrays = other_records.to_arrays()
+    for prefix, records in columnar_records.items():
+        if records.schema is not None:
+            arrays.update(records.to_arrays(prefix))
+
+    night = _get_night(first_ts)
+    archive_folder_path = get_archive_folder_path(folder_path)
+    os.makedirs(f'{archive_folder_path}{night}', exist_ok=True)
+    chunk_file_name = f'{os.path.splitext(os.path.basename(file_path))[0]}.npz'
+    chunk_path = f'{archive_folder_path}{night}/{chunk_file_name}'
+    # np.savez appends .npz to paths which don't end with it
+    tmp_chunk_path = f'{chunk_path}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(tmp_chunk_path, **arrays)
+    os.replace(tmp_chunk_path, chunk_path)
+
+    chunk: ArchiveChunk = {
+        'file_name': chunk_file_name,
+        'source_file_name': os.path.basename(file_path),
+        'source_inode': stat.st_ino,
+        'source_size': stat.st_size,
+        'first_ts': first_ts,
+        'last_ts': last_ts,
+        'first_seq': first_seq,
+        'last_seq': last_seq,
+        'record_counts': record_counts,
+    }
+    index_file_path = _get_index_file_path(archive_folder_path, night)
+    archive_index = _read_archive_index(index_file_path, night)
+    archive_index['chunks'] = [
+        archived_chunk for archived_chunk in archive_index['chunks']
+        if archived_chunk['source_file_name'] != chunk['source_file_name']
+    ]
+    archive_index['chunks'].append(chunk)
+    archive_index['chunks'].sort(key=lambda archived_chunk: archived_chunk['first_ts'])
+    _save_archive_index(index_file_path, archive_index)
+    logger.debug(f'Compacted {file_path} ({stat.st_size:,} bytes) -> {chunk_path} ({os.path.getsize(chunk_path):,} bytes)')
+    return chunk
+
+
+def list_archived_chunks(folder_path: str, nights: Optional[List[str]] = None) -> Dict[str, Tuple[str, ArchiveChunk]]:
+    """
+    Returns source RAW file name -> (chunk path, chunk) for the archived chunks of the given nights (all nights if None)
+    """
+    archive_folder_path = get_archive_folder_path(folder_path)
+    if not os.path.isdir(archive_folder_path):
+        return {}
+    if nights is None:
+        nights = sorted(os.listdir(archive_folder_path))
+
+    archived_chunks = {}
+    for night in nights:
+        index_file_path = _get_index_file_path(archive_folder_path, night)
+        if not os.path.isfile(index_file_path):
+            continue
+        for chunk in _read_archive_index(index_file_path, night)['chunks']:
+            archived_chunks[chunk['source_file_name']] = (f'{archive_folder_path}{night}/{chunk["file_name"]}', chunk)
+    return archived_chunks
+
+
+def get_archive_chunks(folder_path: str, start_epoch: float, end_epoch: float) -> Dict[str, Tuple[str, ArchiveChunk]]:
+    """
+    Returns source RAW file name -> (chunk path, chunk) for the archived chunks overlapping the time range
+    """
+    # A night folder holds the records from its evening until the next evening, plus a margin for files overlapping both
+    start_date = datetime.fromtimestamp(start_epoch - NIGHT_OFFSET_SECONDS, timezone.utc).date() - timedelta(days=1)
+    end_date = datetime.fromtimestamp(end_epoch - NIGHT_OFFSET_SECONDS, timezone.utc).date()
+    nights = [(start_date + timedelta(days=days)).strftime('%Y-%m-%d') for days in range((end_date - start_date).days + 1)]
+
+    return {
+        source_file_name: (chunk_path, chunk)
+        for source_file_name, (chunk_path, chunk) in list_archived_chunks(folder_path, nights).items()
+        if chunk['last_ts'] >= start_epoch and chunk['first_ts'] <= end_epoch
+    }
+
+
+def is_same_source(file_path: str, chunk: ArchiveChunk) -> bool:
+    """
+    True if the RAW file is the one the chunk was compacted from and it hasn't changed since
+    """
+    stat = os.stat(file_path)
+    return stat.st_ino == chunk['source_inode'] and stat.st_size == chunk['source_size']
+
+
+class ArchiveChunkReader:
+    """
+    Reads the columns of an archive chunk, members are only decompressed when accessed
+    """
+
+    def __init__(self, chunk_path: str):
+        self.chunk_path = chunk_path
+        self._npz = np.load(chunk_path)
+        self.files = set(self._npz.files)
+        self._arrays: Dict[str, np.ndarray] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get(self, name: str) -> np.ndarray:
+        if name not in self._arrays:
+            self._arrays[name] = self._npz[name]
+        return self._arrays[name]
+
+    def has(self, prefix: str, column='epochs') -> bool:
+        return f'{prefix}/{column}' in self.files
+
+    def epochs(self, prefix: str) -> np.ndarray:
+        return self._get(f'{prefix}/epochs')
+
+    def order(self, prefix: str) -> np.ndarray:
+        return self._get(f'{prefix}/order')
+
+    def column_names(self, prefix: str) -> List[str]:
+        return [
+            name[len(prefix) + 1:] for name in self._npz.files
+            if name.startswith(f'{prefix}/') and not name.endswith(':samples') and name not in (f'{prefix}/order', f'{prefix}/epochs')
+        ]
+
+    def column(self, prefix: str, name: str) -> np.ndarray:
+        return self._get(f'{prefix}/{name}')
+
+    def channel(self, prefix: str, name: str) -> np.ndarray:
+        """
+        Returns the decoded `(n_records, samples_per_record)` int32 matrix of a byte string column
+        """
+        key = f'{prefix}/{name}:decoded'
+        if key not in self._arrays:
+            samples_per_record = int(self._get(f'{prefix}/{name}:samples'))
+            self._arrays[key] = _delta_decode(self._get(f'{prefix}/{name}')).reshape(-1, samples_per_record)
+        return self._arrays[key]
+
+    def seq(self, prefix: str) -> np.ndarray:
+        if self.has(prefix, 'seq'):
+            return self.column(prefix, 'seq')
+        return np.zeros(len(self.epochs(prefix)), dtype=np.int64)
+
+    def is_channel(self, prefix: str, name: str) -> bool:
+        return f'{prefix}/{name}:samples' in self.files
+
+    def other_payloads(self, rows: np.ndarray) -> Iterator[bytes]:
+        data = self._get(f'{OTHER_PREFIX}/data')
+        offsets = self._get(f'{OTHER_PREFIX}/offsets')
+        for row in rows:
+            yield data[offsets[row]:offsets[row + 1]].tobytes()
+
+    def close(self):
+        self._arrays = {}
+        self._npz.close()
+
+
+def get_archive_record_count(chunk_path: str, record_type: RawDataTypes) -> int:
+    with ArchiveChunkReader(chunk_path) as reader:
+        prefix = ARCHIVE_PREFIXES.get(record_type)
+        record_count = len(reader.epochs(prefix)) if prefix is not None and reader.has(prefix) else 0
+        if reader.has(OTHER_PREFIX):
+            record_count += int(np.count_nonzero(reader.column(OTHER_PREFIX, 'types') == record_type))
+    return record_count
+
+
+def _in_range(epochs: np.ndarray, start_epoch: float, end_epoch: float) -> np.ndarray:
+    return np.flatnonzero((epochs >= start_epoch) & (epochs <= end_epoch))
+
+
+def _get_kept_fields(reader: ArchiveChunkReader, prefix: str, record_type: str, side: Side, sensor_count: int, piezo_metadata: bool) -> List[str]:
+    """
+    Fields returned for a record type, the same ones `load_raw_files._decode_record` keeps
+    """
+    column_names = reader.column_names(prefix)
+    if record_type == 'piezo-dual':
+        kept_keys = [key for key, _ in get_piezo_keys(side, sensor_count, metadata=piezo_metadata)]
+        return [name for name in column_names if name in kept_keys]
+    if record_type == 'capSense':
+        other_side = 'right' if side == 'left' else 'left'
+        return [name for name in column_names if name.split('.')[0] != other_side]
+    return column_names
+
+
+def _build_records(reader: ArchiveChunkReader, prefix: str, record_type: str, rows: np.ndarray, fields: List[str]) -> List[dict]:
+    epochs = reader.epochs(prefix)[rows].tolist()
+    records = [{'type': record_type, 'ts': ts} for ts in epochs]
+    for name in fields:
+        if reader.is_channel(prefix, name):
+            values = reader.channel(prefix, name)[rows]
+        else:
+            values = reader.column(prefix, name)[rows].tolist()
+        if '.' in name:
+            key, sub_key = name.split('.', 1)
+            for record, value in zip(records, values):
+                record.setdefault(key, {})[sub_key] = value
+        else:
+            for record, value in zip(records, values):
+                record[name] = value
+    return records
+
+
+def iter_archive_records(
+        chunk_path: str,
+        start_epoch: float,
+        end_epoch: float,
+        load_raw_types: List[RawDataTypes],
+        side: Side,
+        sensor_count: int,
+        decode_other: DecodeRecord,
+        piezo_metadata=True,
+) -> Iterator[dict]:
+    """
+    Yields the wanted records of an archive chunk in their original order, formatted like the records
+    decoded from RAW files. Records kept as raw CBOR are decoded with decode_other.
+    """
+    with ArchiveChunkReader(chunk_path) as reader:
+        orders = []
+        records: List[Optional[dict]] = []
+        for record_type in load_raw_types:
+            prefix = ARCHIVE_PREFIXES.get(record_type)
+            if prefix is None or not reader.has(prefix):
+                continue
+            rows = _in_range(reader.epochs(prefix), start_epoch, end_epoch)
+            fields = _get_kept_fields(reader, prefix, record_type, side, sensor_count, piezo_metadata)
+            orders.append(reader.order(prefix)[rows])
+            records.extend(_build_records(reader, prefix, record_type, rows, fields))
+
+        if reader.has(OTHER_PREFIX):
+            rows = _in_range(reader.epochs(OTHER_PREFIX), start_epoch, end_epoch)
+            rows = rows[np.isin(reader.column(OTHER_PREFIX, 'types')[rows], load_raw_types)]
+            orders.append(reader.order(OTHER_PREFIX)[rows])
+            records.extend(decode_other(payload) for payload in reader.other_payloads(rows))
+
+    if not records:
+        return
+    for ix in np.argsort(np.concatenate(orders), kind='stable'):
+        if records[ix] is not None:
+            yield records[ix]
+
+
+def load_archive_frames(
+        chunk_path: str,
+        start_epoch: float,
+        end_epoch: float,
+        load_raw_types: List[RawDataTypes],
+        side: Side,
+        sensor_count: int,
+        decode_other: DecodeRecord,
+) -> Tuple[PiezoFrame, CapFrame]:
+    """
+    Loads the piezo & capSense records of an archive chunk straight into columnar frames
+    """
+    frames = []
+    with ArchiveChunkReader(chunk_path) as reader:
+        if 'piezo-dual' in load_raw_types and reader.has('piezo'):
+            rows = _in_range(reader.epochs('piezo'), start_epoch, end_epoch)
+            channel_names = [f'{side}1'] if sensor_count == 1 else [f'{side}1', f'{side}2']
+            frames.append(PiezoFrame(
+                reader.epochs('piezo')[rows],
+                reader.seq('piezo')[rows],
+                {name: reader.channel('piezo', name)[rows] for name in channel_names if reader.is_channel('piezo', name)},
+            ))
+        if 'capSense' in load_raw_types and reader.has('cap'):
+            rows = _in_range(reader.epochs('cap'), start_epoch, end_epoch)
+            frames.append(CapFrame(
+                reader.epochs('cap')[rows],
+                reader.seq('cap')[rows],
+                {
+                    f'{side}_{sensor}': reader.column('cap', f'{side}.{sensor}')[rows].astype(np.int32)
+                    for sensor in ['out', 'cen', 'in'] if reader.has('cap', f'{side}.{sensor}')
+                },
+            ))
+
+        # Records which didn't fit the columns go through the same builders as RAW files
+        piezo_builder = PiezoFrameBuilder(0)
+        cap_builder = CapFrameBuilder()
+        if reader.has(OTHER_PREFIX):
+            rows = _in_range(reader.epochs(OTHER_PREFIX), start_epoch, end_epoch)
+            rows = rows[np.isin(reader.column(OTHER_PREFIX, 'types')[rows], load_raw_types)]
+            for payload in reader.other_payloads(rows):
+                record = decode_other(payload)
+                if record is None:
+                    continue
+                if record['type'] == 'piezo-dual':
+                    piezo_builder.append(record)
+                elif record['type'] == 'capSense':
+                    cap_builder.append(record)
+
+    piezo_frames = [frame for frame in frames if isinstance(frame, PiezoFrame)] + [piezo_builder.build()]
+    cap_frames = [frame for frame in frames if isinstance(frame, CapFrame)] + [cap_builder.build()]
+    return PiezoFrame.concat(piezo_frames), CapFrame.concat(cap_frames)
@@ -0,0 +1,240 @@
+"""
+This module implements a minimal CBOR reader for the inner records of `.RAW` files, it lets
+callers look at the `type` & `ts` of a record before paying for a full `cbor2.loads`.
+
+Inner records are flat CBOR maps with short text keys. Records of the same type share the
+same layout (same keys, same channel lengths), so the offset of every key found by a full walk
+of the first record is cached by record length. Later records are read by checking the key bytes
+at the cached offsets and decoding only the value heads behind them, the piezo channels which
+aren't requested (the bulk of the bytes) are never touched.
+
+Key functionalities:
+- `peek_type_ts(data)` returns the `type` & `ts` of a record.
+- `read_fields(data, keys)` decodes the requested int, text & piezo channel fields of a record.
+- `read_outer_record(data, pos)` locates the `seq` & `data` of an outer record, used by `raw_reader.py`.
+
+Anything this reader does not handle (nested maps, floats, indefinite lengths...) raises
+`CBORPeekError`, callers fall back to `cbor2.loads`.
+
+Usage:
+- record_type, ts = peek_type_ts(row['data'])
+- piezo_record = read_fields(row['data'], get_piezo_keys('left', sensor_count=1))
+"""
+from typing import Dict, Iterable, Optional, Tuple
+import numpy as np
+
+from data_types import *
+
+# (key, CBOR encoding of the key)
+EncodedKeys = Tuple[Tuple[str, bytes], ...]
+
+# Record length -> key -> offset of the key head, learned from full walks
+_layout_cache: Dict[int, Dict[str, int]] = {}
+MAX_CACHED_LAYOUTS = 64
+
+
+class CBORPeekError(ValueError):
+    pass
+
+
+class CBORTruncatedError(CBORPeekError):
+    """
+    The item runs past the end of the data, e.g. the last record of a RAW file still being written
+    """
+    pass
+
+
+def _read_head(data: bytes, pos: int) -> Tuple[int, int, int]:
+    """
+    Reads the head of the item at pos, returns (major type, argument, position after the head)
+    """
+    try:
+        initial_byte = data[pos]
+    except IndexError:
+        raise CBORTruncatedError(f'Unexpected end of data @ {pos}')
+    major_type = initial_byte >> 5
+    additional_info = initial_byte & 0x1f
+    pos += 1
+    if additional_info < 24:
+        return major_type, additional_info, pos
+    if additional_info > 27:
+        raise CBORPeekError(f'Unsupported additional info {additional_info} @ {pos - 1}')
+    length = 1 << (additional_info - 24)
+    if pos + length > len(data):
+        raise CBORTruncatedError(f'Unexpected end of data @ {pos}')
+    return major_type, int.from_bytes(data[pos:pos + length], 'big'), pos + length
+
+
+def _skip_item(data: bytes, pos: int) -> int:
+    """
+    Returns the position right after the item starting at pos
+    """
+    major_type, argument, pos = _read_head(data, pos)
+    if major_type in (2, 3):
+        # Byte & text strings, jump over the payload
+        pos += argument
+        if pos > len(data):
+            raise CBORTruncatedError('String runs past the end of data')
+    elif major_type == 4:
+        for _ in range(argument):
+            pos = _skip_item(data, pos)
+    elif major_type == 5:
+        for _ in range(argument * 2):
+            pos = _skip_item(data, pos)
+    elif major_type == 6:
+        pos = _skip_item(data, pos)
+    # Major types 0, 1 & 7 (ints, simple values & floats) are fully contained in their head
+    return pos
+
+
+def _walk_key_offsets(data: bytes) -> Dict[str, int]:
+    """
+    Walks the top level map of an inner record and returns the offset of every key
+    """
+    major_type, field_count, pos = _read_head(data, 0)
+    if major_type != 5:
+        raise CBORPeekError(f'Expected a map, got major type {major_type}')
+
+    key_offsets = {}
+    for _ in range(field_count):
+        key_pos = pos
+        key_type, key_length, pos = _read_head(data, pos)
+        if key_type != 3 or key_length >= 24:
+            raise CBORPeekError(f'Expected a short text key @ {key_pos}')
+        key = str(data[pos:pos + key_length], 'utf-8')
+        key_offsets[key] = key_pos
+        pos = _skip_item(data, pos + key_length)
+    return key_offsets
+
+
+def encode_keys(keys: Iterable[str]) -> EncodedKeys:
+    """
+    Pairs every key with its CBOR encoding, `read_fields` compares the raw bytes against them
+    """
+    return tuple((key, bytes([0x60 + len(key)]) + key.encode()) for key in keys)
+
+
+def _read_cached_fields(data: bytes, key_offsets: Dict[str, int], encoded_keys: EncodedKeys, copy: bool) -> Optional[dict]:
+    """
+    Reads the fields at the cached key offsets, returns None if the record doesn't match the layout
+    """
+    record = {}
+    for key, key_head in encoded_keys:
+        pos = key_offsets.get(key)
+        if pos is None:
+            continue
+        value_pos = pos + len(key_head)
+        if data[pos:value_pos] != key_head:
+            return None
+
+        # Inline version of `_read_head`, this runs for every field of every record
+        initial_byte = data[value_pos]
+        major_type = initial_byte >> 5
+        argument = initial_byte & 0x1f
+        pos = value_pos + 1
+        if argument >= 24:
+            if argument > 27:
+                return None
+            length = 1 << (argument - 24)
+            argument = int.from_bytes(data[pos:pos + length], 'big')
+            pos += length
+
+        if major_type == 0:
+            record[key] = argument
+        elif major_type == 1:
+            record[key] = -1 - argument
+        elif major_type == 2:
+            # Piezo samples, either a copy of only this channel or a view into data
+            samples = np.frombuffer(data, dtype=np.int32, count=argument // 4, offset=pos)
+            record[key] = samples.copy() if copy else samples
+        elif major_type == 3:
+            record[key] = str(data[pos:pos + argument], 'utf-8')
+        else:
+            raise CBORPeekError(f'Unsupported major type {major_type} for {key}')
+    return record
+
+
+def read_fields(data: bytes, encoded_keys: EncodedKeys, copy=True) -> dict:
+    """
+    Decodes the requested fields of an inner record, missing keys are left out.
+    Integers & text are returned as is, byte strings are piezo channels returned as int32 arrays.
+
+    With copy=False the channels are read-only views into data (e.g. a memory-mapped RAW file),
+    they're only valid for as long as the caller is fine keeping data alive.
+    """
+    key_offsets = _layout_cache.get(len(data))
+    if key_offsets is not None:
+        try:
+            record = _read_cached_fields(data, key_offsets, encoded_keys, copy)
+        except IndexError:
+            record = None
+        if record is not None:
+            return record
+
+    # First record of this length or a different layout, learn it
+    key_offsets = _walk_key_offsets(data)
+    if len(_layout_cache) >= MAX_CACHED_LAYOUTS:
+        _layout_cache.clear()
+    _layout_cache[len(data)] = key_offsets
+    record = _read_cached_fields(data, key_offsets, encoded_keys, copy)
+    if record is None:
+        raise CBORPeekError('Record layout changed while reading it')
+    return record
+
+
+TYPE_TS_KEYS = encode_keys(['type', 'ts'])
+
+
+def read_outer_record(data: bytes, pos: int) -> Tuple[Optional[int], int, int, int]:
+    """
+    Reads the outer `{'seq': int, 'data': bytes}` map of a RAW file at pos without copying the payload.
+    Returns (seq, data start, data end, position of the next record).
+    """
+    major_type, field_count, pos = _read_head(data, pos)
+    if major_type != 5:
+        raise CBORPeekError(f'Expected a map, got major type {major_type}')
+
+    seq = None
+    data_span = None
+    for _ in range(field_count):
+        key_type, key_length, pos = _read_head(data, pos)
+        if key_type != 3:
+            raise CBORPeekError(f'Expected a text key, got major type {key_type}')
+        key = data[pos:pos + key_length]
+        pos += key_length
+        if key == b'data':
+            value_type, length, payload_start = _read_head(data, pos)
+            if value_type != 2:
+                raise CBORPeekError(f'Expected data to be a byte string, got major type {value_type}')
+            pos = payload_start + length
+            if pos > len(data):
+                raise CBORTruncatedError('Record data runs past the end of data')
+            data_span = (payload_start, pos)
+        elif key == b'seq':
+            value_type, argument, _ = _read_head(data, pos)
+            if value_type == 0:
+                seq = argument
+            pos = _skip_item(data, pos)
+        else:
+            pos = _skip_item(data, pos)
+    if data_span is None:
+        raise CBORPeekError('Record has no data')
+    return seq, data_span[0], data_span[1], pos
+
+
+def peek_type_ts(data: bytes) -> Tuple[Optional[str], Optional[int]]:
+    record = read_fields(data, TYPE_TS_KEYS)
+    return record.get('type'), record.get('ts')
+
+
+def get_piezo_keys(side: Side, sensor_count: int, metadata=True) -> EncodedKeys:
+    """
+    Keys of a piezo-dual record kept for a side besides `type` & `ts`, matches what `_delete_other_side` leaves behind.
+    With metadata=False only the channels & `seq` are read, enough for the frame & dataframe builders.
+    """
+    keys = ['freq', 'adc', 'gain'] if metadata else []
+    keys.append(f'{side}1')
+    if sensor_count != 1:
+        keys.append(f'{side}2')
+    keys.append('seq')
+    return encode_keys(keys)
@@ -0,0 +1,225 @@
+"""
+This module maintains a persisted sidecar index for every `.RAW` file so `load_raw_files`
+can skip files outside of the requested time range and seek straight to the requested
+start offset instead of decoding records that are thrown away.
+
+Key functionalities:
+- Scans a RAW file once and records the first/last `ts`, the `seq` range, per-type record
+  counts and the byte offset of the first record of every `CHECKPOINT_INTERVAL_SECONDS`.
+- Persists the index as JSON in `{logger.folder_path}raw_index/`.
+- Builds indexes lazily and only scans the bytes appended since the previous scan when a file grows.
+- Rebuilds the index when a RAW file was replaced (new inode) or truncated.
+
+Usage:
+- Use `get_seek_range(file_path, start_epoch, end_epoch)` to get the byte range of a file to decode.
+- Use `get_raw_file_index(file_path)` to load (and build/refresh if needed) the index of a file.
+"""
+from bisect import bisect_right
+from pathlib import Path
+from typing import Optional, Tuple
+import hashlib
+import json
+import os
+import traceback
+import cbor2
+
+from data_types import *
+from get_logger import get_logger
+from raw_cbor import CBORPeekError, peek_type_ts
+from raw_reader import RawFileReader
+
+logger = get_logger()
+
+RAW_INDEX_FOLDER_PATH = f'{logger.folder_path}raw_index/'
+RAW_INDEX_VERSION = 1
+CHECKPOINT_INTERVAL_SECONDS = 30
+
+
+def get_folder_hash(folder_path: str) -> str:
+    """
+    Returns a short hash of the resolved folder path, prefixed to the file names of per RAW file sidecars
+    """
+    return hashlib.md5(str(Path(folder_path).resolve()).encode()).hexdigest()[:8]
+
+
+def _get_index_file_path(file_path: str) -> str:
+    # RAW file names are only unique per folder, prefix them with a hash of the folder
+    folder_hash = get_folder_hash(os.path.dirname(file_path))
+    return f'{RAW_INDEX_FOLDER_PATH}{folder_hash}_{os.path.basename(file_path)}.json'
+
+
+def _empty_index(file_path: str, inode: int) -> RawFileIndex:
+    return {
+        'version': RAW_INDEX_VERSION,
+        'file_name': os.path.basename(file_path),
+        'inode': inode,
+        'scanned_bytes': 0,
+        'first_ts': None,
+        'last_ts': None,
+        'first_seq': None,
+        'last_seq': None,
+        'record_counts': {},
+        'checkpoint_ts': [],
+        'checkpoint_offsets': [],
+    }
+
+
+def _read_index(index_file_path: str) -> Optional[RawFileIndex]:
+    if not os.path.isfile(index_file_path):
+        return None
+    try:
+        with open(index_file_path, 'r') as json_file:
+            raw_file_index = json.load(json_file)
+        if raw_file_index.get('version') != RAW_INDEX_VERSION:
+            return None
+        return raw_file_index
+    except (OSError, ValueError) as error:
+        logger.warning(f'Could not read RAW index {index_file_path}, rebuilding... | {error}')
+        return None
+
+
+def _save_index(index_file_path: str, raw_file_index: RawFileIndex):
+    try:
+        os.makedirs(RAW_INDEX_FOLDER_PATH, exist_ok=True)
+        # Write to a temporary file first so concurrent jobs never read a partial index
+        tmp_file_path = f'{index_file_path}.{os.getpid()}.tmp'
+        with open(tmp_file_path, 'w') as json_file:
+            json.dump(raw_file_index, json_file)
+        os.replace(tmp_file_path, index_file_path)
+    except OSError as error:
+        logger.warning(f'Could not save RAW index {index_file_path} | {error}')
+
+
+def _get_type_ts(data: bytes) -> Tuple[Optional[str], Optional[int]]:
+    # Only the type & ts are indexed, skip decoding the piezo channels
+    try:
+        return peek_type_ts(data)
+    except CBORPeekError:
+        decoded_data = cbor2.loads(data)
+        return decoded_data.get('type'), decoded_data.get('ts')
+
+
+def _scan_raw_file(file_path: str, raw_file_index: RawFileIndex):
+    """
+    Reads the records appended after `scanned_bytes` and adds them to the index
+    """
+    record_counts = raw_file_index['record_counts']
+    checkpoint_ts = raw_file_index['checkpoint_ts']
+    checkpoint_offsets = raw_file_index['checkpoint_offsets']
+
+    with RawFileReader(file_path) as reader:
+        # Stops before a trailing record that is still being written
+        for offset, next_offset, seq, data in reader.iter_records(raw_file_index['scanned_bytes']):
+            # The outer record was complete, so the scan moves past it even when its payload can't be decoded
+            raw_file_index['scanned_bytes'] = next_offset
+            try:
+                record_type, ts = _get_type_ts(data)
+            except Exception as error:
+                logger.error(f'Error indexing {file_path} @ byte {offset:,}, skipping the record | {error}')
+                continue
+
+            record_counts[record_type] = record_counts.get(record_type, 0) + 1
+
+            if seq is not None:
+                if raw_file_index['first_seq'] is None:
+                    raw_file_index['first_seq'] = seq
+                raw_file_index['last_seq'] = seq
+
+            if ts is None:
+                continue
+            if raw_file_index['first_ts'] is None or ts < raw_file_index['first_ts']:
+                raw_file_index['first_ts'] = ts
+            if raw_file_index['last_ts'] is None or ts > raw_file_index['last_ts']:
+                raw_file_index['last_ts'] = ts
+
+            if len(checkpoint_ts) == 0 or ts >= checkpoint_ts[-1] + CHECKPOINT_INTERVAL_SECONDS:
+                checkpoint_ts.append(ts)
+                checkpoint_offsets.append(offset)
+
+
+def _peek_first_ts(file_path: str) -> Optional[int]:
+    try:
+        with RawFileReader(file_path) as reader:
+            for _, _, _, data in reader.iter_records():
+                _, ts = _get_type_ts(data)
+                if ts is not None:
+                    return ts
+    except Exception:
+        return None
+    return None
+
+
+def get_raw_file_index(file_path: str) -> RawFileIndex:
+    """
+    Loads the index of a RAW file, building it if missing and refreshing it if the file grew.
+    """
+    stat = os.stat(file_path)
+    index_file_path = _get_index_file_path(file_path)
+    raw_file_index = _read_index(index_file_path)
+
+    if raw_file_index is None or raw_file_index['inode'] != stat.st_ino or stat.st_size < raw_file_index['scanned_bytes']:
+        raw_file_index = _empty_index(file_path, stat.st_ino)
+    elif stat.st_size == raw_file_index['scanned_bytes']:
+        return raw_file_index
+
+    scanned_bytes = raw_file_index['scanned_bytes']
+    try:
+        _scan_raw_file(file_path, raw_file_index)
+    except OSError:
+        logger.error(traceback.format_exc())
+    if raw_file_index['scanned_bytes'] != scanned_bytes:
+        _save_index(index_file_path, raw_file_index)
+    return raw_file_index
+
+
+def get_seek_range(file_path: str, start_epoch: float, end_epoch: float) -> Optional[Tuple[int, Optional[int], int]]:
+    """
+    Returns the (start_offset, end_offset, start_ts) byte range of a RAW file holding the records between
+    start_epoch & end_epoch, end_offset is None when the range runs until the end of the file.
+    start_ts is the ts of the record at start_offset, used to read files in timestamp order.
+
+    Returns None if the file does not overlap the time range.
+    """
+    # A file that was last written before the range starts cannot hold any records in range
+    if os.path.getmtime(file_path) < start_epoch:
+        return None
+
+    # Avoid indexing files that only start after the range, reading the first record is enough
+    if not os.path.isfile(_get_index_file_path(file_path)):
+        first_ts = _peek_first_ts(file_path)
+        if first_ts is not None and first_ts > end_epoch:
+            return None
+
+    raw_file_index = get_raw_file_index(file_path)
+    if raw_file_index['first_ts'] is None:
+        return None
+    if raw_file_index['last_ts'] < start_epoch or raw_file_index['first_ts'] > end_epoch:
+        return None
+
+    checkpoint_ts = raw_file_index['checkpoint_ts']
+    checkpoint_offsets = raw_file_index['checkpoint_offsets']
+
+    # Last checkpoint starting at or before start_epoch
+    start_checkpoint = max(bisect_right(checkpoint_ts, start_epoch) - 1, 0)
+    # First checkpoint starting after end_epoch
+    end_checkpoint = bisect_right(checkpoint_ts, end_epoch)
+
+    start_offset = checkpoint_offsets[start_checkpoint]
+    end_offset = checkpoint_offsets[end_checkpoint] if end_checkpoint < len(checkpoint_offsets) else None
+    return start_offset, end_offset, checkpoint_ts[start_checkpoint]
+
+
+def prune_raw_indexes(folder_path: str, file_paths: List[str]):
+    """
+    Deletes the indexes of RAW files in folder_path which no longer exist
+    """
+    if not os.path.isdir(RAW_INDEX_FOLDER_PATH):
+        return
+    current_index_file_names = {os.path.basename(_get_index_file_path(file_path)) for file_path in file_paths}
+    folder_hash = get_folder_hash(folder_path)
+    for index_file_name in os.listdir(RAW_INDEX_FOLDER_PATH):
+        if index_file_name.startswith(folder_hash) and index_file_name not in current_index_file_names:
+            try:
+                os.remove(f'{RAW_INDEX_FOLDER_PATH}{index_file_name}')
+            except OSError:
+                pass
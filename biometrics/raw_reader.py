@@ -0,0 +1,101 @@
+"""
+This module defines `RawFileReader`, a memory-mapped reader for `.RAW` files.
+
+Instead of pulling every record through a file object with `cbor2.load` (which copies the
+whole inner payload into a new `bytes` object), the file is mapped once and record boundaries
+are located in place. Each record's inner payload is handed out as a `memoryview` into the
+mapping, `raw_cbor.read_fields(..., copy=False)` then turns piezo channels into `np.frombuffer`
+views without any copy.
+
+Key functionalities:
+- Iterates the complete records of a file between two byte offsets, a trailing record still
+  being written is left for the next read.
+- `remap()` maps the bytes appended since the previous call, used by the stream to tail the
+  active file.
+- Views into the mapping keep it alive, `close()` only unmaps once no view is left, callers
+  copy the arrays they keep past the file's lifetime.
+
+Usage:
+with RawFileReader(file_path) as reader:
+    for record_start, record_end, seq, data in reader.iter_records(start_offset, end_offset):
+        record_type, ts = raw_cbor.peek_type_ts(data)
+"""
+from typing import Iterator, Optional, Tuple
+import mmap
+import os
+
+from get_logger import get_logger
+from raw_cbor import CBORPeekError, CBORTruncatedError, read_outer_record
+
+logger = get_logger()
+
+
+class RawFileReader:
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.size = 0
+        self._file = open(file_path, 'rb')
+        self._mmap: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+        self.remap()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _unmap(self):
+        self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Arrays still point into the mapping, it's unmapped once they're garbage collected
+                pass
+            self._mmap = None
+
+    def remap(self) -> bool:
+        """
+        Maps the current size of the file, returns True if the file size changed since the last call
+        """
+        size = os.fstat(self._file.fileno()).st_size
+        if size == self.size and (self._mmap is not None or size == 0):
+            return False
+        self._unmap()
+        if size > 0:
+            # Empty files can't be mapped
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+            # The file may have grown since fstat
+            size = len(self._mmap)
+        self.size = size
+        return True
+
+    def iter_records(self, start_offset=0, end_offset: Optional[int] = None) -> Iterator[Tuple[int, int, Optional[int], memoryview]]:
+        """
+        Yields (record start, record end, seq, data) for every complete record starting between
+        start_offset & end_offset, data is a view into the mapping.
+        """
+        view = self._view
+        if view is None:
+            return
+        if end_offset is None or end_offset > self.size:
+            end_offset = self.size
+
+        pos = start_offset
+        while pos < end_offset:
+            try:
+                seq, data_start, data_end, next_pos = read_outer_record(view, pos)
+            except CBORTruncatedError:
+                # The last record is still being written
+                return
+            except CBORPeekError as error:
+                logger.error(f'Error reading {self.file_path} @ byte {pos:,} | {error}')
+                return
+            yield pos, next_pos, seq, view[data_start:data_end]
+            pos = next_pos
+
+    def close(self):
+        self._unmap()
+        self._file.close()
@@ -12,6 +12,21 @@ def get_memory_usage_unix():
     else:
         return 0
 
+def get_peak_memory_usage_unix():
+    """
+    Returns the peak resident set size (VmHWM) of the current process in MB (Linux only).
+    """
+    if platform.system().lower() == 'linux':
+        with open(f'/proc/{os.getpid()}/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    # Value in KB
+                    return int(line.split()[1]) / 1024
+        return 0
+    else:
+        return 0
+
+
 def get_free_memory_mb():
     """
     Returns the free memory in MB by reading /proc/meminfo (Linux only).
@@ -65,6 +65,13 @@ def _parse_args() -> Namespace:
         required=True,
         help="End time in UTC format 'YYYY-MM-DD HH:MM:SS'."
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of processes decoding the RAW files in parallel, uses more memory (default: 1)."
+    )
 
     # Parse arguments
     args = parser.parse_args()
@@ -92,6 +99,7 @@ if __name__ == "__main__":
                 side="right",
                 start_time=datetime.strptime(f'{date} 07:00:00', '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc),
                 end_time=datetime.strptime(f'{date} 15:00:00', '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc),
+                workers=1,
             )
 
 
@@ -99,7 +107,8 @@ if __name__ == "__main__":
             args.side,
             args.start_time,
             args.end_time,
-            FOLDER_PATH
+            FOLDER_PATH,
+            workers=args.workers,
         )
 
         logger.debug(f"END Memory Usage: {get_memory_usage_unix():.2f} MB")
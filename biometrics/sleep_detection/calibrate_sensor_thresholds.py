@@ -35,14 +35,15 @@ from get_logger import get_logger
 logger = get_logger('calibrate-sensor')
 
 from data_types import *
-from load_raw_files import load_raw_files
-from piezo_data import load_piezo_df, detect_presence_piezo, identify_baseline_period
-from cap_data import load_cap_df, create_cap_baseline_from_cap_df, save_baseline
+from feature_cache import load_feature_frames
+from load_raw_files import iter_raw_records, load_raw_frames
+from piezo_data import PiezoDfBuilder, load_piezo_df, detect_presence_piezo, identify_baseline_period
+from cap_data import CapDfBuilder, load_cap_df, create_cap_baseline_from_cap_df, save_baseline
 from resource_usage import get_memory_usage_unix, get_available_memory_mb
 from biometrics_helpers import validate_datetime_utc
 
 
-def _parse_args() -> Union[Namespace, None]:
+def _parse_args() -> Namespace:
     # Argument parser setup
     parser = ArgumentParser(description="Process presence intervals with UTC datetime.")
 
@@ -65,11 +66,20 @@ def _parse_args() -> Union[Namespace, None]:
         required=False,
         help="End time in UTC format 'YYYY-MM-DD HH:MM:SS'."
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of processes decoding the RAW files in parallel, uses more memory (default: 1)."
+    )
 
     # Parse arguments
     args = parser.parse_args()
     if args.start_time is None or args.end_time is None or args.side is None:
-        return None
+        # Calibrate both sides over the last 14 hours
+        args.side = None
+        return args
     # Validate that start_time is before end_time
     if args.start_time >= args.end_time:
         raise ValueError("--start_time must be earlier than --end_time")
@@ -77,20 +87,34 @@ def _parse_args() -> Union[Namespace, None]:
     return args
 
 
-def calibrate_sensor_thresholds(side: Side, start_time: datetime, end_time: datetime, folder_path: str):
+def calibrate_sensor_thresholds(side: Side, start_time: datetime, end_time: datetime, folder_path: str, workers=1, use_feature_cache=True):
     expected_row_count = int((end_time - start_time).total_seconds())
     logger.debug(f"Calibrating sensors for {side} side | {start_time.isoformat()} -> {end_time.isoformat()} | Expected row count: {expected_row_count:,}")
 
-    data = load_raw_files(
-        folder_path,
-        start_time,
-        end_time,
-        side,
-        sensor_count=1,
-        raw_data_types=['capSense', 'piezo-dual']
-    )
+    if use_feature_cache:
+        # Only the bytes appended since the previous run are decoded, the rest comes from the feature cache
+        feature_frames = load_feature_frames(folder_path, start_time, end_time, side, workers=workers)
+        piezo_df = load_piezo_df(feature_frames['piezo'], side, expected_row_count=expected_row_count)
+        cap_df = load_cap_df(feature_frames['cap'], side, expected_row_count=expected_row_count)
+        del feature_frames
+    elif workers > 1:
+        # Decode the RAW files in parallel, trades memory for speed as the frames hold the whole range
+        raw_frames = load_raw_frames(folder_path, start_time, end_time, side, sensor_count=1, raw_data_types=['capSense', 'piezo-dual'], workers=workers)
+        piezo_df = load_piezo_df(raw_frames['piezo_dual'], side, expected_row_count=expected_row_count)
+        cap_df = load_cap_df(raw_frames['cap_senses'], side, expected_row_count=expected_row_count)
+        del raw_frames
+    else:
+        # Fold records into the dataframes as they are decoded instead of holding the whole range in memory
+        piezo_df_builder = PiezoDfBuilder(side)
+        cap_df_builder = CapDfBuilder(side)
+        for record in iter_raw_records(folder_path, start_time, end_time, ['capSense', 'piezo-dual'], side, sensor_count=1, copy=False, epoch_ts=True):
+            if record['type'] == 'piezo-dual':
+                piezo_df_builder.add(record)
+            else:
+                cap_df_builder.add(record)
+        piezo_df = piezo_df_builder.build(expected_row_count=expected_row_count)
+        cap_df = cap_df_builder.build(expected_row_count=expected_row_count)
 
-    piezo_df = load_piezo_df(data, side, expected_row_count=expected_row_count)
     detect_presence_piezo(
         piezo_df,
         side,
@@ -101,11 +125,6 @@ def calibrate_sensor_thresholds(side: Side, start_time: datetime, end_time: date
         clean=False
     )
 
-    cap_df = load_cap_df(data, side, expected_row_count=expected_row_count)
-    # Cleanup data
-    del data
-    gc.collect()
-
     merged_df = piezo_df.merge(cap_df, on='ts', how='inner')
     # Free up memory from old dfs
     piezo_df.drop(piezo_df.index, inplace=True)
@@ -125,7 +144,7 @@ def calibrate_sensor_thresholds(side: Side, start_time: datetime, end_time: date
     gc.collect()
 
 
-def calibrate_both_sides():
+def calibrate_both_sides(workers=1):
     end_time = datetime.now(timezone.utc)
     start_time = end_time - timedelta(hours=14)
     logger.info(
@@ -136,12 +155,14 @@ def calibrate_both_sides():
         start_time,
         end_time,
         FOLDER_PATH,
+        workers=workers,
     )
     calibrate_sensor_thresholds(
         'right',
         start_time,
         end_time,
         FOLDER_PATH,
+        workers=workers,
     )
 
 
@@ -162,16 +183,18 @@ if __name__ == "__main__":
                 side="right",
                 start_time=datetime.strptime(f'{date} 07:00:00', '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc),
                 end_time=datetime.strptime(f'{date} 15:00:00', '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc),
+                workers=1,
             )
 
-        if args is None:
-            calibrate_both_sides()
+        if args.side is None:
+            calibrate_both_sides(workers=args.workers)
         else:
             calibrate_sensor_thresholds(
                 args.side,
                 args.start_time,
                 args.end_time,
                 FOLDER_PATH,
+                workers=args.workers,
             )
     except KeyboardInterrupt:
         logger.info('Keyboard interrupt signal received, exiting...')
@@ -10,7 +10,8 @@ Key functionalities:
 - Uses efficient vectorized operations for fast presence detection.
 
 Usage:
-- Use `load_cap_df(data, side)` to load raw capacitance sensor data.
+- Use `load_cap_df(data, side)` to load raw capacitance sensor data (a `Data` dict or a `CapFrame`).
+- Use `load_cap_df_chunked(records, side)` or `CapDfBuilder` to fold capacitance records as they are decoded.
 - Use `create_cap_baseline_from_cap_df(merged_df, start_time, end_time, side)` to establish a baseline.
 - Use `detect_presence_cap(merged_df, cap_baseline, side)` to determine presence intervals.
 """
@@ -20,8 +21,11 @@ import json
 import math
 import pandas as pd
 from datetime import datetime
+from typing import Iterable
 from data_types import *
 from get_logger import get_logger
+from cap_frame import CapFrame
+from biometrics_helpers import ts_to_datetime
 
 logger = get_logger()
 
@@ -75,19 +79,10 @@ Run `python3 calibrate_sensor_thresholds.py --side=right --start_time="2025-02-0
 ''')
 
 
-def load_cap_df(data: Data, side: Side, expected_row_count=None) -> pd.DataFrame:
-    logger.debug('Loading cap df...')
-    df = pd.DataFrame(data['cap_senses'], columns=['ts', side])
-
-    df[f'{side}_out'] = df[side].str['out']
-    df[f'{side}_cen'] = df[side].str['cen']
-    df[f'{side}_in'] = df[side].str['in']
-
-    df.drop(columns=[side], inplace=True)
-
+def _index_cap_df(df: pd.DataFrame, expected_row_count=None) -> pd.DataFrame:
     # Sort, parse, set index in one pass
     df.sort_values('ts', inplace=True)
-    df['ts'] = pd.to_datetime(df['ts'])
+    df['ts'] = ts_to_datetime(df['ts'])
     df.set_index('ts', inplace=True)
     logger.debug(f'Capacitance rows loaded: {df.shape[0]:,}')
     if expected_row_count is not None:
@@ -99,6 +94,77 @@ def load_cap_df(data: Data, side: Side, expected_row_count=None) -> pd.DataFrame
     return df
 
 
+def load_cap_df(data: Union[Data, CapFrame], side: Side, expected_row_count=None) -> pd.DataFrame:
+    logger.debug('Loading cap df...')
+    if isinstance(data, CapFrame):
+        # Columnar input, the sensor columns are already split out
+        df = pd.DataFrame({
+            'ts': pd.to_datetime(data.epochs, unit='s'),
+            f'{side}_out': data.channel(f'{side}_out'),
+            f'{side}_cen': data.channel(f'{side}_cen'),
+            f'{side}_in': data.channel(f'{side}_in'),
+        })
+        return _index_cap_df(df, expected_row_count=expected_row_count)
+
+    df = pd.DataFrame(data['cap_senses'], columns=['ts', side])
+
+    df[f'{side}_out'] = df[side].str['out']
+    df[f'{side}_cen'] = df[side].str['cen']
+    df[f'{side}_in'] = df[side].str['in']
+
+    df.drop(columns=[side], inplace=True)
+    return _index_cap_df(df, expected_row_count=expected_row_count)
+
+
+class CapDfBuilder:
+    """
+    Folds capSense records into the columns of `load_cap_df` as they arrive, `chunk_size` records at a time.
+    """
+
+    def __init__(self, side: Side, chunk_size=900):
+        self.side = side
+        self.chunk_size = chunk_size
+        self.pending: List[CapSenseData] = []
+        self.chunks: List[pd.DataFrame] = []
+
+    def add(self, cap_record: CapSenseData):
+        self.pending.append(cap_record)
+        if len(self.pending) >= self.chunk_size:
+            self._fold()
+
+    def _fold(self):
+        if not self.pending:
+            return
+        side = self.side
+        self.chunks.append(pd.DataFrame({
+            'ts': [record['ts'] for record in self.pending],
+            f'{side}_out': [record[side]['out'] for record in self.pending],
+            f'{side}_cen': [record[side]['cen'] for record in self.pending],
+            f'{side}_in': [record[side]['in'] for record in self.pending],
+        }))
+        self.pending = []
+
+    def build(self, expected_row_count=None) -> pd.DataFrame:
+        logger.debug('Loading cap df...')
+        self._fold()
+        if self.chunks:
+            df = pd.concat(self.chunks, ignore_index=True)
+        else:
+            df = pd.DataFrame(columns=['ts', f'{self.side}_out', f'{self.side}_cen', f'{self.side}_in'])
+        self.chunks = []
+        return _index_cap_df(df, expected_row_count=expected_row_count)
+
+
+def load_cap_df_chunked(cap_records: Iterable[CapSenseData], side: Side, expected_row_count=None, chunk_size=900) -> pd.DataFrame:
+    """
+    Chunked variant of `load_cap_df` consuming a record iterator (see `load_raw_files.iter_raw_records`)
+    """
+    builder = CapDfBuilder(side, chunk_size=chunk_size)
+    for cap_record in cap_records:
+        builder.add(cap_record)
+    return builder.build(expected_row_count=expected_row_count)
+
+
 def detect_presence_cap(
         merged_df: pd.DataFrame,
         cap_baseline,
@@ -17,10 +17,11 @@ from datetime import datetime, timedelta
 
 from data_types import *
 from db import insert_sleep_records
-from sleep_detection.cap_data import load_cap_df, load_baseline, detect_presence_cap
+from sleep_detection.cap_data import CapDfBuilder, load_cap_df, load_baseline, detect_presence_cap
 from get_logger import get_logger
-from load_raw_files import load_raw_files
-from piezo_data import load_piezo_df, detect_presence_piezo
+from feature_cache import load_feature_frames
+from load_raw_files import iter_raw_records, load_raw_frames
+from piezo_data import PiezoDfBuilder, load_piezo_df, detect_presence_piezo
 
 logger = get_logger()
 
@@ -199,17 +200,33 @@ def build_sleep_records(merged_df: pd.DataFrame, side: Side, max_gap_in_minutes:
     return sleep_records
 
 
-def detect_sleep(side: Side, start_time: datetime, end_time: datetime, folder_path: str) -> List[SleepRecord]:
+def detect_sleep(side: Side, start_time: datetime, end_time: datetime, folder_path: str, workers=1, use_feature_cache=True) -> List[SleepRecord]:
     expected_row_count = int((end_time - start_time).total_seconds())
     logger.info(f"Detecting sleep interval for {side} side | {start_time.isoformat()} -> {end_time.isoformat()} | Expected row count: {expected_row_count:,}")
 
-    data = load_raw_files(folder_path, start_time, end_time, side, sensor_count=1, raw_data_types=['capSense', 'piezo-dual'])
-
-    piezo_df = load_piezo_df(data, side, expected_row_count=expected_row_count)
-    cap_df = load_cap_df(data, side, expected_row_count=expected_row_count)
-    # Cleanup data
-    del data
-    gc.collect()
+    if use_feature_cache:
+        # Only the bytes appended since the previous run are decoded, the rest comes from the feature cache
+        feature_frames = load_feature_frames(folder_path, start_time, end_time, side, workers=workers)
+        piezo_df = load_piezo_df(feature_frames['piezo'], side, expected_row_count=expected_row_count)
+        cap_df = load_cap_df(feature_frames['cap'], side, expected_row_count=expected_row_count)
+        del feature_frames
+    elif workers > 1:
+        # Decode the RAW files in parallel, trades memory for speed as the frames hold the whole night
+        raw_frames = load_raw_frames(folder_path, start_time, end_time, side, sensor_count=1, raw_data_types=['capSense', 'piezo-dual'], workers=workers)
+        piezo_df = load_piezo_df(raw_frames['piezo_dual'], side, expected_row_count=expected_row_count)
+        cap_df = load_cap_df(raw_frames['cap_senses'], side, expected_row_count=expected_row_count)
+        del raw_frames
+    else:
+        # Fold records into the dataframes as they are decoded instead of holding the whole night in memory
+        piezo_df_builder = PiezoDfBuilder(side)
+        cap_df_builder = CapDfBuilder(side)
+        for record in iter_raw_records(folder_path, start_time, end_time, ['capSense', 'piezo-dual'], side, sensor_count=1, copy=False, epoch_ts=True):
+            if record['type'] == 'piezo-dual':
+                piezo_df_builder.add(record)
+            else:
+                cap_df_builder.add(record)
+        piezo_df = piezo_df_builder.build(expected_row_count=expected_row_count)
+        cap_df = cap_df_builder.build(expected_row_count=expected_row_count)
 
     detect_presence_piezo(
         piezo_df,
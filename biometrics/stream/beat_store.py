@@ -0,0 +1,125 @@
+"""
+Rolling store of the heart beats found by the per-second heart rate measurements of one side, HRV is calculated
+from it instead of running heartpy on the whole `hrv_window_seconds` signal.
+
+Key functionalities:
+- `add` keeps the peaks of the middle second of every heart rate window, each second is the middle second of exactly
+  one window and is furthest from the filter & peak detection edge effects there. Peaks closer than
+  `min_beat_distance_seconds` to the previous beat are duplicates found at the boundary of two seconds.
+- A skipped second (no presence, catch-up, unusable signal) starts a new segment, no RR interval spans it.
+- `get_measurement` cleans the RR intervals like heartpy's `check_peaks` & `quotient_filter` and returns
+  sdnn, rmssd & pnn50 in O(beats).
+
+Usage:
+    beat_store = BeatStore(window_seconds=300)
+    beat_store.add(epoch, measurement['peaklist'])
+    hrv_measurement = beat_store.get_measurement()
+"""
+from collections import deque
+from typing import Deque, Optional, Tuple
+import numpy as np
+
+from data_types import *
+
+
+class BeatStore:
+    def __init__(self, window_seconds=300, heart_rate_window_seconds=3, sample_rate=500, min_beat_distance_seconds=0.3, min_rr_intervals=30):
+        self.window_seconds = window_seconds
+        self.heart_rate_window_seconds = heart_rate_window_seconds
+        self.sample_rate = sample_rate
+        self.min_beat_distance = int(min_beat_distance_seconds * sample_rate)
+        self.min_rr_intervals = min_rr_intervals
+
+        self.beats: Deque[int] = deque()  # Sample index since the epoch of every beat, oldest first
+        self.segments: Deque[int] = deque()  # Segment of every beat, RR intervals are only taken within a segment
+        self.segment = 0
+        self.last_epoch: Optional[int] = None
+
+    def add(self, epoch: int, peaklist: Optional[np.ndarray]):
+        """
+        Adds the peaks of the middle second of the heart rate window ending with the record of epoch,
+        peaklist holds sample indexes in that window or None when it couldn't be measured
+        """
+        if peaklist is None:
+            return
+        if self.last_epoch is None or epoch != self.last_epoch + 1:
+            self.segment += 1
+        self.last_epoch = epoch
+
+        middle_second = epoch - self.heart_rate_window_seconds // 2
+        window_start = (epoch - self.heart_rate_window_seconds + 1) * self.sample_rate
+        middle_start = middle_second * self.sample_rate
+        for peak in np.asarray(peaklist):
+            beat = window_start + int(peak)
+            if not middle_start <= beat < middle_start + self.sample_rate:
+                continue
+            if self.beats and self.segments[-1] == self.segment and beat - self.beats[-1] < self.min_beat_distance:
+                continue
+            self.beats.append(beat)
+            self.segments.append(self.segment)
+
+        oldest = (middle_second + 1 - self.window_seconds) * self.sample_rate
+        while self.beats and self.beats[0] < oldest:
+            self.beats.popleft()
+            self.segments.popleft()
+
+    def get_rr_intervals(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the RR intervals in ms & their mask (1 = rejected), cleaned like `check_peaks` & `quotient_filter`
+        """
+        beats = np.fromiter(self.beats, dtype=np.int64, count=len(self.beats))
+        segments = np.fromiter(self.segments, dtype=np.int64, count=len(self.segments))
+        rr_list = np.diff(beats) / self.sample_rate * 1000.0
+        # Intervals across a skipped second are no RR intervals
+        across_gap = segments[1:] != segments[:-1]
+        if len(rr_list) == 0 or across_gap.all():
+            return rr_list, np.ones(len(rr_list), dtype=np.int64)
+
+        # check_peaks: beats after an interval outside mean ± max(300ms, 30%) are removed,
+        # which rejects that interval & the next one
+        mean_rr = np.mean(rr_list[~across_gap])
+        margin = max(0.3 * mean_rr, 300)
+        outlier = ~across_gap & ((rr_list <= mean_rr - margin) | (rr_list >= mean_rr + margin))
+        rr_mask = across_gap | outlier
+        rr_mask[1:] |= outlier[:-1]
+
+        # quotient_filter: an interval is rejected when it differs by more than 20% from the next one, its
+        # second iteration can't reject anything the first didn't
+        ratio = rr_list[:-1] / rr_list[1:]
+        unmasked_pair = ~rr_mask[:-1] & ~rr_mask[1:]
+        rr_mask[:-1] |= unmasked_pair & ((ratio < 0.8) | (ratio > 1.2))
+        return rr_list, rr_mask.astype(np.int64)
+
+    def get_measurement(self) -> Optional[HeartPyMeasurement]:
+        """
+        Returns sdnn, rmssd & pnn50 of the stored beats, None if there are less than min_rr_intervals clean intervals
+        """
+        rr_list, rr_mask = self.get_rr_intervals()
+        rr_list_cor = rr_list[rr_mask == 0]
+        if len(rr_list_cor) < self.min_rr_intervals:
+            return None
+
+        # Successive differences only between adjacent clean intervals, like heartpy's masked `np.diff`
+        adjacent = (rr_mask[:-1] == 0) & (rr_mask[1:] == 0)
+        rr_diff = np.abs(np.diff(rr_list))[adjacent]
+        measurement: HeartPyMeasurement = {
+            'bpm': 60000 / np.mean(rr_list_cor),
+            'sdnn': np.std(rr_list_cor),
+            'rmssd': np.sqrt(np.mean(rr_diff ** 2)) if len(rr_diff) > 0 else np.nan,
+            'pnn50': np.mean(rr_diff > 50.0) if len(rr_diff) > 0 else np.nan,
+        }
+        return measurement
+
+    def get_state(self) -> dict:
+        return {
+            'beats': [int(beat) for beat in self.beats],
+            'segments': [int(segment) for segment in self.segments],
+            'segment': self.segment,
+            'last_epoch': self.last_epoch,
+        }
+
+    def restore_state(self, state: dict):
+        self.beats = deque(state['beats'])
+        self.segments = deque(state['segments'])
+        self.segment = state['segment']
+        self.last_epoch = state['last_epoch']
@@ -19,7 +19,7 @@ with sensor data to process and extract biometric metrics.
 """
 import datetime
 import gc
-from typing import Union, Tuple, TypedDict, List, Optional, Deque
+from typing import Callable, Union, Tuple, TypedDict, List, Optional, Deque
 import traceback
 import numpy as np
 import json
@@ -29,15 +29,111 @@ from get_logger import get_logger
 from heart.exceptions import BadSignalWarning
 from vitals.run_data_types import RuntimeParams
 from vitals.cleaning import interpolate_outliers_in_wave
+from vitals.breathing import BreathingMethod, BreathingRateEngine, decimate_signal, estimate_breathing_rate
 from heart.preprocessing import scale_data
 from heart.filtering import filter_signal, remove_baseline_wander
 from heart.heartpy import process
 from db import insert_vitals
+from beat_store import BeatStore
 from data_types import *
 
 logger = get_logger()
 
 
+def filter_heart_signal(signal: np.ndarray, signal_percentile: Tuple[float, float]) -> np.ndarray:
+    """
+    Interpolates outliers, scales & filters a piezo signal for heartpy
+    """
+    # Remove outliers from signal
+    data = interpolate_outliers_in_wave(
+        signal,
+        lower_percentile=signal_percentile[0],
+        upper_percentile=signal_percentile[1],
+    )
+
+    data = scale_data(data, lower=0, upper=1024)
+    data = remove_baseline_wander(data, sample_rate=500.0, cutoff=0.05)
+
+    return filter_signal(
+        data,
+        cutoff=[0.5, 20.0],
+        sample_rate=500.0,
+        order=2,
+        filtertype='bandpass'
+    )
+
+
+def measure_filtered_signal(
+        data: np.ndarray,
+        window_size: float,
+        calculate_breathing=False,
+        ma_perc_hint: Optional[float] = None,
+        rolling_mean_out: Optional[np.ndarray] = None,
+) -> Optional[HeartPyMeasurement]:
+    """
+    Runs heartpy on a signal of `filter_heart_signal`, returns None if the signal is unusable.
+    ma_perc_hint is the best_ma_perc of the previous window of the channel, see `fit_peaks`.
+    rolling_mean_out is a buffer of len(data) reused for the rolling mean, it isn't referenced by the measurement.
+    """
+    try:
+        working_data, measurement = process(
+            data,
+            500,
+            breathing_method='fft',
+            bpmmin=40,
+            bpmmax=90,
+            windowsize=window_size,
+            calculate_breathing=calculate_breathing,
+            ma_perc_hint=ma_perc_hint,
+            rolling_mean_out=rolling_mean_out,
+            measures_only=True,
+        )
+        measurement['peaklist'] = working_data['peaklist']
+        measurement['best_ma_perc'] = working_data['best_ma_perc']
+        measurement['full_sweep'] = working_data['full_sweep']
+        return measurement
+    except BadSignalWarning:
+        return None
+    except Exception as e:
+        error_message = traceback.format_exc()
+        logger.error(e)
+        logger.error(error_message)
+        return None
+
+
+def measure_signal(
+        signal: np.ndarray,
+        signal_percentile: Tuple[float, float],
+        window_size: float,
+        calculate_breathing=False,
+        ma_perc_hint: Optional[float] = None,
+        rolling_mean_out: Optional[np.ndarray] = None,
+) -> Optional[HeartPyMeasurement]:
+    """
+    Cleans & filters a piezo signal and runs heartpy on it, returns None if the signal is unusable.
+
+    Doesn't read or update any `BiometricProcessor` state, so it can run on a worker thread or process.
+    """
+    try:
+        data = filter_heart_signal(signal, signal_percentile)
+    except Exception as e:
+        error_message = traceback.format_exc()
+        logger.error(e)
+        logger.error(error_message)
+        return None
+    return measure_filtered_signal(data, window_size, calculate_breathing=calculate_breathing, ma_perc_hint=ma_perc_hint, rolling_mean_out=rolling_mean_out)
+
+
+def _to_json_value(value):
+    if isinstance(value, dict):
+        return {key: _to_json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json_value(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
 class BiometricProcessor:
     heart_rates: Deque[float]   # Store last moving_avg_size heart rates (120)
     breath_rates: Deque[float]  # Store last breath rates
@@ -55,6 +151,9 @@ class BiometricProcessor:
             insertion_frequency=60,
             rolling_average_size=25,
             debug=False,
+            persist: Callable[[Measurement], None] = insert_vitals,
+            breathing_method: BreathingMethod = 'heartpy',
+            adaptive_peak_search=False,
     ):
         self.present = False
         self.side = side
@@ -63,6 +162,7 @@ class BiometricProcessor:
         self.iteration_count = 0
         self.rolling_average_size = rolling_average_size
         self.debug = debug
+        self.persist = persist  # Receives the measurement inserted every insertion_frequency seconds
 
         self.heart_rate_window_seconds = 3
         self.breath_rate_window_seconds = 30
@@ -71,6 +171,17 @@ class BiometricProcessor:
         self.hrv_window_seconds = 300
         self.hrv_insertion_frequency = 30
 
+        # 'piezo' estimates the breathing rate from the decimated signal of sensor 1, see `vitals/breathing.py`
+        self.breathing_method = breathing_method
+        self.breathing_engine = BreathingRateEngine(window_seconds=self.breath_rate_window_seconds)
+
+        # The heart rate peak search of each sensor starts from the threshold of its previous window, see `fit_peaks`
+        self.adaptive_peak_search = adaptive_peak_search
+        self.ma_perc_hints: Dict[int, Optional[float]] = {}
+        self.peak_search_count = 0
+        self.full_sweep_count = 0  # Searches which evaluated every threshold, failed ones included
+        self.rolling_mean_buffers: Dict[int, np.ndarray] = {}  # Per sensor, see `get_rolling_mean_buffer`
+
 
         if runtime_params is None:
             runtime_params: RuntimeParams = {
@@ -100,6 +211,52 @@ class BiometricProcessor:
         self.combined_measurements: Deque[Measurement] = deque([], maxlen=100)
         self.debug_measurements: List[Measurement] = []
 
+    def get_state(self) -> dict:
+        """
+        Returns the running state as JSON serializable values, see `restore_state`
+        """
+        return _to_json_value({
+            'present': self.present,
+            'iteration_count': self.iteration_count,
+            'epoch': getattr(self, 'epoch', None),
+            'heart_rates': list(self.heart_rates),
+            'breath_rates': list(self.breath_rates),
+            'hrv_rates': list(self.hrv_rates),
+            'lower_bound': self.lower_bound,
+            'upper_bound': self.upper_bound,
+            'hr_moving_avg': self.hr_moving_avg,
+            'hr_std_2': self.hr_std_2,
+            'breathing_rate': self.breathing_rate,
+            'hrv': self.hrv,
+            'not_present_for': self.not_present_for,
+            'present_for': self.present_for,
+            'combined_measurements': list(self.combined_measurements),
+            'beat_store': self.beat_store.get_state(),
+            'breathing_engine': self.breathing_engine.get_state(),
+        })
+
+    def restore_state(self, state: dict):
+        self.present = state['present']
+        self.iteration_count = state['iteration_count']
+        if state['epoch'] is not None:
+            self.epoch = state['epoch']
+        self.heart_rates = deque(state['heart_rates'], maxlen=self.moving_avg_size)
+        self.breath_rates = deque(state['breath_rates'], maxlen=self.breath_rates.maxlen)
+        self.hrv_rates = deque(state['hrv_rates'], maxlen=self.hrv_rates.maxlen)
+        self.lower_bound = state['lower_bound']
+        self.upper_bound = state['upper_bound']
+        self.hr_moving_avg = state['hr_moving_avg']
+        self.hr_std_2 = state['hr_std_2']
+        self.breathing_rate = state['breathing_rate']
+        self.hrv = state['hrv']
+        self.not_present_for = state['not_present_for']
+        self.present_for = state['present_for']
+        self.combined_measurements = deque(state['combined_measurements'], maxlen=self.combined_measurements.maxlen)
+        if 'beat_store' in state:
+            self.beat_store.restore_state(state['beat_store'])
+        if 'breathing_engine' in state:
+            self.breathing_engine.restore_state(state['breathing_engine'])
+
     def init_tracking(self):
         # Running metrics
         self.heart_rates:  Deque[float] = deque([], maxlen=self.moving_avg_size)
@@ -109,6 +266,11 @@ class BiometricProcessor:
         self.upper_bound = None
         self.hr_moving_avg = None
         self.hr_std_2 = None
+        # Beats of the heart rate measurements of sensor 1, HRV is calculated from them
+        self.beat_store = BeatStore(
+            window_seconds=self.hrv_window_seconds,
+            heart_rate_window_seconds=self.heart_rate_window_seconds,
+        )
 
     def reset(self):
         self.iteration_count = 0
@@ -128,76 +290,63 @@ class BiometricProcessor:
                 self.present_for = 0
                 self.reset()
 
-    def _calculate_vitals(self, signal: np.ndarray, epoch: int, update_breathing=False, update_hrv=False):
-        try:
-            # Remove outliers from signal
-            data = interpolate_outliers_in_wave(
-                signal,
-                lower_percentile=self.signal_percentile[0],
-                upper_percentile=self.signal_percentile[1],
-            )
-
-            data = scale_data(data, lower=0, upper=1024)
-            data = remove_baseline_wander(data, sample_rate=500.0, cutoff=0.05)
-
-            data = filter_signal(
-                data,
-                cutoff=[0.5, 20.0],
-                sample_rate=500.0,
-                order=2,
-                filtertype='bandpass'
-            )
-
-            working_data, measurement = process(
-                data,
-                500,
-                breathing_method='fft',
-                bpmmin=40,
-                bpmmax=90,
-                windowsize=self.window_size,
-                calculate_breathing=update_breathing,
-            )
-            if update_breathing:
-                breathing_rate = measurement.get('breathingrate', 0) * 60
-                if (8 <= breathing_rate <= 20) and not np.isnan(breathing_rate):
-                    self.breath_rates.append(breathing_rate)
-                    breathing_rate = sum(self.breath_rates) / len(self.breath_rates)
-                    if not np.isnan(breathing_rate):
-                        self.breathing_rate = breathing_rate
-
-            if update_hrv:
-                hrv = measurement['sdnn']
-                if (8 <= hrv <= 200) and not np.isnan(hrv):
-                    self.hrv_rates.append(hrv)
-                    hrv = sum(self.hrv_rates) / len(self.hrv_rates)
-
-                    if not np.isnan(hrv):
-                        self.hrv = hrv
-
-
-            if self.is_valid(measurement):
-                return {
-                    'side': self.side,
-                    'timestamp': epoch,
-                    'heart_rate': measurement['bpm'],
-                    'hrv': self.hrv,
-                    'breathing_rate': self.breathing_rate,
-                }
-        except BadSignalWarning:
-            return None
-        except Exception as e:
-            error_message = traceback.format_exc()
-            logger.error(e)
-            logger.error(error_message)
+    def measure(self, signal: np.ndarray, calculate_breathing=False, ma_perc_hint: Optional[float] = None) -> Optional[HeartPyMeasurement]:
+        return measure_signal(signal, self.signal_percentile, self.window_size, calculate_breathing=calculate_breathing, ma_perc_hint=ma_perc_hint)
+
+    def get_ma_perc_hint(self, sensor_number: int) -> Optional[float]:
+        if not self.adaptive_peak_search:
             return None
+        return self.ma_perc_hints.get(sensor_number)
+
+    def get_rolling_mean_buffer(self, sensor_number: int, length: int) -> np.ndarray:
+        """
+        Returns the rolling mean buffer of the heart rate windows of a sensor, only one measurement may use it at a time
+        """
+        buffer = self.rolling_mean_buffers.get(sensor_number)
+        if buffer is None or len(buffer) != length:
+            buffer = np.empty(length)
+            self.rolling_mean_buffers[sensor_number] = buffer
+        return buffer
+
+    def _track_peak_search(self, sensor_number: int, measurement: Optional[HeartPyMeasurement]):
+        if not self.adaptive_peak_search:
+            return
+        self.peak_search_count += 1
+        # A failed search always swept every threshold before giving up
+        if measurement is None or measurement['full_sweep']:
+            self.full_sweep_count += 1
+        self.ma_perc_hints[sensor_number] = None if measurement is None else measurement['best_ma_perc']
+
+    def _to_measurement(self, measurement: Optional[HeartPyMeasurement], epoch: int) -> Optional[Measurement]:
+        if measurement is not None and self.is_valid(measurement):
+            return {
+                'side': self.side,
+                'timestamp': epoch,
+                'heart_rate': measurement['bpm'],
+                'hrv': self.hrv,
+                'breathing_rate': self.breathing_rate,
+            }
+        return None
 
     def calculate_heart_rate(self, epoch: int, signal1: np.ndarray, signal2: Union[None, np.ndarray] = None):
-        self.epoch = epoch
         measurement_2 = None
-        measurement_1 = self._calculate_vitals(signal1, epoch)
+        measurement_1 = self.measure(signal1, ma_perc_hint=self.get_ma_perc_hint(1))
 
         if signal2 is not None:
-            measurement_2 = self._calculate_vitals(signal2, epoch)
+            measurement_2 = self.measure(signal2, ma_perc_hint=self.get_ma_perc_hint(2))
+        self.update_heart_rate(epoch, measurement_1, measurement_2)
+
+    def update_heart_rate(self, epoch: int, heartpy_measurement_1: Optional[HeartPyMeasurement], heartpy_measurement_2: Optional[HeartPyMeasurement] = None):
+        """
+        Applies the measurements of `measure` to the tracked heart rate, see `StreamProcessor` for measuring concurrently
+        """
+        self.epoch = epoch
+        self.beat_store.add(epoch, None if heartpy_measurement_1 is None else heartpy_measurement_1.get('peaklist'))
+        self._track_peak_search(1, heartpy_measurement_1)
+        if self.sensor_count == 2:
+            self._track_peak_search(2, heartpy_measurement_2)
+        measurement_1 = self._to_measurement(heartpy_measurement_1, epoch)
+        measurement_2 = self._to_measurement(heartpy_measurement_2, epoch)
 
         if measurement_1 is not None and measurement_2 is not None:
             m1_heart_rate = measurement_1['heart_rate']
@@ -274,13 +423,13 @@ class BiometricProcessor:
     def next(self):
         self.iteration_count += 1
 
-        # Insert moving average heart rate to DB
-        if self.iteration_count % self.insertion_frequency == 0 and len(self.combined_measurements) > 0:
+        # Insert moving average heart rate to DB, heart_rates is empty after a reset until a window is measured again
+        if self.iteration_count % self.insertion_frequency == 0 and len(self.combined_measurements) > 0 and len(self.heart_rates) > 0:
             heart_rate = np.mean(list(self.heart_rates)[self.rolling_average_size * -1:])
             # Convert last heart rate to average
             self.combined_measurements[-1]['heart_rate'] = heart_rate
             if not self.debug:
-                insert_vitals(self.combined_measurements[-1])
+                self.persist(self.combined_measurements[-1])
             else:
                 last_combined_measurement = list(self.combined_measurements)[-1]
                 ts = datetime.utcfromtimestamp(last_combined_measurement['timestamp']).isoformat()
@@ -316,11 +465,46 @@ class BiometricProcessor:
                 self.hr_std_2 = self.hr_std_range[1]
 
     def calculate_breath_rate(self, signal1: np.ndarray, epoch: int):
-        self._calculate_vitals(signal1, epoch, update_breathing=True)
-
+        if self.breathing_method == 'piezo':
+            self.update_breath_rate({'breathingrate': estimate_breathing_rate(decimate_signal(signal1))})
+            return
+        self.update_breath_rate(self.measure(signal1, calculate_breathing=True))
+
+    def calculate_breath_rate_from_engine(self):
+        """
+        Calculates the breathing rate from the samples passed to `breathing_engine.append`, see `StreamProcessor`
+        """
+        self.update_breath_rate(self.breathing_engine.estimate())
+
+    def update_breath_rate(self, measurement: Optional[HeartPyMeasurement]):
+        if measurement is None:
+            return
+        breathing_rate = measurement.get('breathingrate', 0) * 60
+        if (8 <= breathing_rate <= 20) and not np.isnan(breathing_rate):
+            self.breath_rates.append(breathing_rate)
+            breathing_rate = sum(self.breath_rates) / len(self.breath_rates)
+            if not np.isnan(breathing_rate):
+                self.breathing_rate = breathing_rate
 
     def calculate_hrv(self, signal1: np.ndarray, epoch: int):
-        self._calculate_vitals(signal1, epoch, update_hrv=True)
+        self.update_hrv(self.measure(signal1))
+
+    def calculate_hrv_from_beats(self):
+        """
+        Calculates HRV from the beats of the last hrv_window_seconds of heart rate measurements, see `BeatStore`
+        """
+        self.update_hrv(self.beat_store.get_measurement())
+
+    def update_hrv(self, measurement: Optional[HeartPyMeasurement]):
+        if measurement is None:
+            return
+        hrv = measurement['sdnn']
+        if (8 <= hrv <= 200) and not np.isnan(hrv):
+            self.hrv_rates.append(hrv)
+            hrv = sum(self.hrv_rates) / len(self.hrv_rates)
+
+            if not np.isnan(hrv):
+                self.hrv = hrv
 
 
 
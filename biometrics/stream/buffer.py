@@ -1,9 +1,19 @@
-from collections import deque
-from itertools import islice
+"""
+Keeps the last seconds of every piezo channel for `StreamProcessor`.
+
+Every channel is a preallocated int32 ring of `buffer_size` records which is mirrored, each record is written
+to row `i` and `i + buffer_size`, so any trailing window of up to `buffer_size` records is one contiguous slice.
+Appends copy the 500 samples of each channel twice and window reads are views without any allocation.
+
+The views are only valid until the next `append` overwrites their rows, consumers must use or copy them
+before then (`interpolate_outliers_in_wave` copies its input).
+"""
 from data_types import *
-from typing import Deque
+from typing import Dict, List, Optional
 import numpy as np
 
+PIEZO_CHANNELS = ['left1', 'left2', 'right1', 'right2']
+
 
 class Buffer:
     def __init__(
@@ -13,24 +23,65 @@ class Buffer:
             hrv_window_seconds,
     ):
         self.heart_rate_window_seconds = heart_rate_window_seconds
-        self.heart_rate_buffer = deque([], maxlen=self.heart_rate_window_seconds)
-
         self.breath_rate_window_seconds = breath_rate_window_seconds
         self.hrv_window_seconds = hrv_window_seconds
-        self.buffer_size = max(breath_rate_window_seconds, hrv_window_seconds)
+        self.buffer_size = max(heart_rate_window_seconds, breath_rate_window_seconds, hrv_window_seconds)
 
-        self.piezo_buffer: Deque[PiezoDualData] = deque([], maxlen=self.buffer_size)
+        # Allocated on the first record, once the channels & samples per record are known
+        self.rings: Dict[str, np.ndarray] = {}
+        self.samples_per_record: Optional[int] = None
+        self.write_index = 0  # Row the next record is written to, in [0, buffer_size)
+        self.count = 0  # Number of records buffered, at most buffer_size
 
+    def _allocate(self, channels: List[str], samples_per_record: int):
+        self.samples_per_record = samples_per_record
+        for channel in channels:
+            self.rings[channel] = np.zeros((2 * self.buffer_size, samples_per_record), dtype=np.int32)
 
     def append(self, piezo_record: PiezoDualData):
-        self.heart_rate_buffer.append(piezo_record)
-        self.piezo_buffer.append(piezo_record)
+        if self.samples_per_record is None:
+            self._allocate([channel for channel in PIEZO_CHANNELS if channel in piezo_record], len(piezo_record['left1']))
+
+        for channel, ring in self.rings.items():
+            samples = piezo_record[channel]
+            ring[self.write_index] = samples
+            ring[self.write_index + self.buffer_size] = samples
+
+        self.write_index = (self.write_index + 1) % self.buffer_size
+        self.count = min(self.count + 1, self.buffer_size)
+
+    def _get_window(self, channel: str, length: int) -> np.ndarray:
+        length = min(length, self.count)
+        end = self.write_index + self.buffer_size
+        window = self.rings[channel][end - length:end].reshape(-1)
+        window.flags.writeable = False
+        return window
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        """
+        Returns a copy of the buffered records of every channel, oldest first, as (records, samples) arrays
+        """
+        if self.samples_per_record is None:
+            return {}
+        end = self.write_index + self.buffer_size
+        return {channel: ring[end - self.count:end].copy() for channel, ring in self.rings.items()}
 
-    def get_heart_rate_signal(self, side: Side, sensor_number: Literal[1,2]) -> np.ndarray:
-        return np.concatenate([entry[f"{side}{sensor_number}"] for entry in self.heart_rate_buffer])
+    def restore_state(self, windows: Dict[str, np.ndarray]):
+        """
+        Refills the buffer from `get_state`, the newest buffer_size records are kept
+        """
+        if len(windows) == 0:
+            return
+        record_count, samples_per_record = next(iter(windows.values())).shape
+        self.rings = {}
+        self.write_index = 0
+        self.count = 0
+        self._allocate(list(windows.keys()), samples_per_record)
+        for row in range(max(record_count - self.buffer_size, 0), record_count):
+            self.append({channel: window[row] for channel, window in windows.items()})
 
+    def get_heart_rate_signal(self, side: Side, sensor_number: Literal[1, 2]) -> np.ndarray:
+        return self._get_window(f'{side}{sensor_number}', self.heart_rate_window_seconds)
 
     def get_signal(self, side: Side, length: int) -> np.ndarray:
-        return np.concatenate([
-            entry[f'{side}1'] for entry in islice(self.piezo_buffer, len(self.piezo_buffer) - length, len(self.piezo_buffer))
-        ])
+        return self._get_window(f'{side}1', length)
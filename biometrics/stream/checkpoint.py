@@ -0,0 +1,119 @@
+"""
+Snapshots of the stream service's processing state, so a restarted `free-sleep-stream` resumes warm instead of
+waiting minutes for its buffers, heart rate bounds & HRV window to fill again.
+
+Key functionalities:
+- `Checkpointer.maybe_save` snapshots `StreamProcessor.get_state()` (ring buffers & the running state of both
+  `BiometricProcessor`s) every `interval_seconds` of records while someone is in bed. Only the arrays are copied
+  on the processing thread, the `.npz` is written on a background thread.
+- The snapshot holds the ts of the last processed record, on restart the tailer seeks straight to it with the
+  RAW file index & the records written in the meantime are buffered in catch-up mode, the buffers stay contiguous.
+- `load_checkpoint` ignores snapshots older than `max_age_seconds`, written by another version or unreadable.
+
+Usage:
+    checkpoint = load_checkpoint(time.time())
+    checkpointer = Checkpointer()
+    checkpointer.maybe_save(stream_processor, piezo_record['ts'])
+"""
+import json
+import os
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, TypedDict
+
+import numpy as np
+
+from get_logger import get_logger
+
+logger = get_logger()
+
+CHECKPOINT_FILE_PATH = f'{logger.folder_path}stream_checkpoint.npz'
+CHECKPOINT_VERSION = 1
+# Records since the snapshot are re-read in catch-up mode on restart, older snapshots start cold
+MAX_CHECKPOINT_AGE_SECONDS = 15 * 60
+
+
+class StreamCheckpoint(TypedDict):
+    version: int
+    ts: int  # ts of the last record processed before the snapshot
+    saved_at: float
+    stream_processor: dict  # StreamProcessor.get_state()
+
+
+def save_checkpoint(checkpoint: StreamCheckpoint, buffer_windows: Dict[str, np.ndarray], file_path: str = CHECKPOINT_FILE_PATH):
+    try:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Write to a temporary file first so a restart never reads a partial snapshot
+        tmp_file_path = f'{file_path}.tmp.npz'
+        np.savez(
+            tmp_file_path,
+            checkpoint=np.array(json.dumps(checkpoint)),
+            **{f'buffer_{channel}': window for channel, window in buffer_windows.items()},
+        )
+        os.replace(tmp_file_path, file_path)
+    except Exception as e:
+        logger.error(e)
+        logger.error(traceback.format_exc())
+
+
+def load_checkpoint(now: float, max_age_seconds: float = MAX_CHECKPOINT_AGE_SECONDS, file_path: str = CHECKPOINT_FILE_PATH) -> Optional[Tuple[StreamCheckpoint, Dict[str, np.ndarray]]]:
+    """
+    Returns the snapshot & its buffered signals, or None if there's no usable snapshot
+    """
+    if not os.path.isfile(file_path):
+        return None
+    try:
+        with np.load(file_path, allow_pickle=False) as data:
+            checkpoint: StreamCheckpoint = json.loads(str(data['checkpoint']))
+            buffer_windows = {
+                name[len('buffer_'):]: data[name]
+                for name in data.files
+                if name.startswith('buffer_')
+            }
+    except Exception as e:
+        logger.warning(f'Error reading stream checkpoint {file_path}, starting cold | {e}')
+        return None
+
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        logger.info(f'Stream checkpoint version changed, starting cold...')
+        return None
+    age_seconds = now - checkpoint['ts']
+    if age_seconds > max_age_seconds or age_seconds < 0:
+        logger.info(f'Stream checkpoint is {age_seconds / 60:0.1f} minutes old, starting cold...')
+        return None
+    return checkpoint, buffer_windows
+
+
+class Checkpointer:
+    def __init__(self, interval_seconds=300, file_path: str = CHECKPOINT_FILE_PATH):
+        self.interval_seconds = interval_seconds
+        self.file_path = file_path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self.pending: Optional[Future] = None
+        self.last_ts: Optional[int] = None
+
+    def maybe_save(self, stream_processor, ts: int):
+        """
+        Snapshots the state after the record with ts was processed, if the last snapshot is interval_seconds old
+        """
+        if self.last_ts is not None and ts - self.last_ts < self.interval_seconds:
+            return
+        # Nobody in bed, a cold start loses nothing
+        if not stream_processor.is_present():
+            return
+        # Skip rather than queue snapshots while the previous one is still being written
+        if self.pending is not None and not self.pending.done():
+            return
+        self.last_ts = ts
+        state, buffer_windows = stream_processor.get_state()
+        checkpoint: StreamCheckpoint = {
+            'version': CHECKPOINT_VERSION,
+            'ts': int(ts),
+            'saved_at': time.time(),
+            'stream_processor': state,
+        }
+        self.pending = self.executor.submit(save_checkpoint, checkpoint, buffer_windows, self.file_path)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,98 @@
+"""
+Bounded queues connecting the stages of the stream service: decode (tailer) → compute (`StreamProcessor`) → persist (DB).
+
+Key functionalities:
+- `StageQueue` is a `queue.Queue` with a maximum size & an overflow policy applied when a stage falls behind:
+    - `block`: the producer waits for room, the RAW file is the buffer while the tailer is blocked.
+    - `drop_oldest`: the oldest queued item is dropped to make room.
+    - `decimate`: every `decimate_by`-th queued item is kept, so the backlog still covers the whole time span.
+- Counts the items put & dropped and the deepest the queue has been, see `StageQueue.stats()`.
+- `None` is the stop signal of every stage, it's never dropped.
+
+Usage:
+    piezo_record_queue = StageQueue('decode', maxsize=300, overflow_policy='block')
+    piezo_record_queue.put(piezo_record)
+    logger.info(format_stats([piezo_record_queue.stats()]))
+"""
+import queue
+from collections import deque
+from typing import List, Literal, TypedDict
+
+OverflowPolicy = Literal['block', 'drop_oldest', 'decimate']
+
+
+class StageQueueStats(TypedDict):
+    name: str
+    depth: int
+    max_depth: int
+    put_count: int
+    drop_count: int
+
+
+class StageQueue(queue.Queue):
+    def __init__(self, name: str, maxsize: int, overflow_policy: OverflowPolicy = 'block', decimate_by=2):
+        if overflow_policy not in ('block', 'drop_oldest', 'decimate'):
+            raise ValueError(f'Unknown overflow policy: {overflow_policy}')
+        super().__init__(maxsize)
+        self.name = name
+        self.overflow_policy = overflow_policy
+        self.decimate_by = decimate_by
+        self.put_count = 0
+        self.drop_count = 0
+        self.max_depth = 0
+
+    def _drop(self):
+        """Makes room for one item according to the overflow policy, called with the mutex held"""
+        dropped = 0
+        if self.overflow_policy == 'drop_oldest':
+            # Stop signals are kept
+            for i, item in enumerate(self.queue):
+                if item is not None:
+                    del self.queue[i]
+                    dropped = 1
+                    break
+        else:
+            items = list(self.queue)
+            kept = [item for i, item in enumerate(items) if item is None or i % self.decimate_by == 0]
+            self.queue = deque(kept)
+            dropped = len(items) - len(kept)
+        self.drop_count += dropped
+        self.unfinished_tasks -= dropped
+
+    def put(self, item, block=True, timeout=None):
+        if self.overflow_policy == 'block' or item is None or self.maxsize <= 0:
+            super().put(item, block, timeout)
+            with self.mutex:
+                self.put_count += 1
+                self.max_depth = max(self.max_depth, self._qsize())
+            return
+
+        with self.not_full:
+            if self._qsize() >= self.maxsize:
+                self._drop()
+            if self._qsize() >= self.maxsize:
+                # Only stop signals are queued, wait for room like the block policy
+                while self._qsize() >= self.maxsize:
+                    self.not_full.wait()
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.put_count += 1
+            self.max_depth = max(self.max_depth, self._qsize())
+            self.not_empty.notify()
+
+    def stats(self) -> StageQueueStats:
+        with self.mutex:
+            return {
+                'name': self.name,
+                'depth': self._qsize(),
+                'max_depth': self.max_depth,
+                'put_count': self.put_count,
+                'drop_count': self.drop_count,
+            }
+
+
+def format_stats(stats: List[StageQueueStats]) -> str:
+    return ' | '.join(
+        f"{stage['name']}: depth {stage['depth']} (max {stage['max_depth']}), {stage['put_count']:,} put, {stage['drop_count']:,} dropped"
+        for stage in stats
+    )
@@ -0,0 +1,242 @@
+"""
+This script replays recorded `.RAW` files (or a synthetic corpus) through the stream service's decode path
+(`LatestRawFileHandler`) & `StreamProcessor`, driven by a virtual clock instead of the wall clock.
+
+Key functionalities:
+- Appends the records of the source files second by second to a temporary RAW file the handler tails, the virtual
+  clock is set to each second, so the 2 minute staleness check & catch-up mode behave like they did live.
+- `--speed=0` replays as fast as possible, `--speed=N` paces the replay at N× real time.
+- Measurements go to a list instead of the database, they're reported like `insert_vitals` would have stored them.
+- Reports records/s & per-record latency percentiles of `process_piezo_record`.
+- `--output` saves the report as JSON, `--baseline` compares the vitals against a saved report and exits with 1
+  when they differ, as a regression check for changes to `BiometricProcessor`.
+
+Usage:
+    cd /home/dac/free-sleep/biometrics/stream && /home/dac/venv/bin/python replay.py --folder_path=/persistent/ --start_time="2025-01-10 20:00:00" --end_time="2025-01-11 08:00:00"
+    python biometrics/stream/replay.py --synthetic_hours=1 --output=/tmp/replay.json
+"""
+import sys
+import os
+import json
+import queue
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Tuple, TypedDict
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+# Replays run on any machine, not only the Pod, import the biometrics modules relative to this script
+BIOMETRICS_FOLDER_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BIOMETRICS_FOLDER_PATH)
+sys.path.append(os.path.join(BIOMETRICS_FOLDER_PATH, 'stream'))
+sys.path.append(os.path.join(BIOMETRICS_FOLDER_PATH, 'benchmarks'))
+
+# This must run before the other local import in order to set up the logger
+from get_logger import get_logger
+
+logger = get_logger('stream-replay')
+
+from data_types import *
+from biometrics_helpers import validate_datetime_utc
+from db import _prepare_vitals
+from load_raw_files import get_current_files
+from raw_cbor import CBORPeekError, peek_type_ts
+from raw_reader import RawFileReader
+from stream import CATCH_UP_SECONDS, LatestRawFileHandler
+from stream_processor import StreamProcessor
+from vitals.breathing import BreathingMethod
+
+REPLAY_FILE_NAME = '00000000.RAW'
+
+
+class VirtualClock:
+    """
+    Stands in for `time.time`, the replay sets it to the second being replayed
+    """
+
+    def __init__(self, now: float = 0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class ReplayReport(TypedDict):
+    records: int
+    seconds: float
+    records_per_second: float
+    latency_ms: Dict[str, float]  # Percentiles of the per-record processing time
+    caught_up_count: int
+    peak_searches: Dict[str, int]  # Heart rate peak searches & the ones which swept every threshold, with --adaptive_peak_search
+    vitals: List[Measurement]  # As insert_vitals would have stored them
+
+
+def iter_replay_seconds(file_paths: List[str], start_ts: Optional[int] = None, end_ts: Optional[int] = None) -> Iterator[Tuple[int, bytes]]:
+    """
+    Yields (ts, encoded records) for every second of the source files, in the order the records were written
+    """
+    for file_path in file_paths:
+        with open(file_path, 'rb') as raw_file:
+            file_bytes = raw_file.read()
+        current_ts, chunks = None, []
+        with RawFileReader(file_path) as reader:
+            for record_start, record_end, _, data in reader.iter_records():
+                try:
+                    _, ts = peek_type_ts(data)
+                except CBORPeekError:
+                    continue
+                if (start_ts is not None and ts < start_ts) or (end_ts is not None and ts > end_ts):
+                    continue
+                if current_ts is not None and ts != current_ts:
+                    yield current_ts, b''.join(chunks)
+                    chunks = []
+                current_ts = ts
+                chunks.append(file_bytes[record_start:record_end])
+        if chunks:
+            yield current_ts, b''.join(chunks)
+
+
+def replay(
+        file_paths: List[str],
+        start_ts: Optional[int] = None,
+        end_ts: Optional[int] = None,
+        speed: float = 0,
+        workers: int = 1,
+        breathing_method: BreathingMethod = 'heartpy',
+        adaptive_peak_search=False,
+) -> ReplayReport:
+    clock = VirtualClock()
+    record_queue = queue.Queue()
+    vitals: List[Measurement] = []
+    latencies: List[float] = []
+    stream_processor: Optional[StreamProcessor] = None
+    wall_start, first_ts = time.perf_counter(), None
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        replay_file_path = os.path.join(folder_path, REPLAY_FILE_NAME)
+        open(replay_file_path, 'wb').close()
+        handler = LatestRawFileHandler(folder_path, record_queue=record_queue, clock=clock)
+
+        with open(replay_file_path, 'ab') as replay_file:
+            for ts, encoded in iter_replay_seconds(file_paths, start_ts, end_ts):
+                if first_ts is None:
+                    first_ts = ts
+                if speed > 0:
+                    # Wait until the second is due at the replay speed
+                    delay = wall_start + (ts - first_ts) / speed - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                clock.now = ts
+                replay_file.write(encoded)
+                replay_file.flush()
+                handler.follow_latest_file()
+
+                while not record_queue.empty():
+                    piezo_record = record_queue.get_nowait()
+                    if stream_processor is None:
+                        stream_processor = StreamProcessor(
+                            piezo_record,
+                            workers=workers,
+                            persist=lambda measurement: vitals.append(_prepare_vitals(dict(measurement))),
+                            breathing_method=breathing_method,
+                            adaptive_peak_search=adaptive_peak_search,
+                        )
+                    start = time.perf_counter()
+                    stream_processor.process_piezo_record(piezo_record, catch_up=clock() - piezo_record['ts'] > CATCH_UP_SECONDS)
+                    latencies.append(time.perf_counter() - start)
+        if handler.latest_file_reader:
+            handler.latest_file_reader.close()
+
+    seconds = time.perf_counter() - wall_start
+    caught_up_count = 0
+    peak_searches = {}
+    if stream_processor is not None:
+        caught_up_count = stream_processor.caught_up_count
+        if adaptive_peak_search:
+            processors = [stream_processor.left_processor, stream_processor.right_processor]
+            peak_searches = {
+                'searches': sum(processor.peak_search_count for processor in processors),
+                'full_sweeps': sum(processor.full_sweep_count for processor in processors),
+            }
+        stream_processor.close()
+    latency_ms = {}
+    if latencies:
+        for percentile in [50, 90, 99, 100]:
+            latency_ms[f'p{percentile}'] = round(float(np.percentile(latencies, percentile)) * 1000, 2)
+    return {
+        'records': len(latencies),
+        'seconds': round(seconds, 2),
+        'records_per_second': round(len(latencies) / seconds, 1) if seconds > 0 else 0,
+        'latency_ms': latency_ms,
+        'caught_up_count': caught_up_count,
+        'peak_searches': peak_searches,
+        'vitals': [{key: (value.item() if isinstance(value, np.generic) else value) for key, value in measurement.items()} for measurement in vitals],
+    }
+
+
+def _parse_args() -> Namespace:
+    parser = ArgumentParser(description="Replay RAW files through the stream processor with a virtual clock.")
+    parser.add_argument("--folder_path", default=None, help="Folder holding the RAW files to replay.")
+    parser.add_argument("--start_time", type=validate_datetime_utc, default=None, help="Start time in UTC format 'YYYY-MM-DD HH:MM:SS'.")
+    parser.add_argument("--end_time", type=validate_datetime_utc, default=None, help="End time in UTC format 'YYYY-MM-DD HH:MM:SS'.")
+    parser.add_argument("--synthetic_hours", type=float, default=None, help="Replay a synthetic corpus of this many hours instead of --folder_path.")
+    parser.add_argument("--speed", type=float, default=0, help="Replay at this multiple of real time, 0 replays as fast as possible (default: 0).")
+    parser.add_argument("--workers", type=int, default=1, help="StreamProcessor workers (default: 1).")
+    parser.add_argument("--breathing_method", choices=['heartpy', 'piezo'], default='heartpy', help="Breathing rate method, see vitals/breathing.py (default: heartpy).")
+    parser.add_argument("--adaptive_peak_search", action="store_true", help="Start the heart rate peak search of each channel from its previous threshold.")
+    parser.add_argument("--output", default=None, help="Write the report to this JSON file.")
+    parser.add_argument("--baseline", default=None, help="JSON report of a previous replay to compare the vitals against.")
+    args = parser.parse_args()
+    if (args.folder_path is None) == (args.synthetic_hours is None):
+        parser.error('Either --folder_path or --synthetic_hours is required')
+    return args
+
+
+def main(args: Namespace) -> int:
+    with tempfile.TemporaryDirectory() as synthetic_folder_path:
+        if args.synthetic_hours is not None:
+            from generate_raw_corpus import write_raw_corpus
+
+            start_time = datetime(2025, 1, 10, 20, 0, 0, tzinfo=timezone.utc)
+            file_paths = write_raw_corpus(synthetic_folder_path, start_time, args.synthetic_hours)
+        else:
+            file_paths = sorted(get_current_files(args.folder_path))
+
+        start_ts = None if args.start_time is None else int(args.start_time.timestamp())
+        end_ts = None if args.end_time is None else int(args.end_time.timestamp())
+        logger.info(f'Replaying {len(file_paths)} RAW file(s)...')
+        report = replay(file_paths, start_ts=start_ts, end_ts=end_ts, speed=args.speed, workers=args.workers, breathing_method=args.breathing_method, adaptive_peak_search=args.adaptive_peak_search)
+
+    logger.info(
+        f"Replayed {report['records']:,} records in {report['seconds']:0.1f}s | {report['records_per_second']:,.1f} records/s | "
+        f"latency {' '.join(f'{key} {value:0.1f} ms' for key, value in report['latency_ms'].items())} | "
+        f"{report['caught_up_count']:,} caught up | {len(report['vitals']):,} vitals"
+    )
+    if report['peak_searches']:
+        searches = report['peak_searches']
+        logger.info(f"Peak searches | {searches['full_sweeps']:,} of {searches['searches']:,} swept every threshold")
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        logger.info(f'Wrote report to {args.output}')
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline: ReplayReport = json.load(baseline_file)
+        if baseline['vitals'] != report['vitals']:
+            changed = sum(1 for a, b in zip(baseline['vitals'], report['vitals']) if a != b)
+            changed += abs(len(baseline['vitals']) - len(report['vitals']))
+            logger.error(f"Vitals differ from {args.baseline} | {changed:,} of {len(baseline['vitals']):,} measurement(s) changed")
+            return 1
+        logger.info(f"Vitals match {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    logger.setLevel('INFO')
+    sys.exit(main(args))
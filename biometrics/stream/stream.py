@@ -3,12 +3,18 @@ This script monitors a directory for the latest .RAW file generated by the 8 Sle
 and processes its CBOR-encoded biometric data in real-time.
 
 Key functionalities:
-- Watches the `/persistent` directory for new .RAW files using `watchdog`.
+- Watches the `/persistent` directory using `watchdog`, created & modified events wake the tailer right away.
 - Tracks only the most recently modified .RAW file, avoiding stale data.
-- Reads CBOR-encoded lines from the active file and extracts biometric records.
+- Falls back to polling the directory when the file grows without any events arriving.
+- Memory maps the active file and reads its CBOR records in place (see `raw_reader.py`).
 - Filters and processes `piezo-dual` sensor data, ensuring only recent entries are used.
 - Loads parsed piezoelectric sensor data into `load_piezo_row` and queues it for processing.
 - Uses `StreamProcessor` to analyze incoming biometric records.
+- Decode, compute & persist run as stages connected by bounded queues (`pipeline.py`), a compute stage
+  that fell behind only buffers stale records until it caught up.
+- Vitals are written in batches by a dedicated writer thread (`vitals_writer.py`).
+- Snapshots the processing state & restores it on restart (`checkpoint.py`), the tailer seeks past stale records
+  with the RAW file index instead of decoding the active file from the start.
 - Runs the monitoring and processing loop in a separate thread for efficiency.
 - Handles graceful shutdown via KeyboardInterrupt.
 
@@ -20,107 +26,255 @@ This is set up to run as a systemctl service, but you can manually run it with:
 import sys
 import platform
 import cbor2
-from datetime import datetime, timedelta
+from datetime import datetime
 
 if platform.system().lower() == 'linux':
     sys.path.append('/home/dac/free-sleep/biometrics/')
     sys.path.append('/home/dac/free-sleep/biometrics/stream/')
 
+import math
 import time
 import os
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import queue
 import threading
+from typing import Callable, Optional
 
 from get_logger import get_logger
 logger = get_logger('free-sleep-stream')
 
 from stream_processor import StreamProcessor
 from load_raw_files import load_piezo_row
-
-
-# Global queue for processing decoded biometric data
-piezo_record_queue = queue.Queue()
+from raw_cbor import CBORPeekError, encode_keys, peek_type_ts, read_fields
+from raw_reader import RawFileReader
+from raw_index import get_seek_range
+from checkpoint import Checkpointer, load_checkpoint
+from pipeline import StageQueue, format_stats
+from vitals_writer import VitalsWriter, format_writer_stats
+from data_types import *
+
+
+# Decode → compute → persist stages, see `pipeline.py`
+# Global queue for processing decoded biometric data, the tailer blocks when it's full, the RAW file holds the backlog
+piezo_record_queue = StageQueue('decode', maxsize=300, overflow_policy='block')
+# Measurements waiting for the DB, the oldest ones are dropped rather than stalling the compute stage
+vitals_queue = StageQueue('persist', maxsize=1_000, overflow_policy='drop_oldest')
+
+# Measurements are written behind the compute stage, in one transaction per flush interval
+vitals_writer = VitalsWriter(vitals_queue, flush_seconds=10)
+
+# Records older than this are skipped by the tailer
+STALE_RECORD_SECONDS = 2 * 60
+# Records older than this are only buffered & checked for presence until the compute stage caught up
+CATCH_UP_SECONDS = 10
+# How often the processing state is snapshotted while someone is in bed, see `checkpoint.py`
+CHECKPOINT_SECONDS = 5 * 60
+# How often the queue counters are logged
+STATS_LOG_SECONDS = 300
+
+# The tailer is woken by inotify events, it polls the directory only when none arrived for this long
+EVENT_TIMEOUT_SECONDS = 5
+# Poll interval once the RAW file grew without any event
+POLL_SECONDS = 0.1
+
+# Workers measuring both sides & sensors concurrently, see `StreamProcessor`. Serial until replays on the Pod show
+# a latency gain, replay.py --workers=4 compares against it
+STREAM_WORKERS = 1
+STREAM_USE_PROCESSES = False
+# Breathing rate from the decimated piezo signal ('piezo') instead of heartpy's RR spline, see `vitals/breathing.py`.
+# heartpy until validated on recorded nights, the synthetic corpus adds its breathing sine straight to the piezo signal
+BREATHING_METHOD = 'heartpy'
+# Peak search warm started from the previous threshold of each channel, off as it settles on a different threshold
+# for a few percent of the 3 second windows, see `fit_peaks`
+ADAPTIVE_PEAK_SEARCH = False
+
+# Both sides are processed, every channel is needed
+PIEZO_KEYS = encode_keys(['freq', 'adc', 'gain', 'left1', 'left2', 'right1', 'right2', 'seq'])
+
+
+def _read_piezo_record(data: memoryview, record_type: str, ts: int) -> PiezoDualData:
+    try:
+        # Channels are copied out of the memory map, the record is queued to the processing thread & the map is closed on file changes
+        piezo_record = read_fields(data, PIEZO_KEYS, copy=True)
+        piezo_record['type'] = record_type
+        piezo_record['ts'] = ts
+    except CBORPeekError:
+        piezo_record = cbor2.loads(data)
+        load_piezo_row(piezo_record, 'right')
+    return piezo_record
 
 
 class LatestRawFileHandler(FileSystemEventHandler):
-    """Monitors only the latest RAW file and processes CBOR-encoded lines separately."""
+    """
+    Monitors only the latest RAW file and processes CBOR-encoded lines separately.
 
-    def __init__(self, directory):
+    inotify events only flag the handler, the files are read by the thread calling `follow_latest_file`.
+    """
+
+    def __init__(self, directory, record_queue: queue.Queue = None, clock: Callable[[], float] = time.time, resume_ts: Optional[int] = None):
         self.directory = directory
+        # The replay harness passes its own queue & a virtual clock, see `replay.py`
+        self.record_queue = piezo_record_queue if record_queue is None else record_queue
+        self.clock = clock
+        # ts of the last record processed before a restart, later records are read even if stale, see `checkpoint.py`
+        self.resume_ts = resume_ts
         self.latest_file = None
-        self.latest_file_obj = None
+        self.latest_file_reader = None
         self.last_pos = 0  # Track last read position
+        self.pending_file = None  # RAW file an event was received for, which isn't tracked yet
+        self.changed = threading.Event()
         self.track_latest_file()
+        if self.latest_file_reader:
+            self.last_pos = self._get_start_offset()
+
+    def _get_oldest_ts(self) -> float:
+        """Records before this ts are skipped"""
+        oldest_ts = self.clock() - STALE_RECORD_SECONDS
+        if self.resume_ts is not None:
+            oldest_ts = min(oldest_ts, self.resume_ts + 1)
+        return oldest_ts
+
+    def _get_start_offset(self) -> int:
+        """Byte offset of the first record worth decoding in the file tracked on start up, found with the RAW file index"""
+        if self.latest_file_reader.size == 0:
+            return 0
+        try:
+            seek_range = get_seek_range(self.latest_file, self._get_oldest_ts(), float('inf'))
+        except Exception as e:
+            logger.warning(f'Error seeking {self.latest_file}, reading it from the start | {e}')
+            return 0
+        if seek_range is None:
+            # Every record is stale, only the ones appended from now on are read
+            return self.latest_file_reader.size
+        return seek_range[0]
+
+    @staticmethod
+    def _is_raw_file(path: str) -> bool:
+        return path.endswith(".RAW") and not path.endswith('SEQNO.RAW')
 
     def track_latest_file(self):
         """Finds the most recent RAW file in the directory and starts tracking it."""
-        raw_files = [f for f in os.listdir(self.directory) if f.endswith(".RAW") and not f.endswith('SEQNO.RAW')]
+        raw_files = [f for f in os.listdir(self.directory) if self._is_raw_file(f)]
         if not raw_files:
             return
 
         # Get the latest file by modification time
         raw_files.sort(key=lambda f: os.path.getmtime(os.path.join(self.directory, f)), reverse=True)
-        latest_file = os.path.join(self.directory, raw_files[0])
+        self.track_file(os.path.join(self.directory, raw_files[0]))
+
+    def track_pending_file(self):
+        """Starts tracking the RAW file the last events were received for, without listing the directory."""
+        pending_file, self.pending_file = self.pending_file, None
+        if pending_file is not None and os.path.exists(pending_file):
+            self.track_file(pending_file)
 
+    def track_file(self, latest_file: str):
         if latest_file != self.latest_file:
             # If a new file is found, stop tracking the old one
+            # Close old file reader if open, once the records appended before the switch are read
+            if self.latest_file_reader:
+                self.follow_latest_file()
+                self.latest_file_reader.close()
+
             self.latest_file = latest_file
             logger.debug(f"Now tracking: {self.latest_file}")
 
-            # Close old file handle if open
-            if self.latest_file_obj:
-                self.latest_file_obj.close()
-
-            # Open the new file for reading in binary mode
-            self.latest_file_obj = open(self.latest_file, "rb")
+            # Memory map the new file for reading
+            self.latest_file_reader = RawFileReader(self.latest_file)
             self.last_pos = 0  # Reset position for new file
 
+    def _on_raw_file_event(self, path: str):
+        if path != self.latest_file:
+            # The pod only writes to its latest file
+            self.pending_file = path
+        self.changed.set()
+
     def on_created(self, event):
         """Triggered when a new .RAW file is created."""
-        if event.is_directory or not event.src_path.endswith(".RAW"):
+        if event.is_directory or not self._is_raw_file(event.src_path):
             return
-        self.track_latest_file()
+        self._on_raw_file_event(event.src_path)
 
-    def follow_latest_file(self):
-        """Reads and decodes new CBOR-encoded lines from the latest file."""
-        if not self.latest_file_obj:
+    def on_modified(self, event):
+        """Triggered when records are appended to a .RAW file."""
+        if event.is_directory or not self._is_raw_file(event.src_path):
             return
-
-        # Move to the last known position before reading
-        self.latest_file_obj.seek(self.last_pos)
-
-        while True:
+        self._on_raw_file_event(event.src_path)
+
+    def wait_for_changes(self, timeout: float) -> bool:
+        """Blocks until a RAW file event is received, returns False if none arrived within timeout seconds."""
+        changed = self.changed.wait(timeout)
+        self.changed.clear()
+        return changed
+
+    def follow_latest_file(self) -> int:
+        """
+        Reads and decodes the new CBOR records of the latest file, in place from a memory map.
+        Returns the number of records read.
+        """
+        if not self.latest_file_reader:
+            return 0
+
+        # Map the bytes appended since the last read, nothing to decode if the file didn't grow
+        self.latest_file_reader.remap()
+        if self.last_pos >= self.latest_file_reader.size:
+            return 0
+        oldest_ts = self._get_oldest_ts()
+
+        record_count = 0
+        for _, record_end, _, data in self.latest_file_reader.iter_records(self.last_pos):
+            # Update last read position
+            self.last_pos = record_end
+            record_count += 1
             try:
-                # Decode CBOR object from a **single line**
-                row = cbor2.load(self.latest_file_obj)  # Load the next CBOR object
-                one_minute_ago = datetime.now() - timedelta(minutes=2)
-
-                if 'data' in row:  # Check if 'data' key exists
-                    decoded_data = cbor2.loads(row['data'])
-                    if decoded_data['type'] != 'piezo-dual':
-                        continue
-                    record_time = datetime.fromtimestamp(decoded_data['ts'])
-                    if one_minute_ago > record_time:
-                        continue
-                    load_piezo_row(decoded_data, 'right')
-                    piezo_record_queue.put(decoded_data)
-
-                # Update last read position
-                self.last_pos = self.latest_file_obj.tell()
-
-            except EOFError:
-                # No more CBOR objects to read
-                break
+                # Peek the type & ts first, only piezo records that'll be processed are decoded
+                try:
+                    record_type, ts = peek_type_ts(data)
+                except CBORPeekError:
+                    decoded_data = cbor2.loads(data)
+                    record_type, ts = decoded_data['type'], decoded_data['ts']
+                if record_type != 'piezo-dual':
+                    continue
+                if ts < oldest_ts:
+                    continue
+                piezo_record = _read_piezo_record(data, record_type, ts)
+                self.record_queue.put(piezo_record)
             except Exception as e:
                 logger.error(f"Error decoding CBOR: {e}")
-                break
+        return record_count
+
+
+def _queue_measurement(measurement: Measurement):
+    # A NaN heart rate can't be stored, it would only make the writer drop the whole batch
+    if not math.isfinite(measurement['heart_rate']):
+        logger.warning(f"Skipping vitals record without a heart rate @ {datetime.fromtimestamp(measurement['timestamp']).isoformat()}")
+        return
+    # The processor keeps updating its own measurements, the persist stage gets a copy
+    vitals_queue.put(dict(measurement))
 
 
-def process_biometrics():
+def process_biometrics(checkpoint=None):
     piezo_record = piezo_record_queue.get()
-    stream_processor = StreamProcessor(piezo_record, debug=False)
+    stream_processor = StreamProcessor(
+        piezo_record,
+        debug=False,
+        workers=STREAM_WORKERS,
+        use_processes=STREAM_USE_PROCESSES,
+        persist=_queue_measurement,
+        breathing_method=BREATHING_METHOD,
+        adaptive_peak_search=ADAPTIVE_PEAK_SEARCH,
+    )
+    if checkpoint is not None:
+        stream_checkpoint, buffer_windows = checkpoint
+        if stream_processor.restore_state(stream_checkpoint['stream_processor'], buffer_windows):
+            logger.info(f"Restored stream checkpoint @ {datetime.fromtimestamp(stream_checkpoint['ts']).isoformat()}")
+            # The tailer resumed right after the snapshot, the record the processor was built from is the next second
+            stream_processor.process_piezo_record(piezo_record, catch_up=time.time() - piezo_record['ts'] > CATCH_UP_SECONDS)
+        else:
+            logger.info('Stream checkpoint was saved with a different configuration, starting cold...')
+    checkpointer = Checkpointer(interval_seconds=CHECKPOINT_SECONDS)
+    last_stats_log = time.time()
     while True:
         try:
             piezo_record = piezo_record_queue.get(timeout=5)
@@ -129,41 +283,70 @@ def process_biometrics():
                 # Stop if None is received
                 break
 
-            stream_processor.process_piezo_record(piezo_record)
+            now = time.time()
+            stream_processor.process_piezo_record(piezo_record, catch_up=now - piezo_record['ts'] > CATCH_UP_SECONDS)
+            checkpointer.maybe_save(stream_processor, piezo_record['ts'])
             piezo_record_queue.task_done()
+
+            if now - last_stats_log >= STATS_LOG_SECONDS:
+                last_stats_log = now
+                logger.info(
+                    f'{format_stats([piezo_record_queue.stats(), vitals_queue.stats()])} | '
+                    f'compute: {stream_processor.caught_up_count:,} stale records skipped | '
+                    f'{format_writer_stats(vitals_writer.stats())}'
+                )
         except queue.Empty:
             # Just continue if the queue is empty, do not exit the loop
             logger.info("No new data, retrying...")
         except Exception as e:
             logger.error(e)
+    stream_processor.close()
+    checkpointer.close()
+    vitals_queue.put(None)  # Send stop signal to the vitals writer
 
 
 def watch_directory(directory="/persistent"):
     logger.info('Steam processor starting...')
     """Monitors the directory for new RAW files and processes only the latest one."""
-    handler = LatestRawFileHandler(directory)
+    # Resume from the last snapshot if it's recent, the tailer starts reading right after its last record
+    checkpoint = load_checkpoint(time.time())
+    handler = LatestRawFileHandler(directory, resume_ts=None if checkpoint is None else checkpoint[0]['ts'])
     observer = Observer()
     observer.schedule(handler, directory, recursive=False)
     observer.start()
 
-    # Start biometric processing in a separate thread
-    processing_thread = threading.Thread(target=process_biometrics, daemon=True)
+    # Start biometric processing & persistence in separate threads
+    processing_thread = threading.Thread(target=process_biometrics, args=(checkpoint,), daemon=True)
     processing_thread.start()
+    persist_thread = threading.Thread(target=vitals_writer.run, daemon=True)
+    persist_thread.start()
 
     logger.debug('Steam processor set up successfully, running...')
+    timeout = EVENT_TIMEOUT_SECONDS
     try:
         while True:
-            time.sleep(0.1)
+            if handler.wait_for_changes(timeout):
+                handler.track_pending_file()  # Switch to a newer file if the pod created one
+                handler.follow_latest_file()  # Read new CBOR entries line-by-line
+                timeout = EVENT_TIMEOUT_SECONDS
+                continue
+
+            # No events for a while, poll in case they stopped arriving
             handler.track_latest_file()  # Check if a newer file exists
-            handler.follow_latest_file()  # Read new CBOR entries line-by-line
+            if handler.follow_latest_file() > 0:
+                if timeout != POLL_SECONDS:
+                    logger.warning(f'RAW file grew without file system events, polling every {POLL_SECONDS}s...')
+                timeout = POLL_SECONDS
     except KeyboardInterrupt:
         observer.stop()
         piezo_record_queue.put(None)  # Send stop signal to processing thread
         processing_thread.join()
+        persist_thread.join()
     except Exception as e:
         logger.error(e)
         raise e
     observer.join()
 
-# Start watching and processing the latest .RAW file
-watch_directory("/persistent")
+if __name__ == "__main__":
+    # Start watching and processing the latest .RAW file
+    watch_directory("/persistent")
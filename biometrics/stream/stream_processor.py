@@ -7,42 +7,72 @@ Key functionalities:
 - Buffers incoming piezoelectric sensor data to process trends over time.
 - Detects user presence based on signal strength for both left and right sides.
 - Uses `BiometricProcessor` to analyze heart rate, HRV, and breathing rate.
+- HRV is calculated from the beats the heart rate measurements found, see `beat_store.py`.
+- With `adaptive_peak_search` the heart rate peak search of each channel starts from its previous threshold.
+- With `breathing_method='piezo'` the breathing rate is estimated from each side's decimated signal, which is
+  updated with every record, see `vitals/breathing.py`.
 - Supports single and dual-sensor configurations.
+- Optionally measures both sides & sensors concurrently on a thread or process pool (`workers`).
+- Catch-up mode only buffers stale records & tracks presence, skipping the vitals calculations.
+- Its running state can be saved & restored for warm restarts, see `checkpoint.py`.
 - Maintains a rolling buffer of sensor readings to smooth out noise.
 - Extracts timestamped biometric data and logs presence detections.
 
 Usage:
 Instantiate `StreamProcessor` with an initial piezo record and call `process_piezo_record(piezo_record)`
-with new sensor data to continuously track and analyze biometric trends.
+with new sensor data to continuously track and analyze biometric trends. Call `close()` to stop its workers.
 """
 import sys
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
 from get_logger import get_logger
-from biometric_processor import BiometricProcessor
+from biometric_processor import BiometricProcessor, measure_signal
 from buffer import Buffer
 from data_types import *
+from vitals.breathing import BreathingMethod
+from load_raw_files import get_mp_context
 import numpy as np
 
 logger = get_logger()
 
+# (processor, 'heart_rate' | 'breath_rate' | 'hrv', signals to measure)
+VitalsJob = Tuple[BiometricProcessor, str, List[np.ndarray]]
+
 
 class StreamProcessor:
     def __init__(
             self,
             piezo_record,
             debug=False,
+            workers=1,
+            use_processes=False,
+            persist: Optional[Callable[[Measurement], None]] = None,
+            breathing_method: BreathingMethod = 'heartpy',
+            adaptive_peak_search=False,
     ):
         if 'left2' in piezo_record:
             self.sensor_count = 2
         else:
             self.sensor_count = 1
-        self.left_processor = BiometricProcessor(side='left', sensor_count=self.sensor_count, insertion_frequency=60, debug=debug)
-        self.right_processor = BiometricProcessor(side='right', sensor_count=self.sensor_count, insertion_frequency=60, debug=debug)
+        persist_kwargs = {} if persist is None else {'persist': persist}
+        self.breathing_method = breathing_method
+        self.left_processor = BiometricProcessor(side='left', sensor_count=self.sensor_count, insertion_frequency=60, debug=debug, breathing_method=breathing_method, adaptive_peak_search=adaptive_peak_search, **persist_kwargs)
+        self.right_processor = BiometricProcessor(side='right', sensor_count=self.sensor_count, insertion_frequency=60, debug=debug, breathing_method=breathing_method, adaptive_peak_search=adaptive_peak_search, **persist_kwargs)
         self.buffer = Buffer(
             self.right_processor.heart_rate_window_seconds,
             self.right_processor.breath_rate_window_seconds,
             self.right_processor.hrv_window_seconds,
         )
         self.iteration_count = 0
+        self.caught_up_count = 0  # Records only buffered & checked for presence, see `process_piezo_record`
+
+        # With more than one worker, the signals of both sides & sensors are measured concurrently.
+        # numpy & scipy release the GIL in their kernels, heartpy's peak fitting doesn't, see `use_processes`.
+        self.executor: Optional[Executor] = None
+        if workers > 1 and use_processes:
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_mp_context())
+        elif workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='biometrics')
 
     def check_presence(self, left1_signal: np.ndarray, right1_signal: np.ndarray):
         self.left_processor.detect_presence(left1_signal)
@@ -60,9 +90,69 @@ class StreamProcessor:
             and self.iteration_count % self.left_processor.hrv_insertion_frequency == 0
         )
 
-    def process_piezo_record(self, piezo_record: PiezoDualData):
+    def _get_side_jobs(self, side: Side, processor: BiometricProcessor, signal1: np.ndarray, log: bool, time: datetime) -> List[VitalsJob]:
+        if processor.present_for <= processor.heart_rate_window_seconds:
+            return []
+        if log:
+            logger.debug(f'Presence detected for {side} side @ {time.isoformat()}')
+
+        # Heart rate calculation
+        heart_rate_signals = [signal1]
+        if self.sensor_count == 2:
+            heart_rate_signals.append(self.buffer.get_heart_rate_signal(side, 2))
+        jobs: List[VitalsJob] = [(processor, 'heart_rate', heart_rate_signals)]
+
+        # Breath rate calculation, the piezo engine already holds its signal
+        if self.can_calculate_breath_rate() and processor.present_for >= processor.breath_rate_window_seconds:
+            if self.breathing_method == 'piezo':
+                jobs.append((processor, 'breath_rate', []))
+            else:
+                jobs.append((processor, 'breath_rate', [self.buffer.get_signal(side, processor.breath_rate_window_seconds)]))
+
+        # HRV calculation, from the beats of the heart rate measurements so there's no signal to measure
+        if self.can_calculate_hrv() and processor.present_for >= processor.hrv_window_seconds:
+            jobs.append((processor, 'hrv', []))
+        return jobs
+
+    def _get_measure_call(self, processor: BiometricProcessor, kind: str, sensor_number: int, signal: np.ndarray) -> Tuple[Callable, tuple]:
+        """
+        Returns the function measuring a signal of a job & its arguments after the signal
+        """
+        ma_perc_hint, rolling_mean_out = None, None
+        if kind == 'heart_rate':
+            ma_perc_hint = processor.get_ma_perc_hint(sensor_number)
+            # A buffer written by a worker process wouldn't be seen here, it would only be pickled for nothing
+            if not isinstance(self.executor, ProcessPoolExecutor):
+                rolling_mean_out = processor.get_rolling_mean_buffer(sensor_number, len(signal))
+        return measure_signal, (processor.signal_percentile, processor.window_size, kind == 'breath_rate', ma_perc_hint, rolling_mean_out)
+
+    def _measure(self, jobs: List[VitalsJob]) -> List[List[Optional[HeartPyMeasurement]]]:
+        """
+        Measures every signal of the jobs, concurrently when a pool is set up. All the measurements are
+        joined before returning, the buffer views they read are overwritten by the next record.
+        """
+        calls = [
+            [(signal, *self._get_measure_call(processor, kind, sensor_number, signal)) for sensor_number, signal in enumerate(signals, start=1)]
+            for processor, kind, signals in jobs
+        ]
+        if self.executor is None:
+            return [[measure(signal, *args) for signal, measure, args in job_calls] for job_calls in calls]
+        futures = [
+            [self.executor.submit(measure, signal, *args) for signal, measure, args in job_calls]
+            for job_calls in calls
+        ]
+        return [[future.result() for future in job_futures] for job_futures in futures]
+
+    def process_piezo_record(self, piezo_record: PiezoDualData, catch_up=False):
+        """
+        With catch_up, the record is buffered & used for presence detection but no vitals are calculated,
+        so a backlog of stale records is worked off quickly while the buffer & presence state stay consistent.
+        """
         self.iteration_count += 1
         self.buffer.append(piezo_record)
+        if self.breathing_method == 'piezo':
+            self.left_processor.breathing_engine.append(piezo_record['left1'])
+            self.right_processor.breathing_engine.append(piezo_record['right1'])
         if self.iteration_count > self.left_processor.heart_rate_window_seconds:
             left1_signal = self.buffer.get_heart_rate_signal('left', 1)
             right1_signal = self.buffer.get_heart_rate_signal('right', 1)
@@ -74,50 +164,67 @@ class StreamProcessor:
                 logger.debug(f'Process check - Processing piezo record @ {time.isoformat()}')
 
             self.check_presence(left1_signal, right1_signal)
+            if catch_up:
+                self.caught_up_count += 1
+                return
+
+            jobs = [
+                *self._get_side_jobs('left', self.left_processor, left1_signal, log, time),
+                *self._get_side_jobs('right', self.right_processor, right1_signal, log, time),
+            ]
+            if len(jobs) == 0:
+                return
+
+            # Measurements are applied in the same order they'd be calculated serially, so the output is deterministic
+            for (processor, kind, _), measurements in zip(jobs, self._measure(jobs)):
+                if kind == 'heart_rate':
+                    processor.update_heart_rate(epoch, *measurements)
+                elif kind == 'breath_rate' and self.breathing_method == 'piezo':
+                    processor.calculate_breath_rate_from_engine()
+                elif kind == 'breath_rate':
+                    processor.update_breath_rate(measurements[0])
+                else:
+                    processor.calculate_hrv_from_beats()
 
-            # Process left side
-            if self.left_processor.present_for > self.left_processor.heart_rate_window_seconds:
-                if log:
-                    logger.debug(f'Presence detected for left side @ {time.isoformat()}')
-
-                left2_signal = None
-                if self.sensor_count == 2:
-                    left2_signal = self.buffer.get_heart_rate_signal('left', 2)
-
-                # Heart rate calculation
-                self.left_processor.calculate_heart_rate(epoch, left1_signal, left2_signal)
-
-                # Breath rate calculation
-                if self.can_calculate_breath_rate() and self.left_processor.present_for >= self.left_processor.breath_rate_window_seconds:
-                    breath_rate_signal = self.buffer.get_signal('left', self.left_processor.breath_rate_window_seconds)
-                    self.left_processor.calculate_breath_rate(breath_rate_signal, epoch)
-
-                # HRV calculation
-                if self.can_calculate_hrv() and self.left_processor.present_for >= self.left_processor.hrv_window_seconds:
-                    hrv_signal = self.buffer.get_signal('left', self.left_processor.hrv_window_seconds)
-                    self.left_processor.calculate_hrv(hrv_signal, epoch)
-
-            # Process right side
-            if self.right_processor.present_for > self.right_processor.heart_rate_window_seconds:
-                if log:
-                    logger.debug(f'Presence detected for right side @ {time.isoformat()}')
-
-                right2_signal = None
-                if self.sensor_count == 2:
-                    right2_signal = self.buffer.get_heart_rate_signal('right', 2)
-
-                # Heart rate calculation
-                self.right_processor.calculate_heart_rate(epoch, right1_signal, right2_signal)
-
-                # Breath rate calculation
-                if self.can_calculate_breath_rate() and self.right_processor.present_for >= self.right_processor.breath_rate_window_seconds:
-                    breath_rate_signal = self.buffer.get_signal('right', self.right_processor.breath_rate_window_seconds)
-                    self.right_processor.calculate_breath_rate(breath_rate_signal, epoch)
-
-                # HRV calculation
-                if self.can_calculate_hrv() and self.right_processor.present_for >= self.right_processor.hrv_window_seconds:
-                    hrv_signal = self.buffer.get_signal('right', self.right_processor.hrv_window_seconds)
-                    self.right_processor.calculate_hrv(hrv_signal, epoch)
-
-
-
+            if log:
+                for processor in [self.left_processor, self.right_processor]:
+                    if processor.adaptive_peak_search and processor.peak_search_count > 0:
+                        logger.debug(
+                            f'Peak search {processor.side} | {processor.full_sweep_count:,} of {processor.peak_search_count:,} '
+                            f'searches swept every threshold'
+                        )
+
+    def is_present(self) -> bool:
+        return self.left_processor.present or self.right_processor.present
+
+    def get_state(self) -> Tuple[dict, Dict[str, np.ndarray]]:
+        """
+        Returns the running state of both sides & a copy of the buffered signals, see `checkpoint.py`
+        """
+        state = {
+            'sensor_count': self.sensor_count,
+            'buffer_size': self.buffer.buffer_size,
+            'iteration_count': self.iteration_count,
+            'caught_up_count': self.caught_up_count,
+            'left': self.left_processor.get_state(),
+            'right': self.right_processor.get_state(),
+        }
+        return state, self.buffer.get_state()
+
+    def restore_state(self, state: dict, buffer_windows: Dict[str, np.ndarray]) -> bool:
+        """
+        Restores a state of `get_state`, returns False if it was saved with a different configuration
+        """
+        if state['sensor_count'] != self.sensor_count or state['buffer_size'] != self.buffer.buffer_size:
+            return False
+        self.iteration_count = state['iteration_count']
+        self.caught_up_count = state['caught_up_count']
+        self.left_processor.restore_state(state['left'])
+        self.right_processor.restore_state(state['right'])
+        self.buffer.restore_state(buffer_windows)
+        return True
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
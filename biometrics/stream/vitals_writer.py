@@ -0,0 +1,144 @@
+"""
+Persist stage of the stream service, writes the measurements of the compute stage to the `vitals` table behind its back.
+
+Key functionalities:
+- Runs on its own thread with its own SQLite connection, a locked database never stalls the vitals calculations.
+- Collects the measurements received within `flush_seconds` & inserts them with one `executemany` in a single
+  transaction (`db.insert_vitals_batch`).
+- When the database stays locked (the Node server or `calculate_vitals.py` writing), the batch is kept & retried with
+  an exponential backoff, measurements keep queuing up in the meantime. Any other error drops the batch, the writer
+  keeps running.
+- Reports the batch sizes & flush latency, see `VitalsWriter.stats()`.
+
+Usage:
+    writer = VitalsWriter(vitals_queue)
+    threading.Thread(target=writer.run, daemon=True).start()
+    vitals_queue.put(measurement)
+    vitals_queue.put(None)  # Flushes the pending measurements & stops the writer
+"""
+import queue
+import sqlite3
+import time
+import traceback
+from typing import List, Optional, TypedDict
+
+from get_logger import get_logger
+from db import get_connection, insert_vitals_batch
+from data_types import *
+
+logger = get_logger()
+
+
+class VitalsWriterStats(TypedDict):
+    pending: int  # Measurements waiting for the next flush
+    flush_count: int
+    row_count: int
+    max_batch_size: int
+    last_flush_ms: float
+    max_flush_ms: float
+    retry_count: int
+
+
+class VitalsWriter:
+    def __init__(self, vitals_queue: queue.Queue, flush_seconds=10.0, min_retry_seconds=1.0, max_retry_seconds=60.0, busy_timeout_ms=250):
+        self.vitals_queue = vitals_queue
+        self.flush_seconds = flush_seconds
+        self.min_retry_seconds = min_retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.busy_timeout_ms = busy_timeout_ms
+        self.connection: Optional[sqlite3.Connection] = None
+
+        self.pending: List[Measurement] = []
+        self.flush_count = 0
+        self.row_count = 0
+        self.max_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.retry_count = 0
+
+    def _flush(self) -> bool:
+        """
+        Inserts the pending measurements, returns False if the database was locked & the flush should be retried
+        """
+        start = time.perf_counter()
+        try:
+            insert_vitals_batch(self.pending, self.connection)
+        except sqlite3.OperationalError as e:
+            # Locked or busy, the batch stays pending
+            self.retry_count += 1
+            logger.warning(f'Error inserting {len(self.pending)} vitals record(s), retrying | {e}')
+            return False
+        except Exception as e:
+            # Retrying won't fix the batch itself (a constraint, a value _prepare_vitals can't convert),
+            # drop it rather than blocking the stage or ending the writer thread
+            logger.error(e)
+            logger.error(traceback.format_exc())
+            logger.error(f'Dropped {len(self.pending)} vitals record(s)')
+            self.pending = []
+            return True
+
+        flush_ms = (time.perf_counter() - start) * 1000
+        batch_size = len(self.pending)
+        self.flush_count += 1
+        self.row_count += batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.last_flush_ms = flush_ms
+        self.max_flush_ms = max(self.max_flush_ms, flush_ms)
+        logger.debug(f'Inserted {batch_size} vitals record(s) in {flush_ms:0.1f} ms')
+        self.pending = []
+        return True
+
+    def run(self):
+        # Connections can't be shared with other threads, open it on the writer thread
+        self.connection = get_connection(busy_timeout_ms=self.busy_timeout_ms, check_same_thread=True)
+        next_flush: Optional[float] = None
+        retry_seconds = self.min_retry_seconds
+        stop = False
+        try:
+            while not stop:
+                timeout = None if next_flush is None else max(0.0, next_flush - time.monotonic())
+                try:
+                    measurement = self.vitals_queue.get(timeout=timeout)
+                    self.vitals_queue.task_done()
+                    if measurement is None:
+                        # Stop if None is received, after a last flush
+                        stop = True
+                    else:
+                        self.pending.append(measurement)
+                        if next_flush is None:
+                            next_flush = time.monotonic() + self.flush_seconds
+                except queue.Empty:
+                    pass
+
+                if len(self.pending) == 0 or (not stop and time.monotonic() < next_flush):
+                    continue
+                if self._flush():
+                    next_flush = None
+                    retry_seconds = self.min_retry_seconds
+                else:
+                    next_flush = time.monotonic() + retry_seconds
+                    retry_seconds = min(retry_seconds * 2, self.max_retry_seconds)
+
+            if len(self.pending) > 0:
+                logger.error(f'Database still locked, dropped {len(self.pending)} vitals record(s) on exit')
+        finally:
+            self.connection.close()
+
+    def stats(self) -> VitalsWriterStats:
+        return {
+            'pending': len(self.pending),
+            'flush_count': self.flush_count,
+            'row_count': self.row_count,
+            'max_batch_size': self.max_batch_size,
+            'last_flush_ms': self.last_flush_ms,
+            'max_flush_ms': self.max_flush_ms,
+            'retry_count': self.retry_count,
+        }
+
+
+def format_writer_stats(stats: VitalsWriterStats) -> str:
+    return (
+        f"writer: {stats['row_count']:,} rows in {stats['flush_count']:,} flushes (max batch {stats['max_batch_size']}), "
+        f"last flush {stats['last_flush_ms']:0.1f} ms (max {stats['max_flush_ms']:0.1f} ms), "
+        f"{stats['retry_count']:,} retries, {stats['pending']} pending"
+    )
@@ -0,0 +1,99 @@
+"""
+Breathing rate from the piezo signal decimated to a few Hz, instead of heartpy's `calc_breathing` which fits a spline
+to the RR intervals, resamples it to 1000 Hz & bandpass filters it before the FFT.
+
+Key functionalities:
+- `decimate_signal` averages blocks of the 500 Hz piezo signal down to `BREATHING_SAMPLE_RATE`, the block mean is
+  the anti-aliasing filter, breathing is well below its first zero.
+- `estimate_breathing_rate` detrends & Hann windows the decimated series, takes a zero padded real FFT of a fast
+  length & returns the strongest frequency within `BREATHING_BAND`, refined by parabolic interpolation.
+- `BreathingRateEngine` keeps the decimated series of the last `window_seconds` as records arrive, an estimate
+  only transforms its few hundred samples.
+
+Rates are returned in Hz like heartpy's `breathingrate`, callers multiply by 60.
+
+Usage:
+    breathing_rate = estimate_breathing_rate(decimate_signal(signal)) * 60
+
+    engine = BreathingRateEngine(window_seconds=30)
+    engine.append(piezo_record['left1'])
+    measurement = engine.estimate()
+"""
+from typing import Literal, Optional, Tuple
+import numpy as np
+from scipy.fft import next_fast_len, rfft, rfftfreq
+from scipy.signal import detrend
+
+from data_types import *
+
+# 'heartpy' - `calc_breathing` on the RR intervals of the heart rate pipeline, 'piezo' - this module
+BreathingMethod = Literal['heartpy', 'piezo']
+
+BREATHING_SAMPLE_RATE = 5
+# Same band as calc_breathing's bandpass, 6 - 24 breaths per minute
+BREATHING_BAND = (0.1, 0.4)
+
+
+def decimate_signal(signal: np.ndarray, sample_rate=500, target_rate=BREATHING_SAMPLE_RATE) -> np.ndarray:
+    factor = int(sample_rate // target_rate)
+    length = len(signal) // factor * factor
+    return signal[:length].reshape(-1, factor).mean(axis=1)
+
+
+def estimate_breathing_rate(series: np.ndarray, sample_rate=BREATHING_SAMPLE_RATE, band: Tuple[float, float] = BREATHING_BAND, padding=4) -> float:
+    """
+    Returns the breathing rate in Hz of a decimated series, NaN if it is shorter than a cycle of the band's lowest frequency
+    """
+    if len(series) < sample_rate / band[0] or np.ptp(series) == 0:
+        return np.nan
+    data = detrend(series.astype(np.float64), type='linear') * np.hanning(len(series))
+    # Zero padding interpolates the spectrum, the parabola below refines between its bins
+    n = next_fast_len(len(data) * padding, real=True)
+    psd = np.abs(rfft(data, n)) ** 2
+    frequencies = rfftfreq(n, d=1 / sample_rate)
+
+    in_band = np.where((frequencies >= band[0]) & (frequencies <= band[1]))[0]
+    peak = in_band[np.argmax(psd[in_band])]
+    if peak == 0 or peak == len(psd) - 1:
+        return frequencies[peak]
+    left, center, right = psd[peak - 1:peak + 2]
+    denominator = left - 2 * center + right
+    offset = 0.5 * (left - right) / denominator if denominator != 0 else 0
+    return frequencies[peak] + offset * (frequencies[1] - frequencies[0])
+
+
+class BreathingRateEngine:
+    def __init__(self, window_seconds=30, sample_rate=500, target_rate=BREATHING_SAMPLE_RATE):
+        self.window_seconds = window_seconds
+        self.sample_rate = sample_rate
+        self.target_rate = target_rate
+        self.series = np.zeros(window_seconds * target_rate)
+        self.count = 0  # Decimated samples in series, at most its length
+
+    def append(self, samples: np.ndarray):
+        decimated = decimate_signal(samples, self.sample_rate, self.target_rate)
+        count = len(decimated)
+        self.series[:-count] = self.series[count:]
+        self.series[-count:] = decimated
+        self.count = min(self.count + count, len(self.series))
+
+    def estimate(self) -> Optional[HeartPyMeasurement]:
+        """
+        Returns the breathing rate of the last window_seconds as heartpy's `breathingrate`, None until the window is full
+        """
+        if self.count < len(self.series):
+            return None
+        breathing_rate = estimate_breathing_rate(self.series, self.target_rate)
+        if np.isnan(breathing_rate):
+            return None
+        return {'breathingrate': breathing_rate}
+
+    def get_state(self) -> dict:
+        return {'series': self.series[len(self.series) - self.count:].tolist()}
+
+    def restore_state(self, state: dict):
+        series = np.asarray(state['series'], dtype=np.float64)[-len(self.series):]
+        self.series[:] = 0
+        if len(series) > 0:
+            self.series[-len(series):] = series
+        self.count = len(series)
@@ -25,7 +25,7 @@ from data_types import *
 from get_logger import get_logger
 from biometrics_helpers import validate_datetime_utc
 from resource_usage import get_memory_usage_unix, get_available_memory_mb
-from load_raw_files import load_raw_files
+from load_raw_files import load_piezo_frame
 from calculations import estimate_heart_rate_intervals, clean_df_pred
 from run_data import RunData, RuntimeParams
 from db import DB_FILE_PATH
@@ -68,26 +68,6 @@ def _parse_args() -> Namespace:
     return args
 
 
-def _load_piezo_df(start_time: datetime, end_time: datetime, side: Side, folder_path: str) -> pd.DataFrame:
-    data = load_raw_files(folder_path, start_time, end_time, side, sensor_count=2, raw_data_types=['piezo-dual'])
-
-    piezo_df = pd.DataFrame(data['piezo_dual'])
-
-    # Ensure ts column is in datetime format before setting index
-    piezo_df['ts'] = pd.to_datetime(piezo_df['ts'])
-
-    # Sort and set index
-    piezo_df.sort_values(by='ts', ascending=True, inplace=True)
-    piezo_df.set_index('ts', inplace=True)
-
-    # Drop the rows where the index is between the given timestamps
-    piezo_df = piezo_df.loc[start_time:end_time]
-    piezo_df.drop(columns=['type', 'freq', 'adc', 'gain'], inplace=True)
-
-    # TODO: Filter periods not present
-    return piezo_df
-
-
 def calculate_vitals(start_time: datetime, end_time: datetime, side: Side, folder_path: str):
     # TESTING
     # side = "right"
@@ -95,8 +75,8 @@ def calculate_vitals(start_time: datetime, end_time: datetime, side: Side, folde
     # end_time = datetime.strptime("2025-01-27 14:53:00", "%Y-%m-%d %H:%M:%S")
     # folder_path = '/Users/ds/main/8sleep_biometrics/data/people/david/raw/loaded/2025-01-27/'
 
-    piezo_df = _load_piezo_df(start_time, end_time, side, folder_path)
-    print(piezo_df.head())
+    piezo_frame = load_piezo_frame(folder_path, start_time, end_time, side, sensor_count=2)
+    logger.debug(piezo_frame)
     runtime_params: RuntimeParams = {
         'window': 10,
         'slide_by': 1,
@@ -104,14 +84,15 @@ def calculate_vitals(start_time: datetime, end_time: datetime, side: Side, folde
         'hr_std_range': (1, 20),
         'hr_percentile': (20, 75),
         'signal_percentile': (0.5, 99.5),
+        'window_size': 0.65,
     }
-    if f'{side}2' in piezo_df.columns:
+    if f'{side}2' in piezo_frame.columns:
         sensor_count = 2
     else:
         sensor_count = 1
 
     run_data = RunData(
-        piezo_df,
+        piezo_frame,
         start_time.strftime('%Y-%m-%d %H:%M:%S'),
         end_time.strftime('%Y-%m-%d %H:%M:%S'),
         runtime_params=runtime_params,
@@ -134,14 +115,8 @@ def calculate_vitals(start_time: datetime, end_time: datetime, side: Side, folde
     run_data.df_pred['breathing_rate'] = run_data.df_pred['breathing_rate'].rolling(window=40, min_periods=10).mean()
     run_data.df_pred['hrv'] = run_data.df_pred['hrv'].rolling(window=40, min_periods=10).mean()
 
-    run_data.df_pred['start_time'] = pd.to_datetime(run_data.df_pred['start_time'])
-    run_data.df_pred['end_time'] = pd.to_datetime(run_data.df_pred['end_time'])
-
-    # Floor start_time to the nearest 5-minute interval
-    run_data.df_pred['timestamp'] = run_data.df_pred['start_time'].dt.floor('3min')
-
-    # Convert timestamps to Unix epoch (for Prisma)
-    run_data.df_pred['timestamp'] = run_data.df_pred['timestamp'].astype('int64') // 10 ** 9
+    # Floor start_time (epoch seconds) to the nearest 3-minute interval, Unix epoch for Prisma
+    run_data.df_pred['timestamp'] = run_data.df_pred['start_time'] // 180 * 180
 
     # DEBUGGING Convert epoch columns to formatted datetime strings
     # run_data.df_pred['ts_end'] = pd.to_datetime(run_data.df_pred['period_end'], unit='s').dt.strftime('%Y-%m-%d %H:%M:%S')
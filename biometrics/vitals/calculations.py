@@ -30,6 +30,7 @@ if platform.system().lower() == 'linux':
 sys.path.append(os.getcwd())
 from data_types import *
 from vitals.cleaning import interpolate_outliers_in_wave
+from vitals.breathing import decimate_signal, estimate_breathing_rate
 from heart.filtering import filter_signal, remove_baseline_wander
 from heart.preprocessing import scale_data
 from heart.heartpy import process
@@ -88,7 +89,7 @@ def clean_df_pred(df_pred: pd.DataFrame) -> pd.DataFrame:
 
 def _calculate(run_data: RunData, side: str):
     # Get the signal
-    np_array = np.concatenate(run_data.piezo_df[run_data.start_interval:run_data.end_interval][side])
+    np_array = run_data.get_signal(side)
 
     # Remove outliers from signal
     data = interpolate_outliers_in_wave(
@@ -108,20 +109,28 @@ def _calculate(run_data: RunData, side: str):
         filtertype='bandpass'
     )
 
-    working_data, measurement = process(
-        data,
-        500,
-        breathing_method='fft',
-        bpmmin=40,
-        bpmmax=90,
-        windowsize=run_data.window_size,
-        clean_rr_method='quotient-filter',
-        calculate_breathing=True,
-    )
+    try:
+        working_data, measurement = process(
+            data,
+            500,
+            breathing_method='fft',
+            bpmmin=40,
+            bpmmax=90,
+            windowsize=run_data.window_size,
+            calculate_breathing=run_data.breathing_method == 'heartpy',
+            ma_perc_hint=run_data.get_ma_perc_hint(side),
+            measures_only=True,
+        )
+    except BadSignalWarning:
+        run_data.track_peak_search(side, None)
+        raise
+    run_data.track_peak_search(side, working_data)
+    if run_data.breathing_method == 'piezo':
+        measurement['breathingrate'] = estimate_breathing_rate(decimate_signal(np_array))
     if run_data.is_valid(measurement):
         return {
-            'start_time': run_data.start_interval.strftime('%Y-%m-%d %H:%M:%S'),
-            'end_time': run_data.end_interval.strftime('%Y-%m-%d %H:%M:%S'),
+            'start_time': run_data.interval_start,
+            'end_time': run_data.interval_end,
             'heart_rate': measurement['bpm'],
             'hrv': measurement['sdnn'],
             'breathing_rate': measurement.get('breathingrate', 0) * 60,
@@ -156,7 +165,7 @@ def estimate_heart_rate_intervals(run_data: RunData, debug=False):
         print(f'Estimating heart rate for {run_data.name} {run_data.start_time} -> {run_data.end_time}')
 
     run_data.start_timer()
-    while run_data.start_interval <= run_data.end_datetime:
+    while run_data.interval_start <= run_data.end_epoch:
         measurement_1 = None
         measurement_2 = None
         try:
@@ -198,8 +207,8 @@ def estimate_heart_rate_intervals(run_data: RunData, debug=False):
             run_data.heart_rates.append(heart_rate)
 
             run_data.combined_measurements.append({
-                'start_time': run_data.start_interval.strftime('%Y-%m-%d %H:%M:%S'),
-                'end_time': run_data.end_interval.strftime('%Y-%m-%d %H:%M:%S'),
+                'start_time': run_data.interval_start,
+                'end_time': run_data.interval_end,
                 'heart_rate': heart_rate,
                 'hrv': (measurement_1['hrv'] + measurement_2['hrv']) / 2,
                 'breathing_rate': (measurement_1['breathing_rate'] + measurement_2['breathing_rate']) / 2 * 60,
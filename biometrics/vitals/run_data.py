@@ -4,7 +4,7 @@ This module defines the `RunData` class and related data structures for processi
 The `RunData` class is responsible for managing heart rate estimation, data validation, and result aggregation.
 It handles:
 - Initialization with runtime parameters such as window size and sliding intervals.
-- Loading and processing raw piezoelectric sensor data.
+- Loading and processing raw piezoelectric sensor data (a `pd.DataFrame` or a columnar `PiezoFrame`).
 - Estimating heart rate, heart rate variability (HRV), and breathing rate.
 - Handling multiple sensors and combining results from different sources.
 - Logging and performance tracking with built-in timing functions.
@@ -23,11 +23,12 @@ Example Usage:
     run_data.combine_results()
     run_data.print_results()
 """
+import calendar
 import math
 import time
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 from typing import Union, Tuple, TypedDict, List
 from tqdm import *
 import platform
@@ -38,7 +39,19 @@ if platform.system().lower() == 'linux':
     sys.path.append('/home/dac/free-sleep/biometrics/')
 
 from data_types import *
+from piezo_frame import PiezoFrame
 from vitals.run_data_types import *
+from vitals.breathing import BreathingMethod
+
+
+def _to_epoch(naive_utc_datetime: datetime) -> int:
+    # Interval datetimes are naive but represent UTC
+    return calendar.timegm(naive_utc_datetime.timetuple())
+
+
+def _from_epoch(epoch: int) -> datetime:
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None)
+
 
 # ---------------------------------------------------------------------------------------------------
 # region RunData
@@ -57,7 +70,7 @@ class RunData:
 
     def __init__(
             self,
-            piezo_df: pd.DataFrame,
+            piezo_df: Union[pd.DataFrame, PiezoFrame],
             start_time: str,
             end_time: str,
             runtime_params: RuntimeParams,
@@ -65,7 +78,9 @@ class RunData:
             side: str = 'right',
             sensor_count=2,
             log=True,
-            label=''
+            label='',
+            breathing_method: BreathingMethod = 'heartpy',
+            adaptive_peak_search=False,
     ):
 
         # Runtime parameters
@@ -85,6 +100,16 @@ class RunData:
         self.end_time: str = end_time  # End time in 'YYYY-MM-DD HH:MM:SS' format
         self.log = log  # Log progress to console?
         self.senor_count = sensor_count  # Some 8 sleep pods only have 1 sensor instead of 2
+        self.breathing_method = breathing_method  # See vitals/breathing.py
+        self.adaptive_peak_search = adaptive_peak_search  # Start the peak search of a column from its previous threshold
+
+        # Define the interval, kept in epoch seconds & only formatted when needed
+        self.end_datetime = datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S')
+        self.start_epoch: int = _to_epoch(datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S'))
+        self.end_epoch: int = _to_epoch(self.end_datetime)
+
+        self.interval_start: int = self.start_epoch
+        self.interval_end: int = self.start_epoch + self.window
 
         self._load_piezo_df(piezo_df)
 
@@ -96,14 +121,6 @@ class RunData:
         self.hr_moving_avg: Union[float, None] = None  # Current moving average heart rate
         self.hr_std_2: Union[float, None] = None  # Standard deviation of heart rate
 
-        # Define the interval
-        self.start_interval = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
-        self.end_datetime = datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S')
-
-        window_time = timedelta(seconds=self.window)
-        self.end_interval = self.start_interval + window_time
-        self.slide_by_time = timedelta(seconds=self.slide_by)
-
         # Stores measurements
         self.measurements_side_1 = []
         self.measurements_side_2 = []
@@ -127,9 +144,12 @@ class RunData:
         self.sensor_1_error_count: int = 0
         self.sensor_2_error_count: int = 0
         self.dropped_from_percentile: int = 0
+        self.ma_perc_hints: Dict[str, Union[float, None]] = {}  # best_ma_perc of the previous interval per column
+        self.peak_search_count: int = 0
+        self.full_sweep_count: int = 0
 
         # Time related metrics & progress bar
-        total_seconds = (self.end_datetime - self.start_interval).total_seconds()
+        total_seconds = self.end_epoch - self.start_epoch
         if total_seconds < 0:
             raise Exception(f'end_time is before start_time: {start_time} -> {end_time}')
         self.total_intervals = math.ceil(total_seconds / self.slide_by)
@@ -164,8 +184,17 @@ class RunData:
             if self.i % self.progress_bar_update_interval == 0:
                 self.bar.update()
 
-        self.start_interval += self.slide_by_time
-        self.end_interval += self.slide_by_time
+        self.interval_start += self.slide_by
+        self.interval_end += self.slide_by
+
+    @property
+    def start_interval(self) -> datetime:
+        # Naive UTC datetime of interval_start
+        return _from_epoch(self.interval_start)
+
+    @property
+    def end_interval(self) -> datetime:
+        return _from_epoch(self.interval_end)
 
     def is_valid(self, measurement) -> bool:
         if np.isnan(measurement['bpm']):
@@ -181,7 +210,11 @@ class RunData:
                 return False
         return True
 
-    def _load_piezo_df(self, piezo_df: pd.DataFrame):
+    def _load_piezo_df(self, piezo_df: Union[pd.DataFrame, PiezoFrame]):
+        if isinstance(piezo_df, PiezoFrame):
+            self.piezo_df: PiezoFrame = piezo_df.slice(self.start_epoch, self.end_epoch)
+            return
+
         # Convert start_time and end_time to datetime
         start_time_dt = pd.to_datetime(self.start_time)
         end_time_dt = pd.to_datetime(self.end_time)
@@ -189,6 +222,29 @@ class RunData:
         # self.piezo_df: pd.DataFrame = piezo_df.loc[start_time_dt:end_time_dt]
         self.piezo_df: pd.DataFrame = piezo_df[(piezo_df.index >= start_time_dt) & (piezo_df.index <= end_time_dt)]
 
+    def get_ma_perc_hint(self, column: str) -> Union[float, None]:
+        if not self.adaptive_peak_search:
+            return None
+        return self.ma_perc_hints.get(column)
+
+    def track_peak_search(self, column: str, working_data: Union[WorkingDataSummary, None]):
+        """Keeps the threshold fit_peaks selected for the next interval, working_data is None when it found no fit"""
+        if not self.adaptive_peak_search:
+            return
+        self.peak_search_count += 1
+        if working_data is None or working_data['full_sweep']:
+            self.full_sweep_count += 1
+        self.ma_perc_hints[column] = None if working_data is None else working_data['best_ma_perc']
+
+    def get_signal(self, column: str) -> np.ndarray:
+        """
+        Returns the samples of a piezo column (e.g. right1) for the current interval
+        """
+        if isinstance(self.piezo_df, PiezoFrame):
+            # Contiguous view into the channel matrix, no concatenation needed
+            return self.piezo_df.signal(column, self.interval_start, self.interval_end)
+        return np.concatenate(self.piezo_df[self.start_interval:self.end_interval][column].to_numpy())
+
     def print_results(self):
         if self.log:
             print('-----------------------------------------------------------------------------------------------------')
@@ -207,6 +263,8 @@ class RunData:
             print(f"Dropped b/ of percentile: {self.dropped_from_percentile:,}/{self.total_intervals:,}  ({(self.dropped_from_percentile / self.total_intervals) * 100:.2f}%)")
             predicted_inverval_count = len(self.combined_measurements)
             print(f"Total predicted: {predicted_inverval_count:,}/{self.total_intervals:,}  ({(predicted_inverval_count / self.total_intervals) * 100:.2f}%)")
+            if self.adaptive_peak_search and self.peak_search_count > 0:
+                print(f"Full peak searches: {self.full_sweep_count:,}/{self.peak_search_count:,}  ({(self.full_sweep_count / self.peak_search_count) * 100:.2f}%)")
 
     def start_timer(self):
         """Times runtime duration"""